@@ -0,0 +1,118 @@
+# Single event loop alternative to WebServer.py: serves the same page and MJPEG stream without a thread per viewer
+import asyncio
+import os
+import VideoStream as vs
+import Broadcaster as bc
+import Metrics as mt
+import LazyImport as lazy
+jinja2 = lazy.LazyModule("jinja2")
+
+# Constants
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 6175
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+MAX_REQUEST_SIZE = 8192 # bytes of request line and headers
+WRITE_BUFFER_LIMIT = 256*1024 # bytes queued per viewer before it waits (and skips frames)
+
+class AsyncWebServer():
+    def __init__(self, videoServer, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.videoServer = videoServer
+        self.host = host
+        self.port = port
+        self.viewers = 0
+        self.loop = None
+        self.frameEvent = None # replaced after every frame so each wait sees the next one
+
+        # Render the shared template once, the page never changes
+        environment = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), autoescape=True)
+        page = environment.get_template("index.html").render(url_for=lambda endpoint: "/" + endpoint)
+        self.indexPage = page.encode()
+
+    # Runs on the decode thread. One thread-safe wakeup per frame, however many viewers there are.
+    # The broadcaster also calls it when it closes, so waiting viewers return
+    def onFramePublished(self):
+        try:
+            self.loop.call_soon_threadsafe(self.wakeViewers)
+        except RuntimeError:
+            pass # the event loop already ended
+
+    def wakeViewers(self):
+        event = self.frameEvent
+        self.frameEvent = asyncio.Event()
+        event.set()
+
+    async def handleClient(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        requestLine = request.split(b'\r\n', 1)[0].split()
+        path = requestLine[1].decode(errors="replace") if len(requestLine) > 1 else ""
+        try:
+            if path == "/":
+                await self.sendResponse(writer, b'200 OK', b'text/html; charset=utf-8', self.indexPage)
+            elif path == "/video_feed":
+                await self.streamVideo(writer)
+            elif path == "/metrics":
+                body = self.videoServer.metrics.exposition().encode()
+                await self.sendResponse(writer, b'200 OK', mt.EXPOSITION_CONTENT_TYPE.encode(), body)
+            else:
+                await self.sendResponse(writer, b'404 Not Found', b'text/plain', b'Not Found')
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def sendResponse(self, writer, status, contentType, body):
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: ' + contentType +
+                     b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+
+    async def streamVideo(self, writer):
+        broadcaster = self.videoServer.broadcaster
+        writer.transport.set_write_buffer_limits(WRITE_BUFFER_LIMIT)
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=' +
+                     bc.MJPEG_BOUNDARY + b'\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+
+        # Only ask the decoders for JPEG while someone is watching
+        self.viewers += 1
+        if self.viewers == 1:
+            broadcaster.addListener(self.onFramePublished)
+        try:
+            sequence = 0
+            while not broadcaster.closed:
+                event = self.frameEvent
+                latestSequence, part = broadcaster.latestFrame()
+                if latestSequence == sequence:
+                    await event.wait()
+                    continue
+
+                # A slow viewer blocks in drain and then jumps to the newest frame
+                sequence = latestSequence
+                writer.write(part)
+                await writer.drain()
+        finally:
+            self.viewers -= 1
+            if self.viewers == 0:
+                broadcaster.removeListener(self.onFramePublished)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.frameEvent = asyncio.Event()
+        server = await asyncio.start_server(self.handleClient, self.host, self.port, limit=MAX_REQUEST_SIZE)
+        print("[Web]: Serving on http://" + self.host + ":" + str(self.port))
+        async with server:
+            await server.serve_forever()
+
+if __name__ == '__main__':
+    server = vs.VideoServer(display=False, live=True) # viewers read from the broadcaster
+    server.start()
+
+    try:
+        asyncio.run(AsyncWebServer(server).serve())
+    except KeyboardInterrupt:
+        print("Program ended")
+    finally:
+        server.stop()
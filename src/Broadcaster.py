@@ -0,0 +1,78 @@
+import threading
+
+# Constants
+MJPEG_BOUNDARY = b'frame'
+PART_HEADER = b'--' + MJPEG_BOUNDARY + b'\r\nContent-Type: image/jpeg\r\n\r\n'
+WAIT_TIMEOUT = 1 # seconds a subscriber waits before checking whether the broadcaster closed
+
+# A JPEG framed as one part of a multipart MJPEG response
+def mjpegPart(jpeg):
+    return b''.join((PART_HEADER, jpeg, b'\r\n'))
+
+# Publishes the latest JPEG to any number of viewers. Each frame is framed as a multipart
+# MJPEG part once and shared, and a slow viewer skips straight to the newest frame
+class FrameBroadcaster:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.sequence = 0 # number of the latest published frame
+        self.latest = None # multipart part of the latest frame
+        self.subscribers = 0
+        self.listeners = [] # called from the publishing thread after every frame, and once on close
+        self.closed = False
+
+    def publish(self, jpeg):
+        part = mjpegPart(jpeg)
+        with self.condition:
+            self.latest = part
+            self.sequence += 1
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    # Register a callback run after every published frame and once on close, e.g. to wake an event loop.
+    # Listeners keep their subscriber counted until removed
+    def addListener(self, listener):
+        with self.condition:
+            self.listeners = self.listeners + [listener]
+            self.subscribers += 1
+
+    def removeListener(self, listener):
+        with self.condition:
+            self.listeners = [l for l in self.listeners if l is not listener]
+            self.subscribers -= 1
+
+    # The latest frame without waiting. Returns (sequence, part)
+    def latestFrame(self):
+        with self.condition:
+            return (self.sequence, self.latest)
+
+    # Wait for a frame newer than lastSequence. Returns (sequence, part), or (lastSequence, None) on timeout
+    def wait(self, lastSequence, timeout=WAIT_TIMEOUT):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence != lastSequence or self.closed, timeout):
+                return (lastSequence, None)
+            if self.sequence == lastSequence:
+                return (lastSequence, None)
+            return (self.sequence, self.latest)
+
+    # Yield multipart parts until the broadcaster closes
+    def subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+        try:
+            sequence = 0
+            while not self.closed:
+                sequence, part = self.wait(sequence)
+                if part is not None:
+                    yield part
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        # Wake listeners' waiters too, they see closed and stop
+        for listener in self.listeners:
+            listener()
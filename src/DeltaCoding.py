@@ -0,0 +1,204 @@
+# Inter-frame coding for mostly static scenes: only tiles that changed since they were last sent
+# are packed into one small JPEG, with periodic full keyframes
+import math
+import struct
+import LazyImport as lazy
+cv2 = lazy.LazyModule("cv2")
+np = lazy.LazyModule("numpy")
+
+# Constants
+DELTA_MAGIC = b'VSDT'
+FLAG_KEYFRAME = 1
+DEFAULT_TILE_SIZE = 32 # pixels, a multiple of the 16 pixel JPEG macroblock so tiles never bleed into each other
+DEFAULT_THRESHOLD = 4.0 # mean absolute difference per channel value above which a tile is resent
+DEFAULT_KEYFRAME_INTERVAL = 60 # frames between keyframes, bounds how long a lost delta shows
+MOSAIC_COLUMNS = 16 # changed tiles per row of the mosaic JPEG
+DELTA_HEADER_STRUCT = struct.Struct("!4sBIHHHI") # magic, flags, sequence, width, height, tile size, number of tiles
+SEQUENCE_MODULO = 1 << 32
+TILE_INDEX_DTYPE = '>u4' # row-major tile numbers follow the header
+
+# Tiles of one frame. image is the whole frame for keyframes, otherwise a mosaic of the changed tiles
+class DeltaTiles:
+    def __init__(self, keyframe, width, height, tileSize, indices, image, sequence=0):
+        self.keyframe = keyframe
+        self.sequence = sequence # counts every frame the encoder selected, so the decoder can tell one went missing
+        self.width = width
+        self.height = height
+        self.tileSize = tileSize
+        self.indices = indices # tile numbers, row-major over the padded frame
+        self.image = image # None when nothing changed
+
+# Tiles of a padded frame as a (rows, columns, tileSize, tileSize, channels) view
+def tileView(canvas, tileSize):
+    rows, columns = canvas.shape[0]//tileSize, canvas.shape[1]//tileSize
+    return canvas.reshape(rows, tileSize, columns, tileSize, -1).swapaxes(1, 2)
+
+def isDeltaPayload(payload):
+    return bytes(payload[:len(DELTA_MAGIC)]) == DELTA_MAGIC
+
+# Pack tiles and JPEG encode the image. Safe to run on any thread
+def encode(tiles: DeltaTiles, jpegQuality: int):
+    flags = FLAG_KEYFRAME if tiles.keyframe else 0
+    header = DELTA_HEADER_STRUCT.pack(DELTA_MAGIC, flags, tiles.sequence, tiles.width, tiles.height, tiles.tileSize, len(tiles.indices))
+    if tiles.image is None:
+        return header
+    result, buf = cv2.imencode('.jpg', tiles.image, [int(cv2.IMWRITE_JPEG_QUALITY), jpegQuality])
+    return b''.join((header, tiles.indices.astype(TILE_INDEX_DTYPE).tobytes(), buf.tobytes()))
+
+# Unpack a payload and decode its JPEG. Safe to run on any thread. Returns None if malformed
+def decode(payload):
+    if len(payload) < DELTA_HEADER_STRUCT.size or not isDeltaPayload(payload):
+        return None
+    magic, flags, sequence, width, height, tileSize, numTiles = DELTA_HEADER_STRUCT.unpack_from(payload)
+    indicesEnd = DELTA_HEADER_STRUCT.size + numTiles*np.dtype(TILE_INDEX_DTYPE).itemsize
+    if len(payload) < indicesEnd or tileSize == 0:
+        return None
+    indices = np.frombuffer(payload, TILE_INDEX_DTYPE, numTiles, DELTA_HEADER_STRUCT.size).astype(np.intp)
+
+    image = None
+    if len(payload) > indicesEnd:
+        image = cv2.imdecode(np.frombuffer(payload, np.uint8, offset=indicesEnd), cv2.IMREAD_COLOR)
+        if image is None:
+            return None
+    return DeltaTiles(flags & FLAG_KEYFRAME != 0, width, height, tileSize, indices, image, sequence)
+
+# Chooses the tiles to send. Frames must be passed in capture order
+class DeltaEncoder:
+    def __init__(self, tileSize=DEFAULT_TILE_SIZE, threshold=DEFAULT_THRESHOLD, keyframeInterval=DEFAULT_KEYFRAME_INTERVAL):
+        self.tileSize = tileSize
+        self.threshold = threshold
+        self.keyframeInterval = keyframeInterval
+        self.reference = None # padded frame as last sent, tile by tile
+        self.current = None # padded copy of the frame being compared
+        self.sinceKeyframe = 0
+        self.keyframeRequested = False
+        self.sequence = 0 # of the next frame
+
+        # Counters
+        self.keyframes = 0
+        self.tilesSent = 0
+        self.tilesSkipped = 0
+
+    # Make the next frame a keyframe, e.g. after a delta was dropped before sending or the receiver lost one
+    def requestKeyframe(self):
+        self.keyframeRequested = True
+
+    def select(self, frame):
+        tiles = self._select(frame)
+        tiles.sequence = self.sequence
+        self.sequence = (self.sequence + 1) % SEQUENCE_MODULO
+        return tiles
+
+    def _select(self, frame):
+        height, width = frame.shape[:2]
+        tileSize = self.tileSize
+        paddedShape = (math.ceil(height/tileSize)*tileSize, math.ceil(width/tileSize)*tileSize) + frame.shape[2:]
+
+        if (self.reference is None or self.reference.shape != paddedShape or self.keyframeRequested
+                or self.sinceKeyframe >= self.keyframeInterval):
+            self.reference = np.zeros(paddedShape, np.uint8)
+            self.current = np.zeros(paddedShape, np.uint8)
+            self.reference[:height, :width] = frame
+            self.sinceKeyframe = 1
+            self.keyframeRequested = False
+            self.keyframes += 1
+            return DeltaTiles(True, width, height, tileSize, np.empty(0, np.intp), frame)
+        self.sinceKeyframe += 1
+
+        # Frames that are not a whole number of tiles are padded first
+        current = frame
+        if frame.shape != paddedShape or not frame.flags.c_contiguous:
+            current = self.current
+            current[:height, :width] = frame
+
+        # Sum each tile's difference down its rows, then across. The column sums of a tile fit 16 bits
+        difference = cv2.absdiff(current, self.reference)
+        rows, columns = paddedShape[0]//tileSize, paddedShape[1]//tileSize
+        columnSums = np.add.reduce(difference.reshape(rows, tileSize, -1), axis=1, dtype=np.uint16 if tileSize <= 256 else np.uint32)
+        tileSums = np.add.reduce(columnSums.reshape(rows, columns, -1), axis=2, dtype=np.uint32)
+        indices = np.flatnonzero(tileSums > self.threshold*difference[0, :tileSize].size*tileSize)
+        self.tilesSent += len(indices)
+        self.tilesSkipped += rows*columns - len(indices)
+        if len(indices) == 0:
+            return DeltaTiles(False, width, height, tileSize, indices, None)
+
+        # Gather only the changed tiles and remember them as sent
+        tileRows, tileColumns = np.divmod(indices, columns)
+        changed = tileView(current, tileSize)[tileRows, tileColumns]
+        tileView(self.reference, tileSize)[tileRows, tileColumns] = changed
+
+        mosaicColumns = min(len(indices), MOSAIC_COLUMNS)
+        mosaicRows = math.ceil(len(indices)/mosaicColumns)
+        mosaicTiles = np.zeros((mosaicRows*mosaicColumns,) + changed.shape[1:], np.uint8)
+        mosaicTiles[:len(indices)] = changed
+        mosaic = mosaicTiles.reshape((mosaicRows, mosaicColumns) + changed.shape[1:]).swapaxes(1, 2)
+        mosaic = mosaic.reshape((mosaicRows*tileSize, mosaicColumns*tileSize) + changed.shape[3:])
+        return DeltaTiles(False, width, height, tileSize, indices, mosaic)
+
+# Rebuilds full frames on a persistent canvas. Tiles must be applied in capture order. A delta after
+# a gap in the sequence would leave the tiles it missed stale, so deltas are discarded until the next keyframe
+class DeltaDecoder:
+    def __init__(self):
+        self.canvas = None
+        self.nextSequence = None # expected sequence of the next frame, None until a keyframe arrived
+        self.waitingForKeyframe = False # set when a delta was discarded, the sender should be asked for a keyframe
+        self.missingKeyframe = 0 # frames discarded while waiting for a keyframe
+        self.gaps = 0 # times frames went missing from the sequence
+        self.malformed = 0 # frames whose tiles did not fit their header or the canvas
+
+    # Returns a copy of the updated frame, or None until a keyframe has arrived
+    def apply(self, tiles: DeltaTiles):
+        tileSize = tiles.tileSize
+        height, width = tiles.height, tiles.width
+        paddedSize = (math.ceil(height/tileSize)*tileSize, math.ceil(width/tileSize)*tileSize)
+        if tiles.keyframe:
+            if tiles.image is None or tiles.image.shape[:2] != (height, width):
+                self.malformed += 1
+                self.gaps += 1
+                return self._discard()
+            paddedShape = paddedSize + tiles.image.shape[2:]
+            if self.canvas is None or self.canvas.shape != paddedShape:
+                self.canvas = np.zeros(paddedShape, np.uint8)
+            self.canvas[:height, :width] = tiles.image
+            self.nextSequence = (tiles.sequence + 1) % SEQUENCE_MODULO
+            self.waitingForKeyframe = False
+            return self.canvas[:height, :width].copy()
+
+        if self.nextSequence is not None and tiles.sequence != self.nextSequence:
+            self.gaps += 1
+            self.nextSequence = None
+        if self.nextSequence is None or self.canvas.shape[:2] != paddedSize:
+            return self._discard()
+        if not self._fits(tiles):
+            # Applying what fits would leave the other tiles stale, like a lost frame would
+            self.malformed += 1
+            self.gaps += 1
+            return self._discard()
+        self.nextSequence = (tiles.sequence + 1) % SEQUENCE_MODULO
+
+        if tiles.image is not None:
+            columns = self.canvas.shape[1]//tileSize
+            mosaicTiles = tileView(tiles.image, tileSize)
+            mosaicTiles = mosaicTiles.reshape((-1,) + mosaicTiles.shape[2:])
+            tileRows, tileColumns = np.divmod(tiles.indices, columns)
+            tileView(self.canvas, tileSize)[tileRows, tileColumns] = mosaicTiles[:len(tiles.indices)]
+        return self.canvas[:height, :width].copy()
+
+    # Drop a delta and wait for the next keyframe
+    def _discard(self):
+        self.nextSequence = None
+        self.waitingForKeyframe = True
+        self.missingKeyframe += 1
+        return None
+
+    # Whether every tile of a delta lands on the canvas and the mosaic holds all of them
+    def _fits(self, tiles: DeltaTiles):
+        tileSize = tiles.tileSize
+        numTiles = (self.canvas.shape[0]//tileSize)*(self.canvas.shape[1]//tileSize)
+        if len(tiles.indices) > 0 and tiles.indices.max() >= numTiles:
+            return False
+        image = tiles.image
+        if image is None:
+            return len(tiles.indices) == 0
+        return (image.shape[2:] == self.canvas.shape[2:] and image.shape[0] % tileSize == 0 and image.shape[1] % tileSize == 0
+                and (image.shape[0]//tileSize)*(image.shape[1]//tileSize) >= len(tiles.indices))
@@ -0,0 +1,119 @@
+import threading
+import time
+
+# Constants
+POLICY_DROP_OLDEST = "DROP_OLDEST" # overwrite the oldest frame when full
+POLICY_DROP_NEWEST = "DROP_NEWEST" # discard the incoming frame when full
+POLICY_BLOCK = "BLOCK" # producer waits for a free slot when full
+DEFAULT_CAPACITY = 180
+
+# Fixed-capacity ring of frame slots shared between one producer and one consumer thread
+class FrameRingBuffer:
+    def __init__(self, capacity=DEFAULT_CAPACITY, policy=POLICY_DROP_OLDEST):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        if policy not in (POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_BLOCK):
+            raise ValueError("unknown policy: " + str(policy))
+
+        self.capacity = capacity
+        self.policy = policy
+        self.slots = [None]*capacity # preallocated, never resized
+        self.head = 0 # next slot to read
+        self.count = 0
+        self.dropped = 0
+        self.closed = False
+
+        # Per-instance lock so independent clients/servers never contend
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+
+    def __len__(self):
+        return self.count
+
+    # Store a frame. Returns False if the frame was not stored
+    def put(self, frame, timeout=None):
+        with self.lock:
+            if self.count == self.capacity:
+                if self.policy == POLICY_DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.policy == POLICY_DROP_OLDEST:
+                    # Overwrite the oldest slot in place
+                    self.slots[self.head] = None
+                    self.head = (self.head + 1) % self.capacity
+                    self.count -= 1
+                    self.dropped += 1
+                else:
+                    if not self._wait(self.notFull, lambda: self.count < self.capacity, timeout):
+                        return False
+
+            if self.closed:
+                return False
+
+            tail = (self.head + self.count) % self.capacity
+            self.slots[tail] = frame
+            self.count += 1
+            self.notEmpty.notify()
+            return True
+
+    # Retrieve the oldest frame, waiting up to timeout seconds (None waits forever, 0 never waits)
+    def get(self, timeout=None):
+        with self.lock:
+            if self.count == 0:
+                if timeout == 0 or not self._wait(self.notEmpty, lambda: self.count > 0, timeout):
+                    return (False, None)
+
+            frame = self.slots[self.head]
+            self.slots[self.head] = None # release the reference for the GC
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+            self.notFull.notify()
+            return (True, frame)
+
+    # Retrieve up to maxFrames of the oldest frames in one go, waiting up to timeout seconds for
+    # maxFrames to arrive (None waits forever, 0 never waits). Returns fewer on timeout or close
+    def getBatch(self, maxFrames, timeout=None):
+        with self.lock:
+            if self.count < maxFrames and timeout != 0:
+                self._wait(self.notEmpty, lambda: self.count >= min(maxFrames, self.capacity), timeout)
+
+            frames = []
+            for iterator in range(min(maxFrames, self.count)):
+                frames.append(self.slots[self.head])
+                self.slots[self.head] = None
+                self.head = (self.head + 1) % self.capacity
+            self.count -= len(frames)
+            self.notFull.notify(len(frames))
+            return frames
+
+    # Remove all buffered frames
+    def clear(self):
+        with self.lock:
+            for iterator in range(self.capacity):
+                self.slots[iterator] = None
+            self.head = 0
+            self.count = 0
+            self.notFull.notify_all()
+
+    # Wake every waiting producer and consumer so their threads can exit
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.notEmpty.notify_all()
+            self.notFull.notify_all()
+
+    # Wait on a condition until the predicate holds. Lock must be held
+    def _wait(self, condition, predicate, timeout):
+        endTime = None if timeout is None else time.monotonic() + timeout
+        while not predicate():
+            if self.closed:
+                return False
+            if endTime is None:
+                condition.wait()
+            else:
+                remaining = endTime - time.monotonic()
+                if remaining <= 0:
+                    return False
+                condition.wait(remaining)
+        return True
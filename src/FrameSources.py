@@ -0,0 +1,163 @@
+# Frame sources for VideoClient. Each mirrors cv2.VideoCapture's read()/release(), so a camera,
+# a video file, a folder of images or a generated pattern can all feed the capture stage
+import glob
+import os
+import time
+import LazyImport as lazy
+cv2 = lazy.LazyModule("cv2")
+np = lazy.LazyModule("numpy")
+
+# Constants
+PACING_REALTIME = "realtime" # deliver frames at the source's frame rate
+PACING_FAST = "fast" # deliver frames as fast as they are read, for throughput runs
+DEFAULT_FPS = 30 # for sources that do not know their frame rate
+DEFAULT_WIDTH = 640
+DEFAULT_HEIGHT = 480
+PATTERN_MOVING_BOX = "movingBox" # textured background with a box crossing it, compresses like a camera
+PATTERN_GRADIENT = "gradient" # static gradient, the cheapest frames to encode
+PATTERN_NOISE = "noise" # fresh random noise, the most expensive frames to encode
+PATTERNS = (PATTERN_MOVING_BOX, PATTERN_GRADIENT, PATTERN_NOISE)
+NOISE_FRAMES = 8 # distinct noise frames cycled through, generating fresh noise would be the bottleneck
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# Hands out frames on a fixed schedule. The schedule is absolute so sleep overshoot does not add up
+class Pacer:
+    def __init__(self, fps, pacing=PACING_REALTIME):
+        self.interval = 1/fps if pacing == PACING_REALTIME and fps > 0 else 0
+        self.startTime = None
+        self.frameIndex = 0
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        now = time.perf_counter()
+        if self.startTime is None:
+            self.startTime = now
+        sleepTime = self.startTime + self.frameIndex*self.interval - now
+        if sleepTime > 0:
+            time.sleep(sleepTime)
+        elif sleepTime < -self.interval:
+            self.startTime = now - self.frameIndex*self.interval # fell behind, don't burst to catch up
+        self.frameIndex += 1
+
+class FrameSource:
+    fps = DEFAULT_FPS
+
+    # Returns (True, frame), or (False, None) once the source has ended
+    def read(self):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+# A camera paces itself, and its first read blocks until it has warmed up
+class CameraSource(FrameSource):
+    def __init__(self, index=0):
+        self.capture = cv2.VideoCapture(index)
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+
+    def read(self):
+        return self.capture.read()
+
+    def release(self):
+        self.capture.release()
+
+class VideoFileSource(FrameSource):
+    def __init__(self, path, pacing=PACING_REALTIME, loop=False):
+        self.path = path
+        self.loop = loop
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise ValueError("Cannot open video file " + str(path))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        self.pacer = Pacer(self.fps, pacing)
+
+    def read(self):
+        ret, frame = self.capture.read()
+        if not ret and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.capture.read()
+        if ret:
+            self.pacer.wait()
+        return (ret, frame)
+
+    def release(self):
+        self.capture.release()
+
+# Images in name order from a directory or a glob pattern such as "frames/*.png"
+class ImageSequenceSource(FrameSource):
+    def __init__(self, path, fps=DEFAULT_FPS, pacing=PACING_REALTIME, loop=False, preload=False):
+        if os.path.isdir(path):
+            paths = sorted(p for p in glob.glob(os.path.join(path, "*")) if p.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths = sorted(glob.glob(path))
+        if not paths:
+            raise ValueError("No images found at " + str(path))
+        self.paths = paths
+        self.fps = fps
+        self.loop = loop
+        self.pacer = Pacer(fps, pacing)
+        self.frameIndex = 0
+        # Decoding ahead of time keeps image decoding out of throughput measurements
+        self.frames = [cv2.imread(p) for p in paths] if preload else None
+
+    def read(self):
+        if self.frameIndex >= len(self.paths):
+            if not self.loop:
+                return (False, None)
+            self.frameIndex = 0
+        if self.frames is not None:
+            frame = self.frames[self.frameIndex].copy()
+        else:
+            frame = cv2.imread(self.paths[self.frameIndex])
+        self.frameIndex += 1
+        if frame is None:
+            return (False, None)
+        self.pacer.wait()
+        return (True, frame)
+
+# Generated frames, identical from run to run for a given seed
+class SyntheticSource(FrameSource):
+    def __init__(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, fps=DEFAULT_FPS, pacing=PACING_REALTIME,
+                 numFrames=None, pattern=PATTERN_MOVING_BOX, seed=0):
+        if pattern not in PATTERNS:
+            raise ValueError("Unknown pattern " + str(pattern))
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.numFrames = numFrames # None runs until released
+        self.pattern = pattern
+        self.pacer = Pacer(fps, pacing)
+        self.frameIndex = 0
+
+        random = np.random.default_rng(seed)
+        if pattern == PATTERN_NOISE:
+            self.frames = [random.integers(0, 256, (height, width, 3), dtype=np.uint8) for iterator in range(NOISE_FRAMES)]
+        else:
+            gradient = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+            texture = random.normal(0, 8, (height, width, 3))
+            self.frames = [np.clip(gradient + texture, 0, 255).astype(np.uint8)]
+        self.boxSize = max(1, min(width, height)//5)
+
+    def read(self):
+        if self.numFrames is not None and self.frameIndex >= self.numFrames:
+            return (False, None)
+        frame = self.frames[self.frameIndex % len(self.frames)].copy()
+        if self.pattern == PATTERN_MOVING_BOX:
+            x = (self.frameIndex*4) % max(1, self.width - self.boxSize)
+            y = (self.height - self.boxSize)//2
+            frame[y:y + self.boxSize, x:x + self.boxSize] = (40, 40, 200)
+        self.frameIndex += 1
+        self.pacer.wait()
+        return (True, frame)
+
+# Source for a VideoClient videoPath: a camera index, a video file, an image directory or glob
+# pattern, or a FrameSource which is used as is
+def openSource(videoPath, pacing=PACING_REALTIME, loop=False):
+    if isinstance(videoPath, FrameSource):
+        return videoPath
+    if isinstance(videoPath, int):
+        return CameraSource(videoPath)
+    if os.path.isdir(videoPath) or any(c in videoPath for c in "*?[") or videoPath.lower().endswith(IMAGE_EXTENSIONS):
+        return ImageSequenceSource(videoPath, pacing=pacing, loop=loop)
+    return VideoFileSource(videoPath, pacing, loop)
@@ -0,0 +1,20 @@
+import importlib
+
+# Stands in for a heavy module (OpenCV, NumPy) until one of its attributes is first used, so importing
+# the streaming modules, or a web server built on them, stays cheap. Safe to touch from several threads,
+# the import system serialises the actual import
+# Usage: cv2 = lazy.LazyModule("cv2")
+class LazyModule():
+    def __init__(self, name):
+        self.__name = name
+
+    # Only called for attributes not yet copied onto this object
+    def __getattr__(self, attribute):
+        value = getattr(importlib.import_module(self.__name), attribute)
+        # Later lookups hit the instance dictionary and cost no more than on the module itself
+        setattr(self, attribute, value)
+        return value
+
+    def __repr__(self):
+        return "<lazy module " + repr(self.__name) + ">"
+
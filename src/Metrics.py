@@ -0,0 +1,143 @@
+# Counters, gauges and latency histograms for VideoClient and VideoServer, readable as a snapshot
+# or in the Prometheus text format. Values already counted elsewhere are read through a function
+# at collection time, so the hot loops only pay for the timings they record
+import bisect
+import threading
+
+# Constants
+TYPE_COUNTER = "counter"
+TYPE_GAUGE = "gauge"
+TYPE_HISTOGRAM = "histogram"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5) # seconds
+EXPOSITION_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"' for k, v in labels.items()) + "}"
+
+# A monotonically increasing count. Either incremented, or read from fn when collected
+class Counter:
+    type = TYPE_COUNTER
+
+    def __init__(self, name, help, fn=None, labels=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = labels or {}
+        self.value = 0
+
+    # Only one thread may increment a counter, reads are safe from anywhere
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+    def samples(self):
+        yield (self.name, self.labels, self.get())
+
+# A value that goes up and down, e.g. a queue depth. Either set, or read from fn when collected
+class Gauge(Counter):
+    type = TYPE_GAUGE
+
+    def set(self, value):
+        self.value = value
+
+# Latency distribution in fixed buckets, safe to observe from several threads
+class Histogram:
+    type = TYPE_HISTOGRAM
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = [0]*(len(self.buckets) + 1) # the last bucket is +Inf
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += seconds
+
+    def get(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return {"count": running, "sum": total, "mean": total/running if running else 0,
+                "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], cumulative))}
+
+    def samples(self):
+        value = self.get()
+        for bound, count in value["buckets"].items():
+            yield (self.name + "_bucket", dict(self.labels, le=bound), count)
+        yield (self.name + "_sum", self.labels, value["sum"])
+        yield (self.name + "_count", self.labels, value["count"])
+
+# Every metric of a client or server. Collectors add metrics that come and go, such as
+# per-stream values, by returning a list of metrics each time they are called
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, fn=None, labels=None):
+        return self.register(Counter(name, help, fn, labels))
+
+    def gauge(self, name, help, fn=None, labels=None):
+        return self.register(Gauge(name, help, fn, labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=None):
+        return self.register(Histogram(name, help, buckets, labels))
+
+    # collector() returns a list of metrics, made afresh on every collection
+    def addCollector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def collect(self):
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        for collector in collectors:
+            metrics.extend(collector())
+        return metrics
+
+    # name -> value, or name -> {labels: value} for labelled metrics. Histograms give count, sum,
+    # mean and cumulative buckets
+    def snapshot(self):
+        snapshot = {}
+        for metric in self.collect():
+            if metric.labels:
+                snapshot.setdefault(metric.name, {})[formatLabels(metric.labels)] = metric.get()
+            else:
+                snapshot[metric.name] = metric.get()
+        return snapshot
+
+    # Prometheus text exposition format. Metrics sharing a name are written together as one family
+    def exposition(self):
+        families = {}
+        for metric in self.collect():
+            families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name, metrics in families.items():
+            lines.append("# HELP " + name + " " + metrics[0].help)
+            lines.append("# TYPE " + name + " " + metrics[0].type)
+            for metric in metrics:
+                for sampleName, labels, value in metric.samples():
+                    lines.append(sampleName + formatLabels(labels) + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
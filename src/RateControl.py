@@ -0,0 +1,64 @@
+# Constants
+DEFAULT_QUALITY = 50
+MIN_QUALITY = 10
+MAX_QUALITY = 90
+SCALES = (1.0, 0.75, 0.5, 0.25) # downscale steps, tried once quality is at its minimum
+QUALITY_INCREASE = 2 # additive step while the link keeps up
+QUALITY_DECREASE = 0.8 # multiplicative step on congestion
+UPSCALE_QUALITY = 70 # quality at which a downscaled stream tries the next larger size
+UPSCALE_QUALITY_DROP = 25 # quality given up when upscaling, so bytes per frame stay similar
+DELIVERY_TARGET = 0.95 # fraction of sent frames the server must complete
+FPS_TOLERANCE = 0.9
+BANDWIDTH_HEADROOM = 0.9 # only raise quality below this fraction of the bandwidth budget
+MAX_QUEUE_DEPTH = 5 # encoded frames waiting to be sent before the sender counts as behind
+
+# Additive-increase, multiplicative-decrease control of JPEG quality and resolution
+class RateController:
+    def __init__(self, targetFps=None, bandwidthBudget=None, quality=DEFAULT_QUALITY,
+                 minQuality=MIN_QUALITY, maxQuality=MAX_QUALITY, scales=SCALES):
+        self.targetFps = targetFps
+        self.bandwidthBudget = bandwidthBudget # bytes per second, None for unlimited
+        self.quality = quality
+        self.minQuality = minQuality
+        self.maxQuality = maxQuality
+        self.scales = scales
+        self.scaleIndex = 0
+
+    @property
+    def scale(self):
+        return self.scales[self.scaleIndex]
+
+    # Returns the reason the stream is congested, or None if it keeps up
+    def congestion(self, captureRate, sendRate, bytesRate, queueDepth, deliveryRatio):
+        if deliveryRatio is not None and deliveryRatio < DELIVERY_TARGET:
+            return "server completed {:.0%} of frames".format(deliveryRatio)
+        if self.bandwidthBudget is not None and bytesRate > self.bandwidthBudget:
+            return "{:.0f} B/s over budget".format(bytesRate - self.bandwidthBudget)
+        if queueDepth > MAX_QUEUE_DEPTH:
+            return "{} frames queued".format(queueDepth)
+        if self.targetFps is not None and captureRate >= self.targetFps*FPS_TOLERANCE and sendRate < self.targetFps*FPS_TOLERANCE:
+            return "sending {:.1f} of {} FPS".format(sendRate, self.targetFps)
+        return None
+
+    # Feed one interval of measurements. deliveryRatio is None without server feedback.
+    # Returns the congestion reason when quality or scale changed because of it
+    def update(self, captureRate, sendRate, bytesRate, queueDepth, deliveryRatio=None):
+        reason = self.congestion(captureRate, sendRate, bytesRate, queueDepth, deliveryRatio)
+        if reason is not None:
+            if self.quality > self.minQuality:
+                self.quality = max(self.minQuality, int(self.quality*QUALITY_DECREASE))
+            elif self.scaleIndex < len(self.scales) - 1:
+                self.scaleIndex += 1
+            return reason
+
+        # Grow only on evidence, and only while there is bandwidth to spare
+        if sendRate == 0:
+            return None
+        if self.bandwidthBudget is not None and bytesRate > self.bandwidthBudget*BANDWIDTH_HEADROOM:
+            return None
+        if self.scaleIndex > 0 and self.quality >= UPSCALE_QUALITY:
+            self.scaleIndex -= 1
+            self.quality = max(self.minQuality, self.quality - UPSCALE_QUALITY_DROP)
+        elif self.quality < self.maxQuality:
+            self.quality = min(self.maxQuality, self.quality + QUALITY_INCREASE)
+        return None
@@ -0,0 +1,273 @@
+# Records a stream's JPEG frames to disk and plays them back. Frames are appended to segment files
+# with an index of (frame index, timestamp, offset, length) beside each. Replay maps the segments
+# into memory, so any frame can be read or sought by time without loading or decoding the rest
+import glob
+import mmap
+import os
+import threading
+import time
+import Broadcaster as bc
+import LazyImport as lazy
+np = lazy.LazyModule("numpy")
+
+# Constants
+DEFAULT_SEGMENT_SIZE = 64*1024*1024 # bytes of JPEG data before a new segment is started
+SEGMENT_PREFIX = "segment_"
+DATA_EXTENSION = ".mjpeg" # concatenated JPEGs, which MJPEG players can also read directly
+INDEX_EXTENSION = ".idx"
+INDEX_DTYPE = [("frameIndex", ">u8"), ("timestamp", ">f8"), ("offset", ">u8"), ("length", ">u4")]
+FLUSH_INTERVAL = 30 # frames between flushes, an index never points past flushed data
+FOLLOW_INTERVAL = 0.1 # seconds between checks for new frames while following a recording
+
+def segmentPaths(directory, number):
+    base = os.path.join(directory, SEGMENT_PREFIX + "{:06d}".format(number))
+    return (base + DATA_EXTENSION, base + INDEX_EXTENSION)
+
+# Index entries of a segment. The last entry may still be partly written
+def readIndex(indexPath):
+    with open(indexPath, "rb") as indexFile:
+        raw = indexFile.read()
+    return np.frombuffer(raw, INDEX_DTYPE, len(raw)//np.dtype(INDEX_DTYPE).itemsize)
+
+# Numbers of the segments in a directory, in order
+def segmentNumbers(directory):
+    numbers = []
+    for path in glob.glob(os.path.join(directory, SEGMENT_PREFIX + "*" + INDEX_EXTENSION)):
+        name = os.path.basename(path)[len(SEGMENT_PREFIX):-len(INDEX_EXTENSION)]
+        if name.isdigit():
+            numbers.append(int(name))
+    return sorted(numbers)
+
+# Appends frames to the segments of a directory. An existing recording is continued in a new
+# segment. With maxSegments set, the oldest segments are deleted so the recording stays bounded
+class FrameRecorder:
+    def __init__(self, directory, segmentSize=DEFAULT_SEGMENT_SIZE, maxSegments=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxSegments = maxSegments
+        self.lock = threading.Lock()
+        self.broadcaster = None
+        self.dataFile = None
+        self.indexFile = None
+        self.offset = 0
+        self.unflushed = 0
+        self.closed = False
+
+        numbers = segmentNumbers(directory)
+        self.segmentNumber = numbers[-1] if numbers else -1
+        self.frameIndex = 0
+        if numbers:
+            lastIndex = readIndex(segmentPaths(directory, numbers[-1])[1])
+            if len(lastIndex):
+                self.frameIndex = int(lastIndex[-1]["frameIndex"]) + 1
+
+        # Counters
+        self.framesRecorded = 0
+        self.bytesRecorded = 0
+
+    # Record every frame the broadcaster publishes, timestamped on arrival. Being a listener counts as
+    # a subscriber, so the decoders produce JPEG for the recording even while nobody watches
+    def attach(self, broadcaster):
+        self.broadcaster = broadcaster
+        broadcaster.addListener(self.onFramePublished)
+
+    # Runs on the decode thread that published the frame
+    def onFramePublished(self):
+        sequence, part = self.broadcaster.latestFrame()
+        if part is not None:
+            self.append(memoryview(part)[len(bc.PART_HEADER):-2], time.time())
+
+    def append(self, jpeg, timestamp):
+        with self.lock:
+            if self.closed:
+                return # a publish that raced with close
+            if self.dataFile is None or self.offset >= self.segmentSize:
+                self._startSegment()
+            self.dataFile.write(jpeg)
+            record = np.array([(self.frameIndex, timestamp, self.offset, len(jpeg))], INDEX_DTYPE)
+            self.indexFile.write(record.tobytes())
+            self.offset += len(jpeg)
+            self.frameIndex += 1
+            self.framesRecorded += 1
+            self.bytesRecorded += len(jpeg)
+
+            # Data before index, so a reader never finds an index entry without its frame
+            self.unflushed += 1
+            if self.unflushed >= FLUSH_INTERVAL:
+                self._flush()
+
+    def _flush(self):
+        self.dataFile.flush()
+        self.indexFile.flush()
+        self.unflushed = 0
+
+    def _startSegment(self):
+        self._closeSegment()
+        self.segmentNumber += 1
+        dataPath, indexPath = segmentPaths(self.directory, self.segmentNumber)
+        self.dataFile = open(dataPath, "wb")
+        self.indexFile = open(indexPath, "wb")
+        self.offset = 0
+
+        if self.maxSegments is not None:
+            for number in segmentNumbers(self.directory)[:-self.maxSegments]:
+                for path in segmentPaths(self.directory, number):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass # still open by a reader on Windows, removed with a later segment
+
+    def _closeSegment(self):
+        if self.dataFile is not None:
+            self._flush()
+            self.dataFile.close()
+            self.indexFile.close()
+            self.dataFile = None
+            self.indexFile = None
+
+    def close(self):
+        if self.broadcaster is not None:
+            self.broadcaster.removeListener(self.onFramePublished)
+            self.broadcaster = None
+        with self.lock:
+            self.closed = True
+            self._closeSegment()
+
+# One segment of a recording, its data mapped into memory
+class Segment:
+    def __init__(self, directory, number):
+        self.number = number
+        dataPath, indexPath = segmentPaths(directory, number)
+        self.dataSize = os.path.getsize(dataPath)
+        index = readIndex(indexPath)
+        # Ignore entries whose frame is not fully on disk yet
+        self.index = index[index["offset"] + index["length"] <= self.dataSize]
+        self.data = None
+        if self.dataSize > 0:
+            with open(dataPath, "rb") as dataFile:
+                self.data = mmap.mmap(dataFile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.timestamps = self.index["timestamp"].astype(np.float64)
+
+    def jpeg(self, position):
+        record = self.index[position]
+        offset = int(record["offset"])
+        return self.data[offset:offset + int(record["length"])]
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+# Random access to a recording by position or time. Positions count frames from the start of the
+# oldest segment still on disk. refresh() picks up frames recorded since the reader was opened
+class RecordingReader:
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []
+        self.starts = [] # position of each segment's first frame
+        self.length = 0
+        self.refresh()
+
+    def refresh(self):
+        numbers = segmentNumbers(self.directory)
+        kept = {segment.number: segment for segment in self.segments}
+        segments = []
+        for number in numbers:
+            segment = kept.pop(number, None)
+            # Segments still being recorded to grow, reopen them when they did
+            try:
+                if segment is not None and os.path.getsize(segmentPaths(self.directory, number)[0]) != segment.dataSize:
+                    segment.close()
+                    segment = None
+                if segment is None:
+                    segment = Segment(self.directory, number)
+            except FileNotFoundError:
+                if segment is not None:
+                    segment.close()
+                continue # deleted by the recorder meanwhile
+            if len(segment.index):
+                segments.append(segment)
+            else:
+                segment.close()
+        for segment in kept.values():
+            segment.close()
+
+        self.segments = segments
+        self.starts = []
+        self.length = 0
+        for segment in segments:
+            self.starts.append(self.length)
+            self.length += len(segment.index)
+
+    def __len__(self):
+        return self.length
+
+    def _locate(self, position):
+        if not 0 <= position < self.length:
+            raise IndexError("frame position out of range")
+        segmentNumber = int(np.searchsorted(self.starts, position, side="right")) - 1
+        return (self.segments[segmentNumber], position - self.starts[segmentNumber])
+
+    # Returns (frame index, timestamp, JPEG bytes) of the frame at a position
+    def frame(self, position):
+        segment, offset = self._locate(position)
+        record = segment.index[offset]
+        return (int(record["frameIndex"]), float(record["timestamp"]), segment.jpeg(offset))
+
+    def startTime(self):
+        return float(self.segments[0].timestamps[0]) if self.segments else None
+
+    def endTime(self):
+        return float(self.segments[-1].timestamps[-1]) if self.segments else None
+
+    # Position of the first frame at or after timestamp, len(self) if there is none
+    def seek(self, timestamp):
+        for segment, start in zip(self.segments, self.starts):
+            if segment.timestamps[-1] >= timestamp:
+                return start + int(np.searchsorted(segment.timestamps, timestamp, side="left"))
+        return self.length
+
+    # Position of the first frame with a frame index of at least frameIndex
+    def find(self, frameIndex):
+        for segment, start in zip(self.segments, self.starts):
+            if int(segment.index["frameIndex"][-1]) >= frameIndex:
+                return start + int(np.searchsorted(segment.index["frameIndex"], frameIndex, side="left"))
+        return self.length
+
+    # Yield (timestamp, JPEG) from start (seconds since the epoch, or None for the oldest frame) at
+    # the recorded pace times speed. With follow set, waits for new frames at the end of the
+    # recording instead of stopping
+    def play(self, start=None, speed=1.0, follow=False, running=lambda: True):
+        position = 0 if start is None else self.seek(start)
+        clockStart = None
+        nextFrameIndex = None
+        while running():
+            if position >= self.length:
+                if not follow:
+                    return
+                time.sleep(FOLLOW_INTERVAL)
+                self.refresh()
+                if nextFrameIndex is not None:
+                    position = self.find(nextFrameIndex)
+                elif start is not None:
+                    position = self.seek(start)
+                continue
+
+            frameIndex, timestamp, jpeg = self.frame(position)
+            if clockStart is None:
+                clockStart, timeStart = time.monotonic(), timestamp
+            elif speed > 0:
+                sleepTime = clockStart + (timestamp - timeStart)/speed - time.monotonic()
+                if sleepTime > 0:
+                    time.sleep(sleepTime)
+            yield (timestamp, jpeg)
+            position += 1
+            nextFrameIndex = frameIndex + 1
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        self.starts = []
+        self.length = 0
@@ -0,0 +1,232 @@
+# Same-host transport: frames are written into a ring of preallocated slots in shared memory and
+# a small doorbell datagram tells the server a new frame is ready. Nothing passes through the
+# network stack but the doorbell, and raw frames need no encoding at all
+import os
+import socket
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+import TCPPackets as tcp
+
+# Constants
+MAGIC = b'VSSM'
+DEFAULT_SLOTS = 8 # frames the ring holds before the writer waits or overwrites
+SLOT_HEADROOM = 2 # compressed frames vary in size, so their slots start at twice the first frame's size
+POLL_INTERVAL = 0.0005 # seconds between checks while the writer waits for a free slot
+CONTROL_STRUCT = struct.Struct("!4sIIQQ") # magic, number of slots, slot size, write sequence, read sequence
+WRITE_SEQUENCE_OFFSET = 12
+READ_SEQUENCE_OFFSET = 20
+CONTROL_SIZE = 64 # the control block is padded so slots start cache line aligned
+SEQUENCE_STRUCT = struct.Struct("!Q")
+SLOT_HEADER_STRUCT = struct.Struct("!QBHHQI") # sequence, codec, width, height, capture time (us), payload length
+SLOT_HEADER_SIZE = 64
+DOORBELL_STRUCT = struct.Struct("!4sQ") # magic, write sequence, followed by the shared memory name
+MAX_DOORBELL_SIZE = DOORBELL_STRUCT.size + 255
+
+# Variables
+createdNames = set() # segments created by this process, which its resource tracker already owns
+
+# Attach to an existing segment without handing it to this process's resource tracker, which would
+# unlink it when this process exits although the creator still uses it
+def attachSharedMemory(name: str):
+    try:
+        return shared_memory.SharedMemory(name, track=False) # Python 3.13+
+    except TypeError:
+        pass
+    sharedMemory = shared_memory.SharedMemory(name)
+    if name not in createdNames and os.name == "posix":
+        resource_tracker.unregister(sharedMemory._name, "shared_memory")
+    return sharedMemory
+
+# Release a mapping. Views still held by a consumer keep it alive until they are garbage collected
+def closeSharedMemory(sharedMemory):
+    try:
+        sharedMemory.close()
+    except BufferError:
+        pass
+
+# Offset of the header of frame number sequence in a ring
+def slotOffset(numSlots: int, slotSize: int, sequence: int):
+    return CONTROL_SIZE + ((sequence - 1) % numSlots)*(SLOT_HEADER_SIZE + slotSize)
+
+class SHMSlotHeader:
+    def __init__(self, sequence: int, codec: int, width: int, height: int, timestamp: float, length: int):
+        self.sequence = sequence # 0 while the slot is being written
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.timestamp = timestamp # capture time in seconds since the epoch
+        self.length = length
+
+    def decode(buf, offset: int = 0):
+        sequence, codec, width, height, timestamp, length = SLOT_HEADER_STRUCT.unpack_from(buf, offset)
+        return SHMSlotHeader(sequence, codec, width, height, timestamp/1e6, length)
+
+    def encodeInto(self, buf, offset: int = 0):
+        SLOT_HEADER_STRUCT.pack_into(buf, offset, self.sequence, self.codec, self.width, self.height,
+                                     int(self.timestamp*1e6), self.length)
+
+# Announces frames to the reader. Carries the segment name so the reader can attach, or follow the
+# writer to a bigger ring
+class SHMDoorbell:
+    def __init__(self, sequence: int, name: str):
+        self.sequence = sequence
+        self.name = name
+
+    # Returns None for anything that is not a doorbell
+    def decode(msg: bytes):
+        if len(msg) <= DOORBELL_STRUCT.size:
+            return None
+        magic, sequence = DOORBELL_STRUCT.unpack_from(msg)
+        if magic != MAGIC:
+            return None
+        return SHMDoorbell(sequence, bytes(msg[DOORBELL_STRUCT.size:]).decode(errors="replace"))
+
+    def encode(self):
+        return DOORBELL_STRUCT.pack(MAGIC, self.sequence) + self.name.encode()
+
+# Ring of frame slots in a segment this writer creates and owns. Sequence numbers start at 1, frame n
+# lives in slot (n - 1) % numSlots
+class SHMRing:
+    def __init__(self, numSlots: int, slotSize: int):
+        self.numSlots = numSlots
+        self.slotSize = slotSize
+        self.sharedMemory = shared_memory.SharedMemory(create=True, size=CONTROL_SIZE + numSlots*(SLOT_HEADER_SIZE + slotSize))
+        self.name = self.sharedMemory.name
+        createdNames.add(self.name)
+        self.buf = self.sharedMemory.buf
+        CONTROL_STRUCT.pack_into(self.buf, 0, MAGIC, numSlots, slotSize, 0, 0)
+
+    def close(self):
+        self.buf = None
+        closeSharedMemory(self.sharedMemory)
+        try:
+            self.sharedMemory.unlink() # readers that are still attached keep their mapping
+        except FileNotFoundError:
+            pass
+        createdNames.discard(self.name)
+
+# Writes frames into a ring and rings the reader's doorbell. The ring is created on the first
+# frame, sized for it, and replaced by a bigger one if a later frame does not fit
+class SHMFrameWriter:
+    def __init__(self, sock: socket.socket, address, numSlots: int = DEFAULT_SLOTS):
+        self.sock = sock # UDP socket for doorbells
+        self.address = address
+        self.numSlots = numSlots
+        self.ring = None
+        self.sequence = 0
+
+        # Counters
+        self.overwritten = 0 # frames written over before the reader released them
+
+    # Copy a frame's bytes into the next slot. With a timeout, waits up to that many seconds for the
+    # reader to release the slot before overwriting it, without one the oldest frame is overwritten
+    def write(self, payload, codec: int, width: int, height: int, timestamp: float = 0.0, timeout: float = None):
+        payload = memoryview(payload).cast('B')
+        if self.ring is None or len(payload) > self.ring.slotSize:
+            self._resize(len(payload) if codec == tcp.CODEC_RAW else len(payload)*SLOT_HEADROOM)
+        ring = self.ring
+        buf = ring.buf
+        sequence = self.sequence + 1
+
+        readSequence = SEQUENCE_STRUCT.unpack_from(buf, READ_SEQUENCE_OFFSET)[0]
+        if sequence - readSequence > ring.numSlots and timeout is not None:
+            deadline = time.monotonic() + timeout
+            while sequence - readSequence > ring.numSlots and time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                readSequence = SEQUENCE_STRUCT.unpack_from(buf, READ_SEQUENCE_OFFSET)[0]
+        if sequence - readSequence > ring.numSlots:
+            self.overwritten += 1
+
+        # A zero sequence marks the slot as being written, so a reader copying it notices
+        offset = slotOffset(ring.numSlots, ring.slotSize, sequence)
+        SEQUENCE_STRUCT.pack_into(buf, offset, 0)
+        dataOffset = offset + SLOT_HEADER_SIZE
+        buf[dataOffset:dataOffset + len(payload)] = payload
+        SHMSlotHeader(sequence, codec, width, height, timestamp, len(payload)).encodeInto(buf, offset)
+        SEQUENCE_STRUCT.pack_into(buf, WRITE_SEQUENCE_OFFSET, sequence)
+        self.sequence = sequence
+
+        try:
+            self.sock.sendto(SHMDoorbell(sequence, ring.name).encode(), self.address)
+        except OSError:
+            pass # the reader also polls, a lost doorbell only delays the frame
+        return sequence
+
+    def _resize(self, slotSize: int):
+        if self.ring is not None:
+            self.ring.close()
+        self.ring = SHMRing(self.numSlots, slotSize)
+        self.sequence = 0
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+# Reads frames from a writer's ring in sequence order. Frames the writer already overwrote are
+# skipped and counted
+class SHMFrameReader:
+    def __init__(self):
+        self.name = None
+        self.sharedMemory = None
+        self.buf = None
+        self.numSlots = 0
+        self.slotSize = 0
+        self.nextSequence = 1
+
+        # Counters
+        self.overrun = 0 # frames overwritten before they were read
+
+    # Switch to the segment named by a doorbell. Raises FileNotFoundError if it is already gone
+    def attach(self, name: str):
+        self.close()
+        sharedMemory = attachSharedMemory(name)
+        magic, numSlots, slotSize, writeSequence, readSequence = CONTROL_STRUCT.unpack_from(sharedMemory.buf)
+        if magic != MAGIC:
+            closeSharedMemory(sharedMemory)
+            raise ValueError("Not a video stream frame ring: " + name)
+        self.name = name
+        self.sharedMemory = sharedMemory
+        self.buf = sharedMemory.buf
+        self.numSlots = numSlots
+        self.slotSize = slotSize
+        self.nextSequence = readSequence + 1
+
+    # Yield (header, view) for every frame written since the last call. The view is only valid until
+    # release(header), which returns False if the writer overwrote the slot in the meantime
+    def receive(self):
+        if self.buf is None:
+            return
+        writeSequence = SEQUENCE_STRUCT.unpack_from(self.buf, WRITE_SEQUENCE_OFFSET)[0]
+        if writeSequence - self.nextSequence >= self.numSlots:
+            skipTo = writeSequence - self.numSlots + 1
+            self.overrun += skipTo - self.nextSequence
+            self.nextSequence = skipTo
+
+        while self.nextSequence <= writeSequence and self.buf is not None:
+            sequence = self.nextSequence
+            self.nextSequence += 1
+            offset = slotOffset(self.numSlots, self.slotSize, sequence)
+            header = SHMSlotHeader.decode(self.buf, offset)
+            if header.sequence != sequence or header.length > self.slotSize:
+                self.overrun += 1
+                continue
+            dataOffset = offset + SLOT_HEADER_SIZE
+            yield header, self.buf[dataOffset:dataOffset + header.length]
+
+    def release(self, header: SHMSlotHeader):
+        offset = slotOffset(self.numSlots, self.slotSize, header.sequence)
+        if SEQUENCE_STRUCT.unpack_from(self.buf, offset)[0] != header.sequence:
+            self.overrun += 1
+            return False
+        SEQUENCE_STRUCT.pack_into(self.buf, READ_SEQUENCE_OFFSET, header.sequence)
+        return True
+
+    def close(self):
+        if self.sharedMemory is not None:
+            self.buf = None
+            closeSharedMemory(self.sharedMemory)
+            self.sharedMemory = None
+            self.name = None
@@ -0,0 +1,113 @@
+import struct
+
+# Constants
+MAGIC = b'VSTM'
+VERSION = 1
+CODEC_RAW = 0 # uncompressed BGR uint8
+CODEC_JPEG = 1
+CODEC_PNG = 2
+CODEC_DELTA = 3 # changed tiles since the last keyframe, see DeltaCoding.py
+CODECS = (CODEC_RAW, CODEC_JPEG, CODEC_PNG, CODEC_DELTA)
+HEADER_STRUCT = struct.Struct("!4sBBHHQI") # magic, version, codec, width, height, timestamp (us), payload length
+MAX_FRAME_SIZE = 64*1024*1024 # bytes, a raw 4K frame is ~25 MB. Bounds what one header can make the receiver allocate
+
+# Fixed size, network byte order header sent in front of every TCP frame
+class TCPFrameHeader:
+    headerSize = HEADER_STRUCT.size # bytes
+
+    def __init__(self, codec: int, width: int, height: int, timestamp: float, length: int):
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.timestamp = timestamp # capture time in seconds since the epoch
+        self.length = length
+
+    # Decode a header, rejecting anything that is not a frame of a known version and codec
+    def decode(msg: bytes):
+        magic, version, codec, width, height, timestamp, length = HEADER_STRUCT.unpack_from(msg)
+        if magic != MAGIC:
+            raise ValueError("Not a video stream frame header")
+        if version != VERSION:
+            raise ValueError("Unsupported frame header version " + str(version))
+        if codec not in CODECS:
+            raise ValueError("Unsupported frame codec " + str(codec))
+        if length > MAX_FRAME_SIZE:
+            raise ValueError("Frame of " + str(length) + " bytes exceeds " + str(MAX_FRAME_SIZE))
+        return TCPFrameHeader(codec, width, height, timestamp/1e6, length)
+
+    # Encode the header
+    def encode(self):
+        return HEADER_STRUCT.pack(MAGIC, VERSION, self.codec, self.width, self.height, int(self.timestamp*1e6), self.length)
+
+# Receives whole frames into a reusable, grow-only buffer without intermediate copies
+class TCPFrameReceiver:
+    def __init__(self, sock, msgBufferSize: int):
+        self.sock = sock
+        self.msgBufferSize = msgBufferSize # largest read per recv call
+        self.headerBuffer = bytearray(TCPFrameHeader.headerSize)
+        self.headerView = memoryview(self.headerBuffer)
+        self.payloadBuffer = bytearray()
+        self.payloadView = memoryview(self.payloadBuffer)
+
+        # Progress of poll() on a non-blocking socket
+        self.header = None # header of the frame being received
+        self.received = 0 # bytes of the current header or payload read so far
+        self.closed = False
+
+    # Fill a view completely. Returns False if the peer closed the connection
+    def _receiveExactly(self, view):
+        received = 0
+        size = len(view)
+        while received < size:
+            nbytes = self.sock.recv_into(view[received:], min(size - received, self.msgBufferSize))
+            if nbytes == 0:
+                return False
+            received += nbytes
+        return True
+
+    # Receive the next frame. Returns (header, payload view), or None once the peer disconnects.
+    # The payload view is only valid until the next call
+    def receive(self):
+        if not self._receiveExactly(self.headerView):
+            return None
+        header = TCPFrameHeader.decode(self.headerBuffer)
+
+        self._reserve(header.length)
+        payload = self.payloadView[:header.length]
+        if not self._receiveExactly(payload):
+            return None
+        return header, payload
+
+    def _reserve(self, size: int):
+        if len(self.payloadBuffer) < size:
+            self.payloadBuffer = bytearray(size)
+            self.payloadView = memoryview(self.payloadBuffer)
+
+    # Read whatever a non-blocking socket has available. Returns (header, payload view) once a frame
+    # is complete, otherwise None. Sets closed once the peer disconnects
+    def poll(self):
+        while True:
+            if self.header is None:
+                view = self.headerView
+            else:
+                view = self.payloadView[:self.header.length]
+
+            if self.received < len(view):
+                try:
+                    nbytes = self.sock.recv_into(view[self.received:], min(len(view) - self.received, self.msgBufferSize))
+                except (BlockingIOError, InterruptedError):
+                    return None
+                if nbytes == 0:
+                    self.closed = True
+                    return None
+                self.received += nbytes
+                continue
+
+            self.received = 0
+            if self.header is None:
+                self.header = TCPFrameHeader.decode(self.headerBuffer)
+                self._reserve(self.header.length)
+            else:
+                header = self.header
+                self.header = None
+                return header, view
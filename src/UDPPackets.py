@@ -1,66 +1,487 @@
 # Source: https://github.com/jeremyfix/udp_video_streaming
+import collections
+import ipaddress
 import math
+import socket
+import struct
+import sys
+import threading
+import time
+import LazyImport as lazy
+np = lazy.LazyModule("numpy")
 
 # Constants
-MAX_PACKET_SIZE = 200
+MAX_PACKET_SIZE = 200 # smallest packet size, safe on any link
+ETHERNET_PACKET_SIZE = 1400 # fits a 1500 byte Ethernet MTU with IP/UDP headers and tunnelling slack
+MAX_UDP_PACKET_SIZE = 65507 # largest IPv4 UDP payload
+IP_UDP_HEADER_SIZE = 28 # IPv4 + UDP headers
+WSAEMSGSIZE = 10040 # Windows error for a datagram larger than the receive buffer
+IP_MTU = getattr(socket, "IP_MTU", 14 if sys.platform.startswith("linux") else None) # not exported by Python
+DEFAULT_REASSEMBLY_WINDOW = 4 # frames reassembled concurrently
+DEFAULT_REASSEMBLY_TIMEOUT = 0.5 # seconds before an incomplete frame is abandoned
+STREAM_RESTART_DISTANCE = 1000 # a msgIndex this far behind means the sender restarted
+DEFAULT_RECEIVE_BATCH = 64 # datagrams drained per receive call
+HEADER_STRUCT = struct.Struct("!BBBxHIIIIQ") # version, flags, priority, (reserved), stream ID, msgIndex, packetIndex, numPackets, payload length, capture time (us)
+HEADER_VERSION = 2 # version 1 was the bare 24 byte header without version, flags, priority and stream ID
+FLAG_KEYFRAME = 0x01 # the frame decodes on its own, without earlier frames
+DEFAULT_STREAM_ID = 0 # the main video stream of a sender
+DEFAULT_PRIORITY = 0 # 0-255, receivers under load drain higher priorities first
+FEC_TRAILER_STRUCT = struct.Struct("!IIIHH") # frame length, first/end packet of group, stride, offset
+FEEDBACK_STRUCT = struct.Struct("!4sHIIIII") # magic, stream ID, completed, expired, superseded, recovered, last msgIndex
+FEEDBACK_MAGIC = b'VSFB'
+FEEDBACK_INTERVAL = 0.5 # seconds between receiver reports
+DEFAULT_PACING_BURST = 16*1024 # bytes a pacer lets through back to back
+NACK_STRUCT = struct.Struct("!4sHIIH") # magic, stream ID, msgIndex, first missing packet, bitmap length, followed by the bitmap
+NACK_MAGIC = b'VSNK'
+DEFAULT_NACK_DEADLINE = 0.05 # seconds after its first packet a frame may still be repaired, bounds the added latency
+NACK_DELAY = 0.005 # seconds without packets before the newest incomplete frame is NACKed
+NACK_RETRY_INTERVAL = 0.01 # seconds before a frame is NACKed again
+MAX_NACKS = 3 # NACKs per frame
+NACK_INTERVAL = 0.002 # seconds a receiver in NACK mode waits for packets before checking its NACK timers
+DEFAULT_RETRANSMIT_WINDOW = 0.2 # seconds a sender keeps frames for retransmission
+KEYFRAME_REQUEST_STRUCT = struct.Struct("!4sH") # magic, stream ID
+KEYFRAME_REQUEST_MAGIC = b'VSKF'
+KEYFRAME_REQUEST_INTERVAL = 0.1 # seconds before a receiver still waiting for a keyframe asks again
+
+# Query the kernel's path MTU towards a host. Returns None where unsupported
+def pathMTU(host: str, port: int):
+    if IP_MTU is None:
+        return None
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect((host, port)) # no datagram is sent, this only selects a route
+            return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+
+def isLoopback(host: str):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+# Largest safe datagram size (header included) for the link to a host, capped at limit
+def defaultPacketSize(host: str, port: int = 0, limit: int = MAX_UDP_PACKET_SIZE):
+    mtu = pathMTU(host, port)
+    if mtu is not None:
+        packetSize = mtu - IP_UDP_HEADER_SIZE
+    elif isLoopback(host):
+        packetSize = MAX_UDP_PACKET_SIZE
+    else:
+        packetSize = ETHERNET_PACKET_SIZE
+    return max(MAX_PACKET_SIZE, min(packetSize, MAX_UDP_PACKET_SIZE, limit))
+
+# Request socket buffer sizes in bytes, None keeps the system default.
+# Returns the (send, receive) sizes the kernel granted, which may differ
+def setSocketBuffers(sock: socket.socket, sendBufferSize: int = None, receiveBufferSize: int = None):
+    if sendBufferSize is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sendBufferSize)
+    if receiveBufferSize is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBufferSize)
+    return (sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+# Token bucket limiting datagrams to a bitrate. Spreads a frame's packets out instead of
+# bursting them into the receiver's socket buffer and switch queues
+class TokenBucket:
+    def __init__(self, bitrate: float, burst: int = DEFAULT_PACING_BURST):
+        self.rate = bitrate/8 # bytes per second
+        self.burst = burst
+        self.tokens = burst
+        self.lastTime = time.perf_counter()
+        self.waited = 0 # seconds spent waiting for tokens
+
+    # Wait until numBytes may be sent
+    def consume(self, numBytes: int):
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.lastTime)*self.rate)
+        self.lastTime = now
+        self.tokens -= numBytes
+        if self.tokens < 0:
+            # Sleep off the debt, short sleeps overshoot and the refill accounts for that
+            delay = -self.tokens/self.rate
+            self.waited += delay
+            time.sleep(delay)
 
 # UDP Packet object to assist multi-datagrams
 class UDPPacket:
-    headerSize = 16 # bytes
+    headerSize = HEADER_STRUCT.size # bytes
 
-    def __init__(self, msgIndex: int, packetIndex: int, numPackets: int, payload: memoryview):
+    def __init__(self, msgIndex: int, packetIndex: int, numPackets: int, payload: memoryview, timestamp: float = 0.0,
+                 streamId: int = DEFAULT_STREAM_ID, flags: int = 0, priority: int = DEFAULT_PRIORITY):
         self.msgIndex       = msgIndex 
         self.packetIndex    = packetIndex
         self.numPackets     = numPackets
         self.payload = payload
-        self.header = self.msgIndex.to_bytes  (4, 'big')+\
-                      self.packetIndex.to_bytes  (4, 'big')+\
-                      self.numPackets.to_bytes (4, 'big')+\
-                      len(self.payload).to_bytes(4, 'big')
+        self.timestamp = timestamp # capture time of the frame in seconds since the epoch, 0 if unknown
+        self.streamId = streamId # streams of one sender share its socket, msgIndex counts per stream
+        self.flags = flags
+        self.priority = priority
+
+    @property
+    def header(self):
+        return HEADER_STRUCT.pack(HEADER_VERSION, self.flags, self.priority, self.streamId, self.msgIndex, self.packetIndex,
+                                  self.numPackets, len(self.payload), int(self.timestamp*1e6))
     
-    # Decode packet structure from message
+    # Decode packet structure from message. The payload is a view into msg, not a copy.
+    # Returns None for a header version this receiver does not know
     def decode(msg: bytes):
-        msgIndex        = int.from_bytes(msg[:4],    'big')
-        packetIndex     = int.from_bytes(msg[4:8],   'big')
-        numPackets      = int.from_bytes(msg[8:12],   'big')
-        payloadSize     = int.from_bytes(msg[12:16], 'big')
+        version, flags, priority, streamId, msgIndex, packetIndex, numPackets, payloadSize, timestamp = HEADER_STRUCT.unpack_from(msg)
+        if version != HEADER_VERSION:
+            return None
+        headerSize = UDPPacket.headerSize
 
-        packet = UDPPacket(msgIndex, packetIndex, numPackets, msg[16:16 + payloadSize])
+        packet = UDPPacket(msgIndex, packetIndex, numPackets, memoryview(msg)[headerSize:headerSize + payloadSize], timestamp/1e6,
+                           streamId, flags, priority)
         return packet
     
     # Encode a packet
     def encode(self):
         return self.header + self.payload
 
-# UDP Packet Handler
-class UDPPacketHandler:
+# Packet states in FrameAssembly.received
+PACKET_MISSING = 0
+PACKET_RECEIVED = 1
+PACKET_RECOVERED = 2
+
+# XOR parity for groups of data packets. Packet i of a group is covered by parity (i % parityPackets),
+# so each parity packet can rebuild one lost packet of its stride. Yields (first, end, parities) per group
+def fecGroups(payload, chunkSize: int, groupSize: int, parityPackets: int):
+    numPackets = max(1, math.ceil(len(payload)/chunkSize))
+    fullRows = numPackets - 1
+    lastIndex = numPackets - 1
+
+    # Rows are views into the payload, only the short last row is padded with zeros
+    matrix = np.frombuffer(payload, dtype=np.uint8, count=fullRows*chunkSize).reshape(fullRows, chunkSize)
+    lastRow = np.zeros(chunkSize, dtype=np.uint8)
+    tail = np.frombuffer(payload, dtype=np.uint8, offset=fullRows*chunkSize)
+    lastRow[:len(tail)] = tail
+
+    for first in range(0, numPackets, groupSize):
+        end = min(first + groupSize, numPackets)
+        parities = []
+        for offset in range(min(parityPackets, end - first)):
+            parity = np.bitwise_xor.reduce(matrix[first + offset:min(end, fullRows):parityPackets], axis=0)
+            if end == numPackets and (lastIndex - first - offset) % parityPackets == 0:
+                parity = parity ^ lastRow
+            packetIndex = numPackets + (first//groupSize)*parityPackets + offset
+            trailer = FEC_TRAILER_STRUCT.pack(len(payload), first, end, parityPackets, offset)
+            parities.append((packetIndex, parity.tobytes() + trailer))
+        yield first, end, parities
+
+# A partially received frame. Buffers are kept and reused for later frames
+class FrameAssembly:
     def __init__(self):
-        self.currentMsgIndex = None
-        self.packets = []
-        self.numWaitingPackets = None
-    
-    # Reassemble packets into an object
-    def reassemblePackets(self, packet: UDPPacket):
-        if (self.currentMsgIndex is None or packet.msgIndex > self.currentMsgIndex):
-            # First packet, or we drop all packets in favour of recent packets
-            self.currentMsgIndex = packet.msgIndex
-            self.packets = [b'']*packet.numPackets
-            self.numWaitingPackets = packet.numPackets
-        
-        # Drop frame because too old
-        if packet.msgIndex < self.currentMsgIndex:
-            return
+        self.buffer = bytearray() # grow-only payload storage
+        self.received = bytearray() # one state per packet
+        self.parities = {} # packetIndex -> (first, end, stride, offset, xor bytes)
+        self.msgIndex = None
+        self.numPackets = 0
+        self.numWaitingPackets = 0
+        self.chunkSize = None # payload size of every packet but the last
+        self.lastPayload = None # last packet held back until chunkSize is known
+        self.length = 0
+        self.startTime = 0
+        self.timestamp = 0.0
+        self.flags = 0
+        self.lastPacketTime = 0 # NACK mode only
+        self.complete = False # NACK mode only, held until older frames are delivered or given up on
+        self.nacks = 0
+        self.lastNackTime = 0
+
+    def reset(self, msgIndex: int, numPackets: int, startTime: float, timestamp: float = 0.0, flags: int = 0):
+        self.msgIndex = msgIndex
+        self.numPackets = numPackets
+        self.numWaitingPackets = numPackets
+        self.chunkSize = None
+        self.lastPayload = None
+        self.length = 0
+        self.startTime = startTime
+        self.timestamp = timestamp
+        self.flags = flags
+        self.lastPacketTime = startTime
+        self.complete = False
+        self.nacks = 0
+        self.lastNackTime = 0
+        self.parities.clear()
+        if len(self.received) < numPackets:
+            self.received = bytearray(numPackets)
+        else:
+            self.received[:numPackets] = bytes(numPackets)
+
+    def _setChunkSize(self, chunkSize: int):
+        self.chunkSize = chunkSize
+        if len(self.buffer) < self.numPackets*chunkSize:
+            # Replace rather than resize, a returned view may still reference the old buffer
+            self.buffer = bytearray(self.numPackets*chunkSize)
+        if self.lastPayload is not None:
+            lastPayload = self.lastPayload
+            self.lastPayload = None
+            if len(lastPayload) > chunkSize:
+                # Inconsistent with the other packets, wait for it again
+                self.received[self.numPackets - 1] = PACKET_MISSING
+                self.numWaitingPackets += 1
+                return
+            self._write(self.numPackets - 1, lastPayload)
 
-        self.packets[packet.packetIndex] = packet.payload
+    def _write(self, packetIndex: int, payload):
+        offset = packetIndex*self.chunkSize
+        self.buffer[offset:offset + len(payload)] = payload
+        if packetIndex == self.numPackets - 1:
+            # Zero padding keeps parity arithmetic valid for the short last packet
+            self.buffer[offset + len(payload):offset + self.chunkSize] = bytes(self.chunkSize - len(payload))
+            self.length = offset + len(payload)
+
+    # Copy a payload straight to its offset. Returns False for a duplicate
+    def insert(self, packetIndex: int, payload):
+        if self.received[packetIndex] == PACKET_RECOVERED:
+            # The original arrived after being rebuilt from parity
+            self.received[packetIndex] = PACKET_RECEIVED
+            return True
+        if self.received[packetIndex]:
+            return False
+        if self.chunkSize is not None and len(payload) > self.chunkSize:
+            return True # inconsistent with the other packets, ignore it
+        self.received[packetIndex] = PACKET_RECEIVED
         self.numWaitingPackets -= 1
+        lastIndex = self.numPackets - 1
+
+        if self.chunkSize is None:
+            if packetIndex == lastIndex and self.numPackets > 1:
+                # Offset of the last packet depends on the chunk size of the others
+                self.lastPayload = bytes(payload)
+                return True
+            self._setChunkSize(len(payload))
+
+        self._write(packetIndex, payload)
+        return True
+
+    # Keep a parity packet for recovery. Returns False for a duplicate
+    def insertParity(self, packetIndex: int, payload):
+        if packetIndex in self.parities:
+            return False
+        trailerStart = len(payload) - FEC_TRAILER_STRUCT.size
+        length, first, end, stride, offset = FEC_TRAILER_STRUCT.unpack_from(payload, trailerStart)
+        if (first >= end or end > self.numPackets or offset >= stride or length > self.numPackets*trailerStart
+                or (self.chunkSize is not None and trailerStart != self.chunkSize)):
+            return True # inconsistent with the data packets, ignore it
+
+        if self.chunkSize is None:
+            self._setChunkSize(trailerStart)
+
+        self.parities[packetIndex] = (first, end, stride, offset, bytes(payload[:trailerStart]))
+        if not self.received[self.numPackets - 1]:
+            self.length = length
+        return True
+
+    # Rebuild data packets that are the only loss of their parity stride. Returns the number rebuilt
+    def recover(self):
+        recovered = 0
+        matrix = None
+        for first, end, stride, offset, parity in self.parities.values():
+            covered = range(first + offset, end, stride)
+            missing = [i for i in covered if not self.received[i]]
+            if len(missing) != 1:
+                continue
+
+            if matrix is None:
+                matrix = np.frombuffer(self.buffer, dtype=np.uint8, count=self.numPackets*self.chunkSize)
+                matrix = matrix.reshape(self.numPackets, self.chunkSize)
+            lost = missing[0]
+            matrix[lost] = 0
+            matrix[lost] = np.bitwise_xor.reduce(matrix[covered.start:end:stride], axis=0) ^ np.frombuffer(parity, dtype=np.uint8)
+
+            self.received[lost] = PACKET_RECOVERED
+            self.numWaitingPackets -= 1
+            recovered += 1
+        return recovered
+
+    # Indices of the data packets still missing
+    def missingPackets(self):
+        return np.flatnonzero(np.frombuffer(self.received, np.uint8, self.numPackets) == PACKET_MISSING)
+
+    def payload(self):
+        return memoryview(self.buffer)[:self.length]
+
+# UDP Packet Handler
+class UDPPacketHandler:
+    def __init__(self, window: int = DEFAULT_REASSEMBLY_WINDOW, timeout: float = DEFAULT_REASSEMBLY_TIMEOUT,
+                 nackDeadline: float = None, streamId: int = DEFAULT_STREAM_ID):
+        self.streamId = streamId # the stream this handler reassembles, named in its NACKs
+        self.window = window
+        self.timeout = timeout
+        # With a deadline, missing packets are NACKed and a complete frame waits for older frames
+        # that may still be repaired, up to the deadline. None gives up on incomplete frames at once
+        self.nackDeadline = nackDeadline
+        self.inFlight = {} # msgIndex -> FrameAssembly
+        self.freeAssemblies = [FrameAssembly() for iterator in range(window)]
+        self.nextMsgIndex = None # frames below this were delivered or given up on
+        self.lastTimestamp = 0.0 # capture time of the last delivered frame
+        self.lastFlags = 0 # flags of the last delivered frame
+        self.lastAssemblyTime = 0.0 # seconds from the first to the last packet of the last delivered frame
+
+        # Counters
+        self.completed = 0
+        self.expired = 0 # timed out while incomplete
+        self.superseded = 0 # evicted by a newer frame
+        self.duplicates = 0
+        self.stale = 0 # packets of frames already delivered or given up on
+        self.malformed = 0 # packets that do not fit their frame, e.g. strays or another sender reusing a msgIndex
+        self.recovered = 0 # data packets rebuilt from parity
+        self.nacksSent = 0
+        self.repaired = 0 # frames completed after a NACK
+
+    def stats(self):
+        return {
+            "completed": self.completed,
+            "expired": self.expired,
+            "superseded": self.superseded,
+            "duplicates": self.duplicates,
+            "stale": self.stale,
+            "malformed": self.malformed,
+            "recovered": self.recovered,
+            "nacksSent": self.nacksSent,
+            "repaired": self.repaired,
+            "inFlight": len(self.inFlight),
+        }
+
+    def _release(self, msgIndex: int):
+        self.freeAssemblies.append(self.inFlight.pop(msgIndex))
+
+    # Give up on in-flight frames older than the timeout
+    def expireFrames(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        for msgIndex in [m for m, a in self.inFlight.items() if now - a.startTime > self.timeout]:
+            self._release(msgIndex)
+            self.expired += 1
+
+    # Reassemble packets into an object. The returned view is only valid until the next call
+    def reassemblePackets(self, packet: UDPPacket, now: float = None):
+        msgIndex = packet.msgIndex
+
+        # Parity packets are numbered after the data packets, and a frame never has more of them than data packets
+        isParity = packet.packetIndex >= packet.numPackets
+        if (packet.numPackets == 0 or packet.packetIndex >= 2*packet.numPackets
+                or (isParity and len(packet.payload) <= FEC_TRAILER_STRUCT.size)):
+            self.malformed += 1
+            return None
+
+        if self.nextMsgIndex is not None and msgIndex < self.nextMsgIndex:
+            if self.nextMsgIndex - msgIndex < STREAM_RESTART_DISTANCE:
+                # Drop frame because too old
+                self.stale += 1
+                return None
+            # Sender restarted its frame count
+            for oldIndex in list(self.inFlight):
+                self._release(oldIndex)
+            self.nextMsgIndex = None
+
+        if now is None and self.nackDeadline is not None:
+            now = time.monotonic() # NACK timers need the arrival time of every packet
+
+        assembly = self.inFlight.get(msgIndex)
+        if assembly is None:
+            if now is None:
+                now = time.monotonic()
+            self.expireFrames(now)
+
+            # Make room by abandoning the oldest frame
+            if not self.freeAssemblies:
+                self._release(min(self.inFlight))
+                self.superseded += 1
+
+            assembly = self.freeAssemblies.pop()
+            assembly.reset(msgIndex, packet.numPackets, now, packet.timestamp, packet.flags)
+            self.inFlight[msgIndex] = assembly
+        elif assembly.numPackets != packet.numPackets:
+            self.malformed += 1
+            return None
+        elif self.nackDeadline is not None:
+            assembly.lastPacketTime = now
+
+        if isParity:
+            inserted = assembly.insertParity(packet.packetIndex, packet.payload)
+        else:
+            inserted = assembly.insert(packet.packetIndex, packet.payload)
+        if not inserted:
+            self.duplicates += 1
+            return None
+
+        # Try parity once enough packets arrived to possibly cover the losses
+        if 0 < assembly.numWaitingPackets <= len(assembly.parities):
+            self.recovered += assembly.recover()
 
-        # If all packets has been collected, build full message
-        if self.numWaitingPackets == 0:
-            return b''.join(self.packets)
+        # If all packets has been collected, deliver the message
+        if assembly.numWaitingPackets > 0:
+            return None
+        if self.nackDeadline is not None:
+            assembly.complete = True
+            return self.popReadyFrame(now)
+        return self._deliver(assembly, now)
 
-    # Break up an object into a list of packets
-    def breakupPayload(msgIndex: int, payload: bytes, maxPacketSize: int):
+    def _deliver(self, assembly: FrameAssembly, now: float = None):
+        msgIndex = assembly.msgIndex
+
+        # Older frames can no longer be delivered in order
+        for oldIndex in [m for m in self.inFlight if m < msgIndex]:
+            self._release(oldIndex)
+            self.superseded += 1
+
+        self.lastAssemblyTime = (now if now is not None else time.monotonic()) - assembly.startTime
+        self._release(msgIndex)
+        self.nextMsgIndex = msgIndex + 1
+        self.lastTimestamp = assembly.timestamp
+        self.lastFlags = assembly.flags
+        self.completed += 1
+        if assembly.nacks:
+            self.repaired += 1
+        return assembly.payload()
+
+    # NACK mode: the oldest complete frame once no older frame can still be repaired in time, or None.
+    # Call until None after every delivered frame and regularly while idle, as deadlines pass without packets
+    def popReadyFrame(self, now: float = None):
+        complete = [m for m, a in self.inFlight.items() if a.complete]
+        if not complete:
+            return None
+        if now is None:
+            now = time.monotonic()
+        first = min(complete)
+        for msgIndex, assembly in self.inFlight.items():
+            if msgIndex < first and now - assembly.startTime <= self.nackDeadline:
+                return None
+        return self._deliver(self.inFlight[first], now)
+
+    # NACK mode: NACKs that are due. An incomplete frame is NACKed once a newer frame started arriving,
+    # as packets are sent in order, or once the newest frame saw no packet for NACK_DELAY
+    def pendingNacks(self, now: float = None):
+        if self.nackDeadline is None or not self.inFlight:
+            return []
+        if now is None:
+            now = time.monotonic()
+        newest = max(self.inFlight)
+        nacks = []
+        for msgIndex, assembly in self.inFlight.items():
+            if assembly.complete or assembly.nacks >= MAX_NACKS or now - assembly.startTime > self.nackDeadline:
+                continue
+            if msgIndex == newest and now - assembly.lastPacketTime < NACK_DELAY:
+                continue
+            if assembly.nacks and now - assembly.lastNackTime < NACK_RETRY_INTERVAL:
+                continue
+            missing = assembly.missingPackets()
+            if len(missing) == 0:
+                continue
+            assembly.nacks += 1
+            assembly.lastNackTime = now
+            self.nacksSent += 1
+            nacks.append(UDPNack(msgIndex, missing, self.streamId))
+        return nacks
+
+    # Break up an object into a list of packets, followed by parity packets when FEC is enabled
+    def breakupPayload(msgIndex: int, payload: bytes, maxPacketSize: int, fecGroupSize: int = 0, fecParityPackets: int = 0,
+                       timestamp: float = 0.0, streamId: int = DEFAULT_STREAM_ID, flags: int = 0, priority: int = DEFAULT_PRIORITY):
         payloadChunkSize = maxPacketSize - UDPPacket.headerSize
+        if fecParityPackets > 0:
+            payloadChunkSize -= FEC_TRAILER_STRUCT.size # parity packets must fit too
         numPackets = math.ceil(len(payload)/payloadChunkSize)
         packets = []
 
@@ -70,16 +491,265 @@ class UDPPacketHandler:
         for iterator in range(numPackets - 1):
             startByte = iterator*payloadChunkSize
             endByte = (iterator + 1)*payloadChunkSize
-            packets.append(UDPPacket(msgIndex, iterator, numPackets, payloadView[startByte:endByte]))
+            packets.append(UDPPacket(msgIndex, iterator, numPackets, payloadView[startByte:endByte], timestamp, streamId, flags, priority))
         
         # Process last packet
         startByte = (numPackets - 1)*payloadChunkSize
-        packets.append(UDPPacket(msgIndex, numPackets - 1, numPackets, payloadView[startByte:]))
+        packets.append(UDPPacket(msgIndex, numPackets - 1, numPackets, payloadView[startByte:], timestamp, streamId, flags, priority))
+
+        if fecParityPackets > 0:
+            rowSize = payloadChunkSize if numPackets > 1 else len(payload)
+            for first, end, parities in fecGroups(payloadView, rowSize, fecGroupSize, fecParityPackets):
+                for packetIndex, parity in parities:
+                    packets.append(UDPPacket(msgIndex, packetIndex, numPackets, parity, timestamp, streamId, flags, priority))
 
         return packets
 
+# Receiver report sent back to a sender. Counters are cumulative so lost reports do no harm
+class UDPFeedback:
+    def __init__(self, completed: int, expired: int, superseded: int, recovered: int, lastMsgIndex: int,
+                 streamId: int = DEFAULT_STREAM_ID):
+        self.streamId = streamId
+        self.completed = completed
+        self.expired = expired
+        self.superseded = superseded
+        self.recovered = recovered
+        self.lastMsgIndex = lastMsgIndex
+
+    # Report the state of a packet handler
+    def fromHandler(handler, streamId: int = DEFAULT_STREAM_ID):
+        lastMsgIndex = handler.nextMsgIndex - 1 if handler.nextMsgIndex else 0
+        return UDPFeedback(handler.completed, handler.expired, handler.superseded, handler.recovered, lastMsgIndex, streamId)
+
+    # Decode a report. Returns None for anything else
+    def decode(msg: bytes):
+        if len(msg) < FEEDBACK_STRUCT.size:
+            return None
+        magic, streamId, completed, expired, superseded, recovered, lastMsgIndex = FEEDBACK_STRUCT.unpack_from(msg)
+        if magic != FEEDBACK_MAGIC:
+            return None
+        return UDPFeedback(completed, expired, superseded, recovered, lastMsgIndex, streamId)
+
+    def encode(self):
+        return FEEDBACK_STRUCT.pack(FEEDBACK_MAGIC, self.streamId, self.completed, self.expired, self.superseded,
+                                    self.recovered, self.lastMsgIndex)
+
+# Missing data packets of a frame, sent back to the sender as a bitmap
+class UDPNack:
+    def __init__(self, msgIndex: int, missing, streamId: int = DEFAULT_STREAM_ID):
+        self.streamId = streamId
+        self.msgIndex = msgIndex
+        self.missing = missing # packet indices, ascending
+
+    # Decode a NACK. Returns None for anything else
+    def decode(msg: bytes):
+        if len(msg) < NACK_STRUCT.size:
+            return None
+        magic, streamId, msgIndex, first, bitmapSize = NACK_STRUCT.unpack_from(msg)
+        if magic != NACK_MAGIC or len(msg) < NACK_STRUCT.size + bitmapSize:
+            return None
+        bits = np.unpackbits(np.frombuffer(msg, np.uint8, bitmapSize, NACK_STRUCT.size))
+        return UDPNack(msgIndex, first + np.flatnonzero(bits), streamId)
+
+    def encode(self):
+        first = int(self.missing[0])
+        bits = np.zeros(int(self.missing[-1]) - first + 1, np.uint8)
+        bits[np.asarray(self.missing) - first] = 1
+        bitmap = np.packbits(bits).tobytes()
+        return NACK_STRUCT.pack(NACK_MAGIC, self.streamId, self.msgIndex, first, len(bitmap)) + bitmap
+
+# Asks a sender for a keyframe, e.g. after a delta coded frame was lost. Repeated while none arrives
+class UDPKeyframeRequest:
+    def __init__(self, streamId: int = DEFAULT_STREAM_ID):
+        self.streamId = streamId
+
+    # Decode a request. Returns None for anything else
+    def decode(msg: bytes):
+        if len(msg) < KEYFRAME_REQUEST_STRUCT.size:
+            return None
+        magic, streamId = KEYFRAME_REQUEST_STRUCT.unpack_from(msg)
+        if magic != KEYFRAME_REQUEST_MAGIC:
+            return None
+        return UDPKeyframeRequest(streamId)
+
+    def encode(self):
+        return KEYFRAME_REQUEST_STRUCT.pack(KEYFRAME_REQUEST_MAGIC, self.streamId)
+
+# Sends payloads as datagrams without building per-packet objects or copying payload bytes
+class UDPPacketSender:
+    def __init__(self, sock: socket.socket, maxPacketSize: int = MAX_PACKET_SIZE, fecGroupSize: int = 0, fecParityPackets: int = 0,
+                 pacer: TokenBucket = None, retransmitWindow: float = None):
+        self.sock = sock
+        self.maxPacketSize = maxPacketSize
+        self.fecGroupSize = fecGroupSize # data packets per parity group
+        self.fecParityPackets = fecParityPackets # parity packets per group, 0 disables FEC
+        self.headers = bytearray() # grow-only buffer holding every header of a payload
+        self.headerView = memoryview(self.headers)
+        self.useSendmsg = hasattr(sock, "sendmsg") # scatter/gather is unavailable on Windows
+        self.pacer = pacer # None sends every datagram of a payload back to back
+
+        # Payloads kept for retransmission on NACKs, None disables retransmission. Payloads must
+        # not be modified after they were sent
+        self.retransmitWindow = retransmitWindow # seconds
+        self.sentPayloads = collections.OrderedDict() # (stream ID, msgIndex) -> (send time, payload, timestamp, flags, priority)
+        self.lock = threading.Lock() # NACKs are answered from another thread
+        self.retransmitted = 0 # packets sent again
+
+    def _payloadChunkSize(self):
+        payloadChunkSize = self.maxPacketSize - UDPPacket.headerSize
+        if self.fecParityPackets > 0:
+            payloadChunkSize -= FEC_TRAILER_STRUCT.size # parity packets must fit too
+        return payloadChunkSize
+
+    # Send a payload to an address, stamped with its capture time. Several streams can share a sender,
+    # each numbering its own payloads. Returns the number of datagrams sent
+    def send(self, msgIndex: int, payload: bytes, address, timestamp: float = 0.0, streamId: int = DEFAULT_STREAM_ID,
+             flags: int = 0, priority: int = DEFAULT_PRIORITY):
+        headerSize = UDPPacket.headerSize
+        payloadChunkSize = self._payloadChunkSize()
+        useFec = self.fecParityPackets > 0
+        numPackets = max(1, math.ceil(len(payload)/payloadChunkSize))
+        numDatagrams = numPackets
+        if useFec:
+            numDatagrams += math.ceil(numPackets/self.fecGroupSize)*self.fecParityPackets
+
+        if len(self.headers) < numDatagrams*headerSize:
+            self.headers = bytearray(numDatagrams*headerSize)
+            self.headerView = memoryview(self.headers)
+
+        if self.retransmitWindow is not None:
+            now = time.monotonic()
+            with self.lock:
+                self.sentPayloads[(streamId, msgIndex)] = (now, payload, timestamp, flags, priority)
+                while now - next(iter(self.sentPayloads.values()))[0] > self.retransmitWindow:
+                    self.sentPayloads.popitem(last=False)
+
+        payloadView = memoryview(payload)
+        packHeader = HEADER_STRUCT.pack_into
+        timestampUs = int(timestamp*1e6)
+        sock = self.sock
+        pacer = self.pacer
+
+        def sendPacket(packetIndex, chunk):
+            offset = packetIndex*headerSize
+            packHeader(self.headers, offset, HEADER_VERSION, flags, priority, streamId, msgIndex, packetIndex, numPackets, len(chunk), timestampUs)
+            header = self.headerView[offset:offset + headerSize]
+            if pacer is not None:
+                pacer.consume(IP_UDP_HEADER_SIZE + headerSize + len(chunk))
+
+            if self.useSendmsg:
+                sock.sendmsg((header, chunk), (), 0, address)
+            else:
+                sock.sendto(bytes(header) + chunk, address)
+
+        if not useFec:
+            for iterator in range(numPackets):
+                startByte = iterator*payloadChunkSize
+                sendPacket(iterator, payloadView[startByte:startByte + payloadChunkSize])
+            return numDatagrams
+
+        # Send each group's parity right after its data
+        rowSize = payloadChunkSize if numPackets > 1 else len(payload)
+        for first, end, parities in fecGroups(payloadView, rowSize, self.fecGroupSize, self.fecParityPackets):
+            for iterator in range(first, end):
+                startByte = iterator*payloadChunkSize
+                sendPacket(iterator, payloadView[startByte:startByte + payloadChunkSize])
+            for packetIndex, parity in parities:
+                sendPacket(packetIndex, parity)
+
+        return numDatagrams
+
+    # Send the data packets a NACK lists again, while the payload is kept. Returns the number sent.
+    # Retransmissions are few and urgent, so they skip the pacer
+    def resend(self, nack: UDPNack, address):
+        with self.lock:
+            sent = self.sentPayloads.get((nack.streamId, nack.msgIndex))
+        if sent is None:
+            return 0
+        sendTime, payload, timestamp, flags, priority = sent
+        payloadChunkSize = self._payloadChunkSize()
+        numPackets = max(1, math.ceil(len(payload)/payloadChunkSize))
+        payloadView = memoryview(payload)
+
+        numSent = 0
+        for packetIndex in nack.missing:
+            packetIndex = int(packetIndex)
+            if packetIndex >= numPackets:
+                continue
+            chunk = payloadView[packetIndex*payloadChunkSize:(packetIndex + 1)*payloadChunkSize]
+            header = HEADER_STRUCT.pack(HEADER_VERSION, flags, priority, nack.streamId, nack.msgIndex, packetIndex, numPackets,
+                                        len(chunk), int(timestamp*1e6))
+            if self.useSendmsg:
+                self.sock.sendmsg((header, chunk), (), 0, address)
+            else:
+                self.sock.sendto(header + chunk, address)
+            numSent += 1
+        self.retransmitted += numSent
+        return numSent
+
+# Receives datagrams into a reusable buffer, draining up to a batch per call
+class UDPPacketReceiver:
+    def __init__(self, sock: socket.socket, maxPacketSize: int, batchSize: int = DEFAULT_RECEIVE_BATCH):
+        self.sock = sock
+        self.maxPacketSize = maxPacketSize
+        self.useRecvmsg = hasattr(sock, "recvmsg_into")
+
+        # Non-blocking drains need MSG_DONTWAIT, otherwise receive one datagram at a time
+        self.dontWait = getattr(socket, "MSG_DONTWAIT", None)
+        self.batchSize = batchSize if self.dontWait is not None else 1
+
+        self.buffer = bytearray(maxPacketSize*self.batchSize)
+        self.view = memoryview(self.buffer)
+        self.slots = [self.view[i*maxPacketSize:(i + 1)*maxPacketSize] for i in range(self.batchSize)]
+        self.truncated = 0 # datagrams larger than maxPacketSize, dropped
+        self.unknownVersion = 0 # datagrams with a header version this receiver does not know, dropped
+
+    def _receiveInto(self, slot, flags):
+        if self.useRecvmsg:
+            nbytes, ancdata, msgFlags, address = self.sock.recvmsg_into([slot], 0, flags)
+            if msgFlags & getattr(socket, "MSG_TRUNC", 0):
+                self.truncated += 1
+                nbytes = 0
+        else:
+            try:
+                nbytes, address = self.sock.recvfrom_into(slot, 0, flags)
+            except OSError as error:
+                if getattr(error, "winerror", None) != WSAEMSGSIZE:
+                    raise
+                self.truncated += 1
+                nbytes, address = 0, None
+        return nbytes, address
+
+    # Block for one datagram then drain whatever else is already queued.
+    # Returns a list of (packet, address). Packets are only valid until the next call
+    def receive(self):
+        received = []
+        flags = 0
+        # With a timeout set, Python waits out the timeout even for MSG_DONTWAIT, so drain non-blocking
+        timeout = self.sock.gettimeout()
+        draining = False
+        try:
+            for slot in self.slots:
+                try:
+                    nbytes, address = self._receiveInto(slot, flags)
+                except (BlockingIOError, InterruptedError):
+                    break
+                if nbytes >= UDPPacket.headerSize:
+                    packet = UDPPacket.decode(slot[:nbytes])
+                    if packet is not None:
+                        received.append((packet, address))
+                    else:
+                        self.unknownVersion += 1
+                if timeout and not draining and self.batchSize > 1:
+                    self.sock.settimeout(0)
+                    draining = True
+                flags = self.dontWait
+        finally:
+            if draining:
+                self.sock.settimeout(timeout)
+        return received
+
 if __name__ == '__main__':
-    import numpy as np
     import random
     import cv2
 
@@ -1,13 +1,26 @@
-import cv2
-import numpy as np
 import socket
 import sys
-import pickle
-import struct
 import time
 import math
+import selectors
+import select
 import UDPPackets as udp
+import TCPPackets as tcp
+import FrameBuffer as fb
+import WorkerPool as wp
+import Broadcaster as bc
+import RateControl as rc
+import DeltaCoding as dc
+import FrameSources as fs
+import Metrics as mt
+import SHMFrames as shm
+import Recording as rec
+import LazyImport as lazy
+import os
 import threading
+# OpenCV and NumPy load when the first frame needs them, so importing this module binds and starts nothing
+cv2 = lazy.LazyModule("cv2")
+np = lazy.LazyModule("numpy")
 
 # Constants
 DEFAULT_HOST="localhost"
@@ -15,23 +28,119 @@ DEFAULT_PORT=8082
 STREAM_CAMERA = 0
 SOCKET_TYPE_TCP="TCP"
 SOCKET_TYPE_UDP="UDP"
-MAX_NUM_CLIENTS = 1 # only one client
+SOCKET_TYPE_SHM="SHM" # shared memory, client and server on the same host
+MAX_NUM_CLIENTS = 1 # only one client, unless the server runs in multi-client mode
+MAX_PENDING_CLIENTS = 128 # TCP accept backlog in multi-client mode
 DEFAULT_MESSAGE_BUFFER_SIZE = 10000 # Optimal buffer size to store image frames for both UDP and TCP
+DEFAULT_CLIENT_FRAME_CAPACITY = 30 # ~1 second of captured frames at 30 FPS
+DEFAULT_SERVER_FRAME_CAPACITY = 180
+DEFAULT_FEC_GROUP_SIZE = 10 # UDP data packets covered by each group of parity packets
+PNG_COMPRESSION = 1 # fastest zlib level, PNG is chosen for lossless frames rather than size
+DEFAULT_DECODE_WORKERS = wp.DEFAULT_WORKERS
+DEFAULT_ENCODE_WORKERS = wp.DEFAULT_WORKERS
+FRAME_WAIT_TIMEOUT = 1 # seconds to wait for a frame before reporting starvation
+SELECT_TIMEOUT = 1 # seconds the multi-client event loop waits before checking for shutdown
+RESUME_POLL_INTERVAL = 0.002 # seconds between checks for decoder room while a TCP stream is paused
+STREAM_IDLE_TIMEOUT = 10 # seconds without data before a UDP stream is forgotten
+FEEDBACK_TIMEOUT = 2 # seconds without a server report while sending before the client assumes nothing arrives
+READY_POLL_INTERVAL = 0.01 # seconds between checks that a starting thread is still alive
+# JPEG and PNG decode straight to 1/2, 1/4 or 1/8 of the resolution, always as 3 channel BGR. OpenCV flag names
+DECODE_REDUCTIONS = {1: "IMREAD_UNCHANGED", 2: "IMREAD_REDUCED_COLOR_2", 4: "IMREAD_REDUCED_COLOR_4", 8: "IMREAD_REDUCED_COLOR_8"}
 
-# Variables
-clientLock = threading.Lock() # lock for client
-serverLock = threading.Lock() # lock for server
+# A captured frame, encoded and ready to send
+class EncodedFrame():
+    def __init__(self, payload, codec, width, height, captureTime):
+        self.payload = payload
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.captureTime = captureTime # seconds since the epoch
+        self.streamId = udp.DEFAULT_STREAM_ID
+        self.priority = udp.DEFAULT_PRIORITY
+        self.flags = 0 # UDP header flags
+        self.renditions = [] # EncodedFrames of the same capture for the client's other streams
+
+# An extra, downscaled rendition of the video, e.g. a thumbnail. Sent over the client's UDP socket
+# as its own stream, numbered from 1 in the order given
+class Rendition():
+    def __init__(self, scale, priority=udp.DEFAULT_PRIORITY, jpegQuality=None):
+        self.scale = scale # of the captured frame
+        self.priority = priority
+        self.jpegQuality = jpegQuality # None follows the main stream's quality
 
 # Client sending video frames to a server
 class VideoClient():
-    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socketType=SOCKET_TYPE_UDP, videoPath=STREAM_CAMERA):
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socketType=SOCKET_TYPE_UDP, videoPath=STREAM_CAMERA,
+                 frameCapacity=DEFAULT_CLIENT_FRAME_CAPACITY, framePolicy=fb.POLICY_DROP_OLDEST, packetSize=None,
+                 fecGroupSize=DEFAULT_FEC_GROUP_SIZE, fecParityPackets=0, tcpCodec=tcp.CODEC_JPEG,
+                 encodeWorkers=DEFAULT_ENCODE_WORKERS, adaptive=False, targetFps=None, bandwidthBudget=None,
+                 pacingBitrate=None, sendBufferSize=None, deltaCoding=False, keyframeInterval=dc.DEFAULT_KEYFRAME_INTERVAL,
+                 pacing=fs.PACING_REALTIME, loop=False, jpegQuality=rc.DEFAULT_QUALITY, metrics=None,
+                 shmCodec=tcp.CODEC_RAW, shmSlots=shm.DEFAULT_SLOTS, retransmit=False, retransmitWindow=udp.DEFAULT_RETRANSMIT_WINDOW,
+                 live=False, priority=udp.DEFAULT_PRIORITY, renditions=None):
         # Initialisation
         print("[Client]: Initialising Video Client")
         self.socketType = socketType
         self.host = host
         self.port = port
-        self.frames = []
+
+        # UDP datagram size. The server's buffer is unknown here, so assume it uses the default
+        if packetSize is None:
+            packetSize = udp.defaultPacketSize(host, port, DEFAULT_MESSAGE_BUFFER_SIZE)
+        self.packetSize = packetSize
+        self.fecGroupSize = fecGroupSize
+        self.fecParityPackets = fecParityPackets # parity packets per group of fecGroupSize, 0 disables FEC
+        self.pacingBitrate = pacingBitrate # bits per second UDP packets are spread out to, None sends frames in bursts
+        self.retransmit = retransmit # resend UDP packets a server in NACK mode reports missing
+        self.priority = priority # of the main stream, a loaded multi-client server decodes higher priorities first
+        self.renditions = renditions or []
+        if self.renditions and (socketType != SOCKET_TYPE_UDP or deltaCoding):
+            raise ValueError("Renditions need full JPEG frames over UDP")
+        self.tcpCodec = tcpCodec
+        self.shmSlots = shmSlots
+        if socketType == SOCKET_TYPE_TCP:
+            self.codec = tcpCodec
+        elif socketType == SOCKET_TYPE_SHM:
+            self.codec = shmCodec # raw frames skip encoding and decoding altogether
+        else:
+            self.codec = tcp.CODEC_JPEG
+        # Send only the tiles that changed, on either transport
+        self.deltaEncoder = None
+        if deltaCoding or self.codec == tcp.CODEC_DELTA:
+            self.codec = tcp.CODEC_DELTA
+            self.deltaEncoder = dc.DeltaEncoder(keyframeInterval=keyframeInterval)
+        # Live mode sends only the newest frame. Captures the encoders cannot take at once are skipped
+        # rather than queued, and an encoded frame still waiting when the next one is ready is dropped
+        self.live = live
+        if live:
+            frameCapacity, framePolicy = 1, fb.POLICY_DROP_OLDEST
+        self.frames = fb.FrameRingBuffer(frameCapacity, framePolicy) # encoded frames waiting to be sent
         self.running = False
+        self.firstFrame = threading.Event() # set once the source delivers its first frame
+        self.thread = None # streams after start()
+
+        # Capture -> encode -> send pipeline. Encoding fans out to the pool and comes back in capture order
+        self.encodePool = wp.WorkerPool(encodeWorkers, max(1, encodeWorkers) if live else wp.DEFAULT_MAX_PENDING, name="encode")
+        self.encodeQueue = self.encodePool.orderedQueue(self.queueEncodedFrame)
+        self.framesCaptured = 0
+        self.framesEncoded = 0
+        self.framesSent = 0
+        self.bytesSent = 0
+        self.packetsSent = 0 # UDP datagrams, including parity
+        self.throughputTime = time.time()
+        self.throughputCounts = (0, 0, 0)
+
+        # JPEG quality and downscale read by the encoders. With adaptive set they follow the measured
+        # throughput towards targetFps and bandwidthBudget (bytes per second)
+        self.jpegQuality = jpegQuality
+        self.scale = 1.0
+        self.rateController = rc.RateController(targetFps, bandwidthBudget, jpegQuality) if adaptive else None
+        self.feedback = None # newest report from a UDP server
+
+        # Counters are read when collected, only the stage timings cost anything while streaming.
+        # A registry can be shared with a server in the same process
+        self.metrics = metrics if metrics is not None else mt.MetricsRegistry()
+        self.registerMetrics(self.metrics)
 
         if socketType == SOCKET_TYPE_TCP:
             self.clientSocket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
@@ -39,41 +148,46 @@ class VideoClient():
             self.clientSocket.connect((host, port))
         elif socketType == SOCKET_TYPE_UDP:
             self.clientSocket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+            print("[Client]: UDP packet size " + str(packetSize))
+            pacer = udp.TokenBucket(pacingBitrate) if pacingBitrate else None
+            self.sender = udp.UDPPacketSender(self.clientSocket, packetSize, fecGroupSize, fecParityPackets, pacer,
+                                              retransmitWindow if retransmit else None)
+        elif socketType == SOCKET_TYPE_SHM:
+            self.clientSocket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM) # doorbells only
+            print("[Client]: Sharing frames in memory, " + str(shmSlots) + " slots")
+        if sendBufferSize is not None:
+            sendBufferSize, receiveBufferSize = udp.setSocketBuffers(self.clientSocket, sendBufferSize)
+            print("[Client]: Send buffer " + str(sendBufferSize) + " bytes")
 
-        print("[Client]: Starting up camera")
-        self.capture = cv2.VideoCapture(videoPath)
-        time.sleep(2) # Warm up the camera
+        # videoPath is a camera index, a video file, images or a FrameSource. Files and generated
+        # frames play at their frame rate, or as fast as possible with fs.PACING_FAST
+        print("[Client]: Opening frame source")
+        self.capture = fs.openSource(videoPath, pacing, loop)
 
     def streamUDP(self):
         frameIndex = 0
-        t1 = time.time()
-        t0 = t1
-        handler = udp.UDPPacketHandler
-        waitTimer = 1
+        sender = self.sender
+        address = (self.host, self.port)
 
         try:
             while self.running:
-                if len(self.frames) <= 0:
-                    print(["[Client]: Starved of frames!"])
-                    print(["[Client]: Sleep for " + str(waitTimer) + " second"])
-                    time.sleep(waitTimer)
-                    waitTimer += 1
+                result, encodedFrame = self.frames.get(timeout=FRAME_WAIT_TIMEOUT)
+                if not result:
+                    if self.frames.closed:
+                        break # the source ended and every frame was sent
+                    print("[Client]: Starved of frames!")
                     continue
-                else:
-                    with clientLock:
-                        encodedFrame = self.frames.pop(0)
-                    waitTimer = 1
-                packets = handler.breakupPayload(msgIndex=frameIndex, payload=encodedFrame, maxPacketSize=udp.MAX_PACKET_SIZE)
-
-                for packet in packets:
-                    self.clientSocket.sendto(packet.encode(), (self.host, self.port))
+                # Every stream gets each capture, so they share the frame index. Higher priorities go first
+                sendStart = time.perf_counter()
+                numBytes = 0
+                for streamFrame in sorted([encodedFrame] + encodedFrame.renditions, key=lambda f: -f.priority):
+                    numDatagrams = sender.send(frameIndex, streamFrame.payload, address, streamFrame.captureTime,
+                                               streamFrame.streamId, streamFrame.flags, streamFrame.priority)
+                    self.packetsSent += numDatagrams
+                    numBytes += len(streamFrame.payload) + numDatagrams*udp.UDPPacket.headerSize
+                self.sendHistogram.observe(time.perf_counter() - sendStart)
                 frameIndex += 1
-
-                if frameIndex % 30 == 0:
-                    t1 = time.time()
-                    frameRate = str(30/(t1 - t0))
-                    t0 = t1
-                    print("[Client]: Stream FPS: " + frameRate)
+                self.frameSent(numBytes)
         except KeyboardInterrupt:
             self.close()
         finally:
@@ -81,236 +195,1060 @@ class VideoClient():
 
     # Source: https://stackoverflow.com/a/55432139
     def streamTCP(self):
-        frameIndex = 0
-        t1 = time.time()
-        t0 = t1
-        waitTimer = 1
-
         try:
             while self.running:
-                if len(self.frames) <= 0:
-                    print(["[Client]: Starved of frames!"])
-                    print(["[Client]: Sleep for " + str(waitTimer) + " second"])
-                    time.sleep(waitTimer)
-                    waitTimer += 1
+                result, encodedFrame = self.frames.get(timeout=FRAME_WAIT_TIMEOUT)
+                if not result:
+                    if self.frames.closed:
+                        break # the source ended and every frame was sent
+                    print("[Client]: Starved of frames!")
                     continue
-                else:
-                    with clientLock:
-                        frame = self.frames.pop(0)
-                    waitTimer = 1
-
-                # Serialise frame before sending. Not intended for production
-                data = pickle.dumps(frame) 
-                msgSize = struct.pack("L", len(data))
-                self.clientSocket.sendall(msgSize + data)
-                frameIndex += 1
 
-                if frameIndex % 30 == 0:
-                    t1 = time.time()
-                    frameRate = str(30/(t1 - t0))
-                    t0 = t1
-                    print("[Client]: Stream FPS: " + frameRate)
+                header = tcp.TCPFrameHeader(encodedFrame.codec, encodedFrame.width, encodedFrame.height,
+                                            encodedFrame.captureTime, len(encodedFrame.payload))
+                sendStart = time.perf_counter()
+                self.clientSocket.sendall(b''.join((header.encode(), encodedFrame.payload)))
+                self.sendHistogram.observe(time.perf_counter() - sendStart)
+                self.frameSent(tcp.HEADER_STRUCT.size + len(encodedFrame.payload))
         except KeyboardInterrupt:
             self.close()
+        except OSError as error:
+            if self.running: # otherwise stop shut the socket down
+                print("[Client]: Connection lost: " + str(error))
         finally:
             self.close()
 
+    # Frames are copied straight into a shared memory slot. With the blocking frame policy the
+    # client waits for the server to free a slot, otherwise the oldest unread frame is overwritten
+    def streamSHM(self):
+        writer = shm.SHMFrameWriter(self.clientSocket, (self.host, self.port), self.shmSlots)
+        timeout = FRAME_WAIT_TIMEOUT if self.frames.policy == fb.POLICY_BLOCK else None
+
+        try:
+            while self.running:
+                result, encodedFrame = self.frames.get(timeout=FRAME_WAIT_TIMEOUT)
+                if not result:
+                    if self.frames.closed:
+                        break # the source ended and every frame was sent
+                    print("[Client]: Starved of frames!")
+                    continue
+                sendStart = time.perf_counter()
+                writer.write(encodedFrame.payload, encodedFrame.codec, encodedFrame.width, encodedFrame.height,
+                             encodedFrame.captureTime, timeout)
+                self.sendHistogram.observe(time.perf_counter() - sendStart)
+                self.frameSent(len(encodedFrame.payload))
+        except KeyboardInterrupt:
+            self.close()
+        finally:
+            writer.close()
+            self.close()
+
     def run(self):
         self.running = True
-        if self.socketType == SOCKET_TYPE_TCP:
-            # Begin grabbing frames in a different thread
-            grabFrameThread = threading.Thread(target=self.grabFrame)
-            grabFrameThread.setDaemon(True)
-            grabFrameThread.start()
-            time.sleep(2) # Grab some frames before we begin streaming
 
+        # Begin grabbing frames in a different thread
+        grabFrameThread = threading.Thread(target=self.grabFrame)
+        grabFrameThread.daemon = True
+        grabFrameThread.start()
+        if self.rateController is not None:
+            rateControlThread = threading.Thread(target=self.runRateControl)
+            rateControlThread.daemon = True
+            rateControlThread.start()
+        if self.socketType == SOCKET_TYPE_UDP and (self.rateController is not None or self.retransmit or self.deltaEncoder is not None):
+            controlThread = threading.Thread(target=self.runControl)
+            controlThread.daemon = True
+            controlThread.start()
+
+        if self.socketType == SOCKET_TYPE_TCP:
             print("[Client]: Beginning streaming TCP")
             self.streamTCP()
         elif self.socketType == SOCKET_TYPE_UDP:
-            # Begin grabbing frames in a different thread
-            grabFrameThread = threading.Thread(target=self.grabEncodedFrame)
-            grabFrameThread.setDaemon(True)
-            grabFrameThread.start()
-            time.sleep(2) # Grab some frames before we begin streaming
-        
             print("[Client]: Beginning streaming UDP")
             self.streamUDP()
+        elif self.socketType == SOCKET_TYPE_SHM:
+            print("[Client]: Beginning streaming through shared memory")
+            self.streamSHM()
+
+    # Stream on a background thread. Waits up to timeout seconds for the first captured frame and
+    # returns whether it came, False if the source ended or failed first
+    def start(self, timeout=None):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return waitForEvent(self.firstFrame, self.thread, timeout)
+
+    # Stop streaming, waiting up to timeout seconds for the stream thread to finish
+    def stop(self, timeout=None):
+        self.close()
+        # Wake a send blocked on a server that stopped reading
+        try:
+            self.clientSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # not connected, or already closed
+        if self.thread is not None:
+            self.thread.join(timeout)
     
     def close(self):
         print("[Client]: Closing")
         self.running = False
+        # Release an encoder blocked on a full frame buffer first, it holds a worker thread
+        self.frames.close()
+        self.encodeQueue.close()
+        self.encodePool.close()
         self.capture.release()
 
+    # Capture stage. Waits for the encoders when they fall behind instead of queueing raw frames
     def grabFrame(self):
+        framesDropped = 0
         while self.running:
+            captureStart = time.perf_counter()
             ret, frame = self.capture.read()
-            with clientLock:
-                self.frames.append(frame)
+            self.captureHistogram.observe(time.perf_counter() - captureStart)
+            if not ret:
+                # Let the frames in flight reach the send stage, then end the stream
+                print("[Client]: Capture ended")
+                self.encodeQueue.join()
+                self.frames.close()
+                break
+            self.framesCaptured += 1
+            if self.framesCaptured == 1:
+                self.firstFrame.set()
+            if self.deltaEncoder is None:
+                self.encodeQueue.submit(self.encodeCapturedFrame, frame, time.time(), block=not self.live)
+                continue
+
+            # Tiles are chosen here, in capture order, and only JPEG encoding fans out to the pool.
+            # A delta dropped before sending would leave the server's canvas stale, so resync
+            captureTime = time.time()
+            if self.frames.dropped != framesDropped:
+                framesDropped = self.frames.dropped
+                self.deltaEncoder.requestKeyframe()
+            if self.scale != 1.0:
+                frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            if not self.encodeQueue.submit(self.encodeDeltaTiles, self.deltaEncoder.select(frame), captureTime, block=not self.live):
+                self.deltaEncoder.requestKeyframe()
+
+    # Encode stage, runs on the encode pool
+    def encodeCapturedFrame(self, frame, captureTime):
+        encodeStart = time.perf_counter()
+        scale = self.scale
+        if scale != 1.0:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        height, width = frame.shape[:2]
+        payload = self.encodeFrame(frame, self.jpegQuality, self.codec)
+        encodedFrame = EncodedFrame(payload, self.codec, width, height, captureTime)
+        encodedFrame.priority = self.priority
+        encodedFrame.flags = udp.FLAG_KEYFRAME
+        for streamId, rendition in enumerate(self.renditions, 1):
+            small = cv2.resize(frame, None, fx=rendition.scale/scale, fy=rendition.scale/scale, interpolation=cv2.INTER_AREA)
+            smallPayload = self.encodeFrame(small, rendition.jpegQuality or self.jpegQuality, self.codec)
+            encodedRendition = EncodedFrame(smallPayload, self.codec, small.shape[1], small.shape[0], captureTime)
+            encodedRendition.streamId = streamId
+            encodedRendition.priority = rendition.priority
+            encodedRendition.flags = udp.FLAG_KEYFRAME
+            encodedFrame.renditions.append(encodedRendition)
+        self.encodeHistogram.observe(time.perf_counter() - encodeStart)
+        return encodedFrame
+
+    # Encode stage for delta coding, runs on the encode pool
+    def encodeDeltaTiles(self, tiles, captureTime):
+        encodeStart = time.perf_counter()
+        payload = dc.encode(tiles, self.jpegQuality)
+        self.encodeHistogram.observe(time.perf_counter() - encodeStart)
+        encodedFrame = EncodedFrame(payload, tcp.CODEC_DELTA, tiles.width, tiles.height, captureTime)
+        encodedFrame.priority = self.priority
+        encodedFrame.flags = udp.FLAG_KEYFRAME if tiles.keyframe else 0
+        return encodedFrame
+
+    # Called by the encode pool, in capture order
+    def queueEncodedFrame(self, encodedFrame):
+        self.frames.put(encodedFrame)
+        self.framesEncoded += 1
+
+    def registerMetrics(self, metrics):
+        prefix = "videostream_client_"
+        metrics.counter(prefix + "frames_captured_total", "Frames read from the source", lambda: self.framesCaptured)
+        metrics.counter(prefix + "frames_encoded_total", "Frames encoded and queued to send", lambda: self.framesEncoded)
+        metrics.counter(prefix + "frames_sent_total", "Frames sent", lambda: self.framesSent)
+        metrics.counter(prefix + "frames_dropped_total", "Encoded frames dropped before sending",
+                        lambda: self.frames.dropped + self.encodeQueue.dropped)
+        metrics.counter(prefix + "encode_failed_total", "Frames that failed to encode", lambda: self.encodeQueue.failed)
+        metrics.counter(prefix + "packets_sent_total", "UDP datagrams sent, including parity", lambda: self.packetsSent)
+        metrics.counter(prefix + "packets_retransmitted_total", "UDP packets sent again on NACKs",
+                        lambda: self.sender.retransmitted if self.socketType == SOCKET_TYPE_UDP else 0)
+        metrics.counter(prefix + "bytes_sent_total", "Bytes sent, including frame and packet headers", lambda: self.bytesSent)
+        metrics.gauge(prefix + "send_queue_depth", "Encoded frames waiting to be sent", lambda: len(self.frames))
+        metrics.gauge(prefix + "encode_pending", "Frames submitted to the encoders and not yet queued", lambda: self.encodeQueue.pending)
+        metrics.gauge(prefix + "jpeg_quality", "Current JPEG quality", lambda: self.jpegQuality)
+        metrics.gauge(prefix + "scale", "Current downscale factor", lambda: self.scale)
+        self.captureHistogram = metrics.histogram(prefix + "capture_seconds", "Time to read a frame from the source, including pacing")
+        self.encodeHistogram = metrics.histogram(prefix + "encode_seconds", "Time to encode a frame")
+        self.sendHistogram = metrics.histogram(prefix + "send_seconds", "Time to send a frame, including UDP pacing")
+
+    # Send stage bookkeeping. Reports the throughput of every stage so the bottleneck shows
+    def frameSent(self, numBytes):
+        self.framesSent += 1
+        self.bytesSent += numBytes
+        if self.framesSent % 30 != 0:
+            return
+
+        t1 = time.time()
+        elapsed = t1 - self.throughputTime
+        counts = (self.framesCaptured, self.framesEncoded, self.framesSent)
+        captureRate, encodeRate, sendRate = [(now - before)/elapsed for now, before in zip(counts, self.throughputCounts)]
+        self.throughputTime = t1
+        self.throughputCounts = counts
+        print("[Client]: Stream FPS: {:.1f} (capture {:.1f}, encode {:.1f}, {} queued, {} dropped)".format(
+            sendRate, captureRate, encodeRate, len(self.frames), self.frames.dropped + self.encodeQueue.dropped))
+
+    # Adjusts JPEG quality and resolution once per feedback interval, from the client's own counters
+    # and, over UDP, the reports the server sends back to the client's socket
+    def runRateControl(self):
+        lastTime = time.monotonic()
+        lastCounts = (self.framesCaptured, self.framesSent, self.bytesSent)
+        lastReport = None
+        lastReportTime = lastTime
 
-    def grabEncodedFrame(self):
         while self.running:
-            ret, frame = self.capture.read()
-            encodedFrame = self.encodeFrame(frame)
-            with clientLock:
-                self.frames.append(encodedFrame)
+            time.sleep(max(0, lastTime + udp.FEEDBACK_INTERVAL - time.monotonic()))
+            report = self.feedback if self.feedback is not lastReport else None
+
+            now = time.monotonic()
+            elapsed = now - lastTime
+            counts = (self.framesCaptured, self.framesSent, self.bytesSent)
+            captureRate, sendRate, bytesRate = [(c - before)/elapsed for c, before in zip(counts, lastCounts)]
+            lastTime = now
+            lastCounts = counts
+
+            # Share of the frames the server should have finished that it completed. Frames lost
+            # outright show up as gaps in the last completed index
+            deliveryRatio = None
+            if report is not None:
+                if lastReport is not None and report.lastMsgIndex > lastReport.lastMsgIndex and report.completed >= lastReport.completed:
+                    deliveryRatio = min(1.0, (report.completed - lastReport.completed)/(report.lastMsgIndex - lastReport.lastMsgIndex))
+                lastReport = report
+                lastReportTime = now
+            elif lastReport is not None and sendRate > 0 and now - lastReportTime > FEEDBACK_TIMEOUT:
+                deliveryRatio = 0.0
 
-    def encodeFrame(self, frame, jpegQuality=50):
+            controller = self.rateController
+            reason = controller.update(captureRate, sendRate, bytesRate, len(self.frames), deliveryRatio)
+            if (controller.quality, controller.scale) != (self.jpegQuality, self.scale):
+                self.jpegQuality = controller.quality
+                self.scale = controller.scale
+                print("[Client]: JPEG quality {}, scale {}{}".format(self.jpegQuality, self.scale,
+                                                                     " (" + reason + ")" if reason else ""))
+
+    # Reads what a UDP server sends back: reports for the rate controller, NACKs, which are
+    # answered from the sender's cache straight away, and requests for a keyframe
+    def runControl(self):
+        address = (self.host, self.port)
+        while self.running:
+            if not select.select([self.clientSocket], [], [], SELECT_TIMEOUT)[0]:
+                continue
+            try:
+                msg = self.clientSocket.recv(udp.MAX_UDP_PACKET_SIZE)
+            except OSError:
+                continue # e.g. the server is not up yet
+            nack = udp.UDPNack.decode(msg)
+            if nack is not None:
+                if self.retransmit:
+                    self.sender.resend(nack, address)
+                continue
+            request = udp.UDPKeyframeRequest.decode(msg)
+            if request is not None:
+                if self.deltaEncoder is not None and request.streamId == udp.DEFAULT_STREAM_ID:
+                    self.deltaEncoder.requestKeyframe()
+                continue
+            report = udp.UDPFeedback.decode(msg)
+            if report is not None and report.streamId == udp.DEFAULT_STREAM_ID:
+                self.feedback = report # the rate controller follows the main stream
+
+    def encodeFrame(self, frame, jpegQuality=rc.DEFAULT_QUALITY, codec=tcp.CODEC_JPEG):
+        if codec == tcp.CODEC_RAW:
+            return memoryview(np.ascontiguousarray(frame)).cast('B') # the frame's own bytes, no copy
+        elif codec == tcp.CODEC_PNG:
+            result, buf = cv2.imencode('.png', frame, [int(cv2.IMWRITE_PNG_COMPRESSION), PNG_COMPRESSION])
+            return buf.tobytes()
         encodeParams = [int(cv2.IMWRITE_JPEG_QUALITY), jpegQuality]
         result, buf = cv2.imencode('.jpg', frame, encodeParams)
         return buf.tobytes()
 
+def frameChannels(frame):
+    return frame.shape[2] if frame.ndim == 3 else 1
+
+# Viewer JPEG for a frame, or None while nobody watches
+def viewerJpeg(broadcaster, frame):
+    if broadcaster.subscribers == 0:
+        return None
+    result, buf = cv2.imencode('.jpg', frame)
+    return buf.tobytes() if result else None
+
+# Delivery side of delta coding. Tiles decoded on the pool are applied to the stream's canvas
+# in order here. Returns (frame, jpeg, captureTime), frame is None until the first keyframe
+def resolveDelta(decoder, broadcaster, decoded):
+    frame, jpeg, captureTime = decoded
+    if not isinstance(frame, dc.DeltaTiles):
+        return decoded
+    frame = decoder.apply(frame)
+    if frame is None:
+        return (None, None, captureTime)
+    return (frame, viewerJpeg(broadcaster, frame), captureTime)
+
+# Import OpenCV and NumPy ahead of the first frame, so a server waiting for clients pays for them up front
+def preloadModules():
+    return (cv2.imdecode, np.frombuffer)
+
+# Wait until event is set, giving up early if thread exits first. Returns whether the event is set
+def waitForEvent(event, thread, timeout=None):
+    endTime = None if timeout is None else time.monotonic() + timeout
+    while not event.wait(READY_POLL_INTERVAL):
+        if not thread.is_alive() or (endTime is not None and time.monotonic() >= endTime):
+            return event.is_set()
+    return True
+
+# A client's stream within a multi-client server
+class ClientStream():
+    def __init__(self, streamId, frameCapacity, framePolicy, latencyHistogram=None, recorder=None, firstFrame=None):
+        self.streamId = streamId # "host:port" of the client
+        self.frames = fb.FrameRingBuffer(frameCapacity, framePolicy) # (frame, capture time)
+        self.connection = None # TCP only
+        self.receiver = None # TCPFrameReceiver for TCP
+        self.heldFrame = None # TCP only, (header, payload) waiting for room in the decode queue
+        self.paused = False # TCP only, not read from while a frame is held
+        self.UDPHandler = None # UDPPacketHandler for UDP
+        self.decodeQueue = None
+        self.broadcaster = bc.FrameBroadcaster()
+        self.recorder = recorder # FrameRecorder of this stream's JPEG frames, or None
+        if recorder is not None:
+            recorder.attach(self.broadcaster)
+        self.deltaDecoder = dc.DeltaDecoder()
+        self.framesReceived = 0
+        self.latency = wp.LatencyStat() # glass-to-glass, from capture on the client to delivery here
+        self.latencyHistogram = latencyHistogram # the server's, shared by every stream
+        self.lastActive = time.monotonic()
+        self.lastFeedback = 0 # UDP only, when the client was last sent a report
+        self.lastKeyframeRequest = 0 # UDP only, when the client was last asked for a keyframe
+        self.address = None # UDP only, where reports and NACKs go
+        self.firstFrame = firstFrame # the server's event, set once any stream delivers a frame
+
+    def deliverFrame(self, decoded):
+        frame, jpeg, captureTime = resolveDelta(self.deltaDecoder, self.broadcaster, decoded)
+        if frame is None:
+            return
+        self.frames.put((frame, captureTime))
+        if self.firstFrame is not None and not self.firstFrame.is_set():
+            self.firstFrame.set()
+        if jpeg is not None:
+            self.broadcaster.publish(jpeg)
+        self.framesReceived += 1
+        if captureTime:
+            latency = time.time() - captureTime
+            self.latency.add(latency)
+            if self.latencyHistogram is not None:
+                self.latencyHistogram.observe(latency)
+
+    # Per-stream metrics, labelled with the stream's address
+    def metrics(self, prefix):
+        labels = {"stream": self.streamId}
+        metrics = [
+            mt.Counter(prefix + "frames_delivered_total", "Frames decoded and delivered", lambda: self.framesReceived, labels),
+            mt.Counter(prefix + "frames_dropped_total", "Frames dropped before or after decoding",
+                       lambda: self.frames.dropped + self.decodeQueue.dropped, labels),
+            mt.Counter(prefix + "decode_failed_total", "Frames that failed to decode", lambda: self.decodeQueue.failed, labels),
+            mt.Gauge(prefix + "frame_buffer_depth", "Decoded frames waiting to be exported", lambda: len(self.frames), labels),
+            mt.Gauge(prefix + "decode_pending", "Frames submitted to the decoders and not yet delivered", lambda: self.decodeQueue.pending, labels),
+            mt.Gauge(prefix + "stream_priority", "Priority the stream's frames are decoded with", lambda: self.decodeQueue.priority, labels),
+        ]
+        if self.UDPHandler is not None:
+            metrics.extend(udpHandlerMetrics(prefix, self.UDPHandler, labels))
+        if self.recorder is not None:
+            metrics.extend(recorderMetrics(prefix, self.recorder, labels))
+        return metrics
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.frames.close()
+        if self.decodeQueue is not None:
+            self.decodeQueue.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.broadcaster.close()
+
+# Reassembly counters of a UDP stream
+def udpHandlerMetrics(prefix, handler, labels=None):
+    return [
+        mt.Counter(prefix + "frames_completed_total", "UDP frames fully reassembled", lambda: handler.completed, labels),
+        mt.Counter(prefix + "frames_expired_total", "UDP frames given up on after the reassembly timeout", lambda: handler.expired, labels),
+        mt.Counter(prefix + "frames_superseded_total", "UDP frames abandoned for newer frames", lambda: handler.superseded, labels),
+        mt.Counter(prefix + "packets_recovered_total", "UDP data packets rebuilt from parity", lambda: handler.recovered, labels),
+        mt.Counter(prefix + "packets_duplicate_total", "Duplicate UDP packets", lambda: handler.duplicates, labels),
+        mt.Counter(prefix + "nacks_sent_total", "NACKs sent for missing UDP packets", lambda: handler.nacksSent, labels),
+        mt.Counter(prefix + "frames_repaired_total", "UDP frames completed by retransmitted packets", lambda: handler.repaired, labels),
+        mt.Counter(prefix + "packets_stale_total", "UDP packets of frames already delivered or given up on", lambda: handler.stale, labels),
+        mt.Counter(prefix + "packets_malformed_total", "UDP packets that do not fit their frame", lambda: handler.malformed, labels),
+        mt.Gauge(prefix + "frames_in_flight", "UDP frames being reassembled", lambda: len(handler.inFlight), labels),
+    ]
+
+def recorderMetrics(prefix, recorder, labels=None):
+    return [
+        mt.Counter(prefix + "frames_recorded_total", "Frames written to the recording", lambda: recorder.framesRecorded, labels),
+        mt.Counter(prefix + "bytes_recorded_total", "JPEG bytes written to the recording", lambda: recorder.bytesRecorded, labels),
+    ]
+
 class VideoServer():
-    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socketType=SOCKET_TYPE_UDP, msgBufferSize=DEFAULT_MESSAGE_BUFFER_SIZE):
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socketType=SOCKET_TYPE_UDP, msgBufferSize=DEFAULT_MESSAGE_BUFFER_SIZE,
+                 frameCapacity=DEFAULT_SERVER_FRAME_CAPACITY, framePolicy=fb.POLICY_DROP_OLDEST, packetSize=None,
+                 multiClient=False, decodeWorkers=DEFAULT_DECODE_WORKERS, display=True, receiveBufferSize=None, metrics=None,
+                 recordPath=None, recordSegmentSize=rec.DEFAULT_SEGMENT_SIZE, recordMaxSegments=None, nackDeadline=None,
+                 decodeReduction=1, live=False):
         # Initialisation
         print("[Server]: Initialising Video Server")
         self.socketType = socketType
         self.host = host
         self.port = port
         self.msgBufferSize = msgBufferSize
+        # Live mode keeps only the newest decoded frame, so consumers never work through a backlog.
+        # Frames that arrive while every decoder is busy are dropped instead of queued
+        self.live = live
+        if live:
+            frameCapacity, framePolicy = 1, fb.POLICY_DROP_OLDEST
+        self.frameCapacity = frameCapacity
+        self.framePolicy = framePolicy
+        self.multiClient = multiClient
+        self.nackDeadline = nackDeadline # seconds a UDP frame may wait for retransmitted packets, None disables NACKs
+        self.streams = {} # streamId -> ClientStream, multi-client mode only
+        self.display = display # show frames in an OpenCV window
+        self.displayFrames = fb.FrameRingBuffer(1, fb.POLICY_DROP_OLDEST) # display shows the latest frame only
+
+        if multiClient and socketType == SOCKET_TYPE_SHM:
+            raise ValueError("Multi-client mode supports TCP and UDP only")
+
+        # Consumers that want smaller frames get them at a fraction of the decode cost. Delta coded
+        # streams are drawn onto a full resolution canvas and are not reduced
+        if decodeReduction not in DECODE_REDUCTIONS:
+            raise ValueError("decodeReduction must be one of " + str(sorted(DECODE_REDUCTIONS)))
+        self.decodeReduction = decodeReduction
+        self.decodeFlagName = DECODE_REDUCTIONS[decodeReduction] # looked up when decoding, OpenCV is not loaded yet
+
+        # Datagrams larger than the receive buffer would be truncated
+        if packetSize is None:
+            packetSize = udp.defaultPacketSize(host, port, msgBufferSize)
+        elif socketType == SOCKET_TYPE_UDP and packetSize > msgBufferSize:
+            raise ValueError("packetSize " + str(packetSize) + " exceeds msgBufferSize " + str(msgBufferSize))
+        self.packetSize = packetSize
         self.running = False
-        self.frames = []
+        self.ready = threading.Event() # set once the server listens for clients or receives frames
+        self.firstFrame = threading.Event() # set once the first frame is delivered, from any stream
+        self.thread = None # serves after start()
+        self.connection = None # the TCP client, single-client mode only
+        self.frames = fb.FrameRingBuffer(frameCapacity, framePolicy) # (frame, capture time), old frames are dropped to not fill up the buffer
+        self.framesReceived = 0
+        self.framesAssembled = 0 # frames received whole and submitted for decoding, every stream
+        self.packetsReceived = 0 # UDP datagrams, or frames over TCP and shared memory
+        self.bytesReceived = 0
+        self.broadcaster = bc.FrameBroadcaster() # JPEG frames for web viewers
+
+        # Received frames are recorded as JPEG to recordPath, one subdirectory per stream in multi-client mode
+        self.recordPath = recordPath
+        self.recordSegmentSize = recordSegmentSize
+        self.recordMaxSegments = recordMaxSegments
+        self.recorder = None
+        if recordPath is not None and not multiClient:
+            self.recorder = rec.FrameRecorder(recordPath, recordSegmentSize, recordMaxSegments)
+            self.recorder.attach(self.broadcaster)
+        self.deltaDecoder = dc.DeltaDecoder() # canvas of a delta coded stream
+        self.latency = wp.LatencyStat() # glass-to-glass, from capture on the client to delivery here
+        self.exportLatency = wp.LatencyStat() # from capture to a consumer exporting the frame, every stream
+
+        # Receive threads only reassemble, decoding happens on the pool
+        self.decodePool = wp.WorkerPool(decodeWorkers, max(1, decodeWorkers) if live else wp.DEFAULT_MAX_PENDING, name="decode")
+        self.decodeQueue = self.decodePool.orderedQueue(self.deliverFrame)
 
         if socketType == SOCKET_TYPE_TCP:
             self.serverSocket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
         elif socketType == SOCKET_TYPE_UDP:
             self.serverSocket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-            self.UDPHandler = udp.UDPPacketHandler()
+            # Windows reports a departed client's ICMP port unreachable on the next receive
+            if hasattr(socket, "SIO_UDP_CONNRESET"):
+                self.serverSocket.ioctl(socket.SIO_UDP_CONNRESET, False)
+            self.UDPHandler = udp.UDPPacketHandler(nackDeadline=nackDeadline)
+        elif socketType == SOCKET_TYPE_SHM:
+            self.serverSocket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM) # doorbells only
+            if hasattr(socket, "SIO_UDP_CONNRESET"):
+                self.serverSocket.ioctl(socket.SIO_UDP_CONNRESET, False)
+            self.SHMReader = shm.SHMFrameReader()
+        if receiveBufferSize is not None:
+            sendBufferSize, receiveBufferSize = udp.setSocketBuffers(self.serverSocket, receiveBufferSize=receiveBufferSize)
+            print("[Server]: Receive buffer " + str(receiveBufferSize) + " bytes")
         self.serverSocket.bind((host, port))
 
+        # Counters are read when collected, only the stage timings cost anything while streaming.
+        # A registry can be shared with a client in the same process
+        self.metrics = metrics if metrics is not None else mt.MetricsRegistry()
+        self.registerMetrics(self.metrics)
+
+    def registerMetrics(self, metrics):
+        prefix = "videostream_server_"
+        metrics.counter(prefix + "packets_received_total", "UDP datagrams, or frames over TCP and shared memory", lambda: self.packetsReceived)
+        metrics.counter(prefix + "bytes_received_total", "Bytes received, including frame and packet headers", lambda: self.bytesReceived)
+        metrics.counter(prefix + "frames_assembled_total", "Frames received whole and submitted for decoding", lambda: self.framesAssembled)
+        metrics.gauge(prefix + "web_viewers", "Web viewers watching the stream, and the recorder", lambda: self.broadcaster.subscribers)
+        self.reassemblyHistogram = metrics.histogram(prefix + "reassembly_seconds", "Time from the first to the last UDP packet of a frame")
+        self.decodeHistogram = metrics.histogram(prefix + "decode_seconds", "Time to decode a frame")
+        self.displayHistogram = metrics.histogram(prefix + "display_seconds", "Time to show a frame")
+        self.latencyHistogram = metrics.histogram(prefix + "latency_seconds", "Glass-to-glass latency, from capture on the client to delivery")
+        self.exportLatencyHistogram = metrics.histogram(prefix + "export_latency_seconds", "Time from capture on the client to a consumer exporting the frame")
+
+        if self.multiClient:
+            metrics.gauge(prefix + "streams", "Connected client streams", lambda: len(self.streams))
+            metrics.addCollector(lambda: [m for stream in list(self.streams.values()) for m in stream.metrics(prefix)])
+            return
+        metrics.counter(prefix + "frames_delivered_total", "Frames decoded and delivered", lambda: self.framesReceived)
+        metrics.counter(prefix + "frames_dropped_total", "Frames dropped before or after decoding",
+                        lambda: self.frames.dropped + self.decodeQueue.dropped)
+        metrics.counter(prefix + "decode_failed_total", "Frames that failed to decode", lambda: self.decodeQueue.failed)
+        metrics.gauge(prefix + "frame_buffer_depth", "Decoded frames waiting to be exported", lambda: len(self.frames))
+        metrics.gauge(prefix + "decode_pending", "Frames submitted to the decoders and not yet delivered", lambda: self.decodeQueue.pending)
+        if self.recorder is not None:
+            for metric in recorderMetrics(prefix, self.recorder):
+                metrics.register(metric)
+        if self.socketType == SOCKET_TYPE_UDP:
+            for metric in udpHandlerMetrics(prefix, self.UDPHandler):
+                metrics.register(metric)
+        elif self.socketType == SOCKET_TYPE_SHM:
+            metrics.counter(prefix + "frames_overrun_total", "Shared memory frames overwritten before they were read",
+                            lambda: self.SHMReader.overrun)
+
     # Source: https://stackoverflow.com/a/55432139
     def runTCP(self):
         self.serverSocket.listen(MAX_NUM_CLIENTS)
         print("[Server]: Video socket ready to listen")
+        self.ready.set()
 
         connection, address = self.serverSocket.accept()
         print("[Server]: Accepted a client!")
-        data = b''
-        payloadSize = struct.calcsize("L")
-
-        frameIndex = 0
-        t1 = time.time()
-        t0 = t1
+        self.connection = connection
+        receiver = tcp.TCPFrameReceiver(connection, self.msgBufferSize)
 
         while self.running:
-            while len(data) < payloadSize:
-                data += connection.recv(self.msgBufferSize)
-            packedMsgSize = data[:payloadSize]
-            data = data[payloadSize:]
-            msgSize = struct.unpack("L", packedMsgSize)[0]
-
-            # Retrieve data based on message size
-            while len(data) < msgSize:
-                data += connection.recv(self.msgBufferSize)
-            frameData = data[:msgSize]
-            data = data[msgSize:]
-            frame = pickle.loads(frameData)
-
-            with serverLock:
-                self.frames.append(frame)
-                # Drop old frames to not fill up the buffer
-                if len(self.frames) > 180:
-                    self.frames.pop(0)
-            
-            cv2.imshow('frame', frame)
-            cv2.waitKey(1)
-            frameIndex += 1
-
-            if frameIndex % 30 == 0:
-                t1 = time.time()
-                frameRate = str(30/(t1 - t0))
-                t0 = t1
-                print("[Server]: Stream FPS: " + frameRate)
+            try:
+                received = receiver.receive()
+            except (ValueError, OSError) as error:
+                # A malformed frame, or the client reset the connection
+                if self.running:
+                    print("[Server]: Dropping client: " + str(error))
+                connection.close()
+                return
+            if received is None:
+                print("[Server]: Client disconnected")
+                return
+
+            # Copy out of the receive buffer, it is reused for the next frame. TCP is reliable, so wait
+            # for the decoders rather than drop, and let flow control slow the client down
+            header, frameData = received
+            self.frameAssembled(tcp.HEADER_STRUCT.size + len(frameData))
+            # A dropped delta could not be resent without a way back to the client, so those always wait
+            self.decodeQueue.submit(self.decodeReceivedFrame, self.broadcaster, bytearray(frameData), header.codec, header.width, header.height,
+                                    header.timestamp, block=not self.live or header.codec == tcp.CODEC_DELTA)
 
     def runUDP(self):
-        serverSock = self.serverSocket
+        receiver = udp.UDPPacketReceiver(self.serverSocket, self.msgBufferSize)
 
-        data = b''
-        frameIndex = 0
-        t1 = time.time()
-        t0 = 0
+        truncationReported = False
+        lastFeedback = 0
+        lastKeyframeRequest = 0
+        clientAddress = None
+        ignoredStreams = set()
 
+        # NACK timers run out while no packets arrive, so do not block for long
+        if self.nackDeadline is not None:
+            self.serverSocket.settimeout(udp.NACK_INTERVAL)
+
+        self.ready.set()
         while self.running:
-            # Grab as much data from buffer
-            data += serverSock.recv(self.msgBufferSize)
-            packet = udp.UDPPacket.decode(data)
-            packetSize = packet.headerSize + len(packet.payload)
-            data = data[packetSize:]
-
-            # Display frame when fully reassembled
-            frameBytes = self.UDPHandler.reassemblePackets(packet)
-
-            if frameBytes != None:
-                frame = self.decodeFrame(frameBytes)
-                with serverLock:
-                    self.frames.append(frame)
-                    # Drop old frames to not fill up the buffer
-                    if len(self.frames) > 180:
-                        self.frames.pop(0)
-                
-                cv2.imshow('frame',frame)
-                cv2.waitKey(1)
-                frameIndex += 1
+            # Drain a batch of datagrams into the reusable receive buffer
+            address = None
+            try:
+                batch = receiver.receive()
+            except socket.timeout:
+                batch = []
+            for packet, address in batch:
+                self.packetsReceived += 1
+                self.bytesReceived += udp.UDPPacket.headerSize + len(packet.payload)
+                if packet.streamId != self.UDPHandler.streamId:
+                    if packet.streamId not in ignoredStreams:
+                        ignoredStreams.add(packet.streamId)
+                        print("[Server]: Ignoring stream " + str(packet.streamId) + ", receive several streams with multiClient=True")
+                    continue
 
-                if frameIndex % 30 == 0:
-                    t1 = time.time()
-                    frameRate = str(30/(t1 - t0))
-                    t0 = t1
-                    print("[Server]: Stream FPS: " + frameRate)
+                # Decode frame when fully reassembled
+                frameBytes = self.UDPHandler.reassemblePackets(packet)
+                self.submitUDPFrames(self.UDPHandler, frameBytes, self.decodeQueue, self.broadcaster)
+            if address is not None:
+                clientAddress = address
+            if self.nackDeadline is not None and clientAddress is not None:
+                self.serviceNacks(self.UDPHandler, clientAddress, self.decodeQueue, self.broadcaster)
+
+            # Report back to the sender so an adaptive client can adjust its bitrate
+            now = time.monotonic()
+            if address is not None and now - lastFeedback >= udp.FEEDBACK_INTERVAL:
+                lastFeedback = now
+                self.sendFeedback(self.UDPHandler, address)
+            if (clientAddress is not None and self.deltaDecoder.waitingForKeyframe
+                    and now - lastKeyframeRequest >= udp.KEYFRAME_REQUEST_INTERVAL):
+                lastKeyframeRequest = now
+                self.requestKeyframe(self.UDPHandler, clientAddress)
+
+            if receiver.truncated and not truncationReported:
+                print("[Server]: Dropping datagrams larger than " + str(self.msgBufferSize) + " bytes, lower the client packet size")
+                truncationReported = True
     
+    # Frames arrive in shared memory, datagrams on the socket only announce them
+    def runSHM(self):
+        reader = self.SHMReader
+        self.serverSocket.settimeout(SELECT_TIMEOUT)
+        print("[Server]: Waiting for frames in shared memory")
+        self.ready.set()
+
+        try:
+            while self.running:
+                try:
+                    msg = self.serverSocket.recv(shm.MAX_DOORBELL_SIZE)
+                except socket.timeout:
+                    msg = None # look for frames anyway, a doorbell may have been lost
+                doorbell = shm.SHMDoorbell.decode(msg) if msg else None
+
+                # Attach to the client's ring, or follow it to a bigger one after the old one is read
+                if doorbell is not None and doorbell.name != reader.name:
+                    self.receiveSHMFrames(reader)
+                    try:
+                        reader.attach(doorbell.name)
+                    except (FileNotFoundError, ValueError) as error:
+                        print("[Server]: Cannot attach to shared memory " + doorbell.name + ": " + str(error))
+                        continue
+                    print("[Server]: Attached to shared memory " + doorbell.name)
+                self.receiveSHMFrames(reader)
+        finally:
+            reader.close()
+
+    def receiveSHMFrames(self, reader):
+        for header, view in reader.receive():
+            # Copy out of the slot, the client reuses it once released
+            payload = bytearray(view)
+            if not reader.release(header):
+                continue # overwritten while copying
+            self.frameAssembled(len(payload))
+            self.decodeQueue.submit(self.decodeReceivedFrame, self.broadcaster, payload, header.codec, header.width, header.height,
+                                    header.timestamp)
+
+    # Serve many clients from a single thread. Each client gets its own stream with its own
+    # reassembler and frame buffer, keyed by its address
+    def runMultiClient(self):
+        selector = selectors.DefaultSelector()
+        self.serverSocket.setblocking(False)
+        if self.socketType == SOCKET_TYPE_TCP:
+            self.serverSocket.listen(MAX_PENDING_CLIENTS)
+        else:
+            receiver = udp.UDPPacketReceiver(self.serverSocket, self.msgBufferSize)
+        selector.register(self.serverSocket, selectors.EVENT_READ)
+        print("[Server]: Ready for multiple clients")
+        self.ready.set()
+
+        # NACK timers run out while no packets arrive, so do not wait for long
+        nack = self.socketType == SOCKET_TYPE_UDP and self.nackDeadline is not None
+        selectTimeout = udp.NACK_INTERVAL if nack else SELECT_TIMEOUT
+
+        lastIdleCheck = time.monotonic()
+        try:
+            while self.running:
+                # Paused TCP streams resume as soon as their decoders have room
+                paused = [stream for stream in self.streams.values() if stream.paused]
+                for key, events in selector.select(timeout=RESUME_POLL_INTERVAL if paused else selectTimeout):
+                    if key.fileobj is not self.serverSocket:
+                        self.receiveTCPStream(selector, key.data)
+                    elif self.socketType == SOCKET_TYPE_TCP:
+                        self.acceptClient(selector)
+                    else:
+                        self.receiveUDPStreams(receiver)
+                for stream in paused:
+                    if stream.streamId in self.streams:
+                        self.submitHeldFrame(selector, stream)
+                if nack:
+                    for stream in list(self.streams.values()):
+                        self.serviceNacks(stream.UDPHandler, stream.address, stream.decodeQueue, stream.broadcaster)
+
+                now = time.monotonic()
+                if self.socketType == SOCKET_TYPE_UDP and now - lastIdleCheck > SELECT_TIMEOUT:
+                    lastIdleCheck = now
+                    for streamId in [i for i, stream in self.streams.items() if now - stream.lastActive > STREAM_IDLE_TIMEOUT]:
+                        print("[Server]: Stream " + streamId + " went idle")
+                        self.streams.pop(streamId).close()
+        finally:
+            for stream in list(self.streams.values()):
+                stream.close()
+            selector.close()
+
+    def acceptClient(self, selector):
+        try:
+            connection, address = self.serverSocket.accept()
+        except OSError:
+            return # nothing to accept, or stop shut the socket down
+        connection.setblocking(False)
+        streamId = address[0] + ":" + str(address[1])
+        stream = ClientStream(streamId, self.frameCapacity, self.framePolicy, self.latencyHistogram, self.streamRecorder(streamId),
+                              self.firstFrame)
+        stream.connection = connection
+        stream.receiver = tcp.TCPFrameReceiver(connection, self.msgBufferSize)
+        stream.decodeQueue = self.decodePool.orderedQueue(stream.deliverFrame)
+        self.streams[stream.streamId] = stream
+        selector.register(connection, selectors.EVENT_READ, stream)
+        print("[Server]: Accepted client " + stream.streamId)
+
+    # Recorder of a new stream in multi-client mode, or None when not recording
+    def streamRecorder(self, streamId):
+        if self.recordPath is None:
+            return None
+        directory = os.path.join(self.recordPath, streamId.replace(":", "_").replace("/", "_"))
+        return rec.FrameRecorder(directory, self.recordSegmentSize, self.recordMaxSegments)
+
+    def dropClient(self, selector, stream, reason):
+        print("[Server]: Dropping client " + stream.streamId + ": " + reason)
+        if not stream.paused:
+            selector.unregister(stream.connection)
+        stream.close()
+        self.streams.pop(stream.streamId, None)
+
+    def receiveTCPStream(self, selector, stream):
+        try:
+            received = stream.receiver.poll()
+        except (ValueError, OSError) as error:
+            # A malformed frame, or the client reset the connection. Only this stream goes
+            self.dropClient(selector, stream, str(error))
+            return
+        if stream.receiver.closed:
+            self.dropClient(selector, stream, "disconnected")
+            return
+        if received is None:
+            return
+
+        # Copy out of the receive buffer, it is reused for the next frame
+        header, frameData = received
+        self.frameAssembled(tcp.HEADER_STRUCT.size + len(frameData))
+        stream.heldFrame = (header, bytearray(frameData))
+        self.submitHeldFrame(selector, stream)
+
+    # Like runTCP, frames wait for the decoders rather than drop, except in live mode. Rather than block the
+    # event loop, a stream whose decoders are full stops being read, so flow control slows down only that client.
+    # Delta coded frames always wait, a dropped delta could not be resent
+    def submitHeldFrame(self, selector, stream):
+        header, frameData = stream.heldFrame
+        if (not self.live or header.codec == tcp.CODEC_DELTA) and stream.decodeQueue.full():
+            if not stream.paused:
+                selector.unregister(stream.connection)
+                stream.paused = True
+            return
+        stream.heldFrame = None
+        stream.decodeQueue.submit(self.decodeReceivedFrame, stream.broadcaster, frameData, header.codec, header.width, header.height,
+                                  header.timestamp)
+        if stream.paused:
+            selector.register(stream.connection, selectors.EVENT_READ, stream)
+            stream.paused = False
+
+    def receiveUDPStreams(self, receiver):
+        now = time.monotonic()
+        # Reassemble higher priorities first, so their frames also reach the decoders first
+        batch = receiver.receive()
+        batch.sort(key=lambda item: -item[0].priority)
+        for packet, address in batch:
+            self.packetsReceived += 1
+            self.bytesReceived += udp.UDPPacket.headerSize + len(packet.payload)
+
+            # Senders are told apart by source address, and their streams by stream ID
+            streamId = address[0] + ":" + str(address[1])
+            if packet.streamId != udp.DEFAULT_STREAM_ID:
+                streamId += "/" + str(packet.streamId)
+            stream = self.streams.get(streamId)
+            if stream is None:
+                stream = ClientStream(streamId, self.frameCapacity, self.framePolicy, self.latencyHistogram, self.streamRecorder(streamId),
+                                      self.firstFrame)
+                stream.UDPHandler = udp.UDPPacketHandler(nackDeadline=self.nackDeadline, streamId=packet.streamId)
+                stream.address = address
+                stream.decodeQueue = self.decodePool.orderedQueue(stream.deliverFrame, packet.priority)
+                self.streams[streamId] = stream
+                print("[Server]: New stream " + streamId + ", priority " + str(packet.priority))
+            stream.lastActive = now
+            stream.decodeQueue.priority = packet.priority
+
+            frameBytes = stream.UDPHandler.reassemblePackets(packet)
+            self.submitUDPFrames(stream.UDPHandler, frameBytes, stream.decodeQueue, stream.broadcaster)
+
+            if now - stream.lastFeedback >= udp.FEEDBACK_INTERVAL:
+                stream.lastFeedback = now
+                self.sendFeedback(stream.UDPHandler, address)
+            if stream.deltaDecoder.waitingForKeyframe and now - stream.lastKeyframeRequest >= udp.KEYFRAME_REQUEST_INTERVAL:
+                stream.lastKeyframeRequest = now
+                self.requestKeyframe(stream.UDPHandler, address)
+
+    # Submit a reassembled UDP frame for decoding, and in NACK mode the held frames it released
+    def submitUDPFrames(self, handler, frameBytes, decodeQueue, broadcaster):
+        while frameBytes is not None:
+            self.framesAssembled += 1
+            self.reassemblyHistogram.observe(handler.lastAssemblyTime)
+            decodeQueue.submit(self.decodeReceivedFrame, broadcaster, bytearray(frameBytes), tcp.CODEC_JPEG, 0, 0,
+                               handler.lastTimestamp)
+            frameBytes = handler.popReadyFrame() if handler.nackDeadline is not None else None
+
+    # NACK mode: ask the sender for the packets that are overdue, and deliver held frames whose
+    # older frames ran out of time
+    def serviceNacks(self, handler, address, decodeQueue, broadcaster):
+        for nack in handler.pendingNacks():
+            try:
+                self.serverSocket.sendto(nack.encode(), address)
+            except OSError:
+                pass # the frame is given up on at its deadline
+        self.submitUDPFrames(handler, handler.popReadyFrame(), decodeQueue, broadcaster)
+
+    # A frame arrived whole over TCP or shared memory. Neither has packets, so each frame counts as one
+    def frameAssembled(self, numBytes):
+        self.packetsReceived += 1
+        self.bytesReceived += numBytes
+        self.framesAssembled += 1
+
+    # Send a UDP sender the reassembly counters of its stream
+    def sendFeedback(self, handler, address):
+        try:
+            self.serverSocket.sendto(udp.UDPFeedback.fromHandler(handler, handler.streamId).encode(), address)
+        except OSError:
+            pass # a report is only advice, the next one follows shortly
+
+    # Ask a UDP sender for a keyframe, a delta coded stream lost a frame
+    def requestKeyframe(self, handler, address):
+        try:
+            self.serverSocket.sendto(udp.UDPKeyframeRequest(handler.streamId).encode(), address)
+        except OSError:
+            pass # asked again while the stream still waits
+
+    # Runs on the decode pool. Returns (frame, JPEG for the broadcaster or None, captureTime).
+    # Delta coded payloads return their decoded tiles instead of a frame, see resolveDelta
+    def decodeReceivedFrame(self, broadcaster, payload, codec=tcp.CODEC_JPEG, width=0, height=0, captureTime=0.0):
+        decodeStart = time.perf_counter()
+        # UDP carries no codec, delta payloads identify themselves
+        if codec == tcp.CODEC_DELTA or (codec == tcp.CODEC_JPEG and dc.isDeltaPayload(payload)):
+            tiles = dc.decode(payload)
+            self.decodeHistogram.observe(time.perf_counter() - decodeStart)
+            return (tiles, None, captureTime) if tiles is not None else None
+
+        frame = self.decodeFrame(payload, codec, width, height)
+        self.decodeHistogram.observe(time.perf_counter() - decodeStart)
+        if frame is None:
+            return None
+
+        # Web viewers get the received JPEG as is, other codecs are encoded once for all viewers
+        if codec == tcp.CODEC_JPEG:
+            return (frame, payload if broadcaster.subscribers > 0 else None, captureTime)
+        return (frame, viewerJpeg(broadcaster, frame), captureTime)
+
+    # Called by the decode pool, in order, for every decoded frame
+    def deliverFrame(self, decoded):
+        frame, jpeg, captureTime = resolveDelta(self.deltaDecoder, self.broadcaster, decoded)
+        if frame is None:
+            return
+        self.frames.put((frame, captureTime))
+        if not self.firstFrame.is_set():
+            self.firstFrame.set()
+        if jpeg is not None:
+            self.broadcaster.publish(jpeg)
+        if self.display:
+            self.displayFrames.put(frame)
+        self.framesReceived += 1
+        if captureTime:
+            latency = time.time() - captureTime
+            self.latency.add(latency)
+            self.latencyHistogram.observe(latency)
+
+        if self.framesReceived % 30 == 0:
+            t1 = time.time()
+            frameRate = str(30/(t1 - self.fpsTime))
+            self.fpsTime = t1
+            print("[Server]: Stream FPS: " + frameRate + " (" + str(self.frames.dropped + self.decodeQueue.dropped) + " dropped)")
+
+    # Show frames away from the receive thread. Only the latest frame is shown if display falls behind
+    def runDisplay(self):
+        while self.running:
+            result, frame = self.displayFrames.get(timeout=FRAME_WAIT_TIMEOUT)
+            if result:
+                displayStart = time.perf_counter()
+                cv2.imshow('frame', frame)
+                cv2.waitKey(1)
+                self.displayHistogram.observe(time.perf_counter() - displayStart)
+
     def run(self):
         try:
             self.running = True
-            if self.socketType == SOCKET_TYPE_TCP:
+            self.fpsTime = time.time()
+            if self.display and not self.multiClient:
+                displayThread = threading.Thread(target=self.runDisplay)
+                displayThread.daemon = True
+                displayThread.start()
+            preloadThread = threading.Thread(target=preloadModules)
+            preloadThread.daemon = True
+            preloadThread.start()
+
+            if self.multiClient:
+                print("[Server]: Running multi-client " + self.socketType + " server")
+                self.runMultiClient()
+            elif self.socketType == SOCKET_TYPE_TCP:
                 print("[Server]: Running TCP server")
                 self.runTCP()
             elif self.socketType == SOCKET_TYPE_UDP:
                 print("[Server]: Running UDP server")
                 self.runUDP()
+            elif self.socketType == SOCKET_TYPE_SHM:
+                print("[Server]: Running shared memory server")
+                self.runSHM()
         except KeyboardInterrupt:
             self.close()
         finally:
             self.close()
+
+    # Serve on a background thread. Waits up to timeout seconds until clients can connect or send,
+    # and returns whether the server got there, False if it failed first
+    def start(self, timeout=None):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return waitForEvent(self.ready, self.thread, timeout)
+
+    # Stop serving, waiting up to timeout seconds for the serving thread to finish
+    def stop(self, timeout=None):
+        self.running = False
+        # Wake the thread blocked in accept or receive: shut TCP sockets down, send datagram sockets an empty datagram
+        for sock in (self.serverSocket, self.connection):
+            try:
+                if sock is None:
+                    continue
+                if sock.type == socket.SOCK_STREAM:
+                    sock.shutdown(socket.SHUT_RDWR)
+                else:
+                    host, port = sock.getsockname()[:2]
+                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as wake:
+                        wake.sendto(b'', ("127.0.0.1" if host == "0.0.0.0" else host, port))
+            except OSError:
+                pass # already closed, or the client went first
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.thread is None or self.thread.is_alive():
+            self.close()
     
-    def decodeFrame(self, frameBuffer):
+    def decodeFrame(self, frameBuffer, codec=tcp.CODEC_JPEG, width=0, height=0):
         frameArray = np.frombuffer(frameBuffer, dtype=np.dtype('uint8'))
-        return cv2.imdecode(frameArray, flags=cv2.IMREAD_UNCHANGED)
-
-    def exportFrame(self):
-        result = False
-        outputFrame = None
-        if self.frames:
-            with serverLock:
-                outputFrame = self.frames.pop(0)
-                result = True
-        return (result, outputFrame)
+        if codec == tcp.CODEC_RAW:
+            frame = frameArray.reshape(height, width, -1)
+            if self.decodeReduction > 1:
+                frame = cv2.resize(frame, (width//self.decodeReduction, height//self.decodeReduction), interpolation=cv2.INTER_AREA)
+            return frame
+        return cv2.imdecode(frameArray, flags=getattr(cv2, self.decodeFlagName))
+
+    # Pop the oldest frame. Waits up to timeout seconds for one to arrive (0 never waits).
+    # In multi-client mode, streamId selects the client stream
+    def exportFrame(self, timeout=0, streamId=None):
+        if streamId is None:
+            frames = self.frames
+        else:
+            stream = self.streams.get(streamId)
+            if stream is None:
+                return (False, None)
+            frames = stream.frames
+        result, entry = frames.get(timeout=timeout)
+        if not result:
+            return (False, None)
+        frame, captureTime = entry
+        self.frameExported(captureTime)
+        return (True, frame)
+
+    def frameExported(self, captureTime):
+        if captureTime:
+            latency = time.time() - captureTime
+            self.exportLatency.add(latency)
+            self.exportLatencyHistogram.observe(latency)
+
+    # Pop up to batchSize of the oldest frames into one N x H x W x C array, waiting up to timeout
+    # seconds for a full batch (0 takes what is buffered). Frames are written straight into out,
+    # allocated from the first frame if None, and resized when their size differs from out's.
+    # colorConversion is an OpenCV code such as cv2.COLOR_BGR2RGB, applied while copying. Frames whose
+    # channel count differs from out's (or with colorConversion, from the first frame's) are skipped.
+    # Returns (number of frames written, out); rows past the number of frames are left untouched
+    def exportBatch(self, batchSize, out=None, timeout=0, colorConversion=None, streamId=None):
+        if streamId is None:
+            frames = self.frames.getBatch(batchSize, timeout)
+        else:
+            stream = self.streams.get(streamId)
+            frames = stream.frames.getBatch(batchSize, timeout) if stream is not None else []
+        if not frames:
+            return (0, out)
+        for frame, captureTime in frames:
+            self.frameExported(captureTime)
+        frames = [frame for frame, captureTime in frames]
+
+        # Frames are converted straight into out, only the first is converted on its own when out is allocated from it
+        row = 0
+        if out is None:
+            first = frames[0] if colorConversion is None else cv2.cvtColor(frames[0], colorConversion)
+            out = np.empty((batchSize,) + first.shape, first.dtype)
+            out[0] = first
+            row = 1
+        channels = frameChannels(frames[0]) if colorConversion is not None else (out.shape[3] if out.ndim == 4 else 1)
+        height, width = out.shape[1:3]
+        for frame in frames[row:]:
+            if frameChannels(frame) != channels:
+                continue # e.g. a grey PNG among colour frames
+            if frame.shape[:2] != (height, width):
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            if colorConversion is not None:
+                cv2.cvtColor(frame, colorConversion, dst=out[row])
+            else:
+                out[row] = frame.reshape(out.shape[1:])
+            row += 1
+        return (row, out)
+
+    # Identifiers of the currently connected client streams
+    def streamIds(self):
+        return list(self.streams)
     
     def close(self):
         print("[Server]: Closing")
         self.serverSocket.close()
         self.running = False
+        # Close the queues before the pool, so late submits are refused rather than reach a shut down pool
+        self.frames.close()
+        self.decodeQueue.close()
+        for stream in list(self.streams.values()):
+            stream.close()
+        self.decodePool.close()
+        self.displayFrames.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.broadcaster.close()
 
 if __name__ == '__main__':
     host = DEFAULT_HOST
     port = DEFAULT_PORT
     socketType = SOCKET_TYPE_UDP
 
-    # Set up and run server
+    # Set up and run server, the client can connect as soon as start returns
     server = VideoServer(host, port, socketType)
-    serverThread = threading.Thread(target=server.run)
-    serverThread.setDaemon(True)
-    serverThread.start()
-
-    time.sleep(3) # Give time for the server to be up and running
+    server.start()
 
     # Set up and run client
     client = VideoClient(host, port, socketType)
-    clientThread = threading.Thread(target=client.run)
-    clientThread.setDaemon(True)
-    clientThread.start()
+    client.start()
 
     # Run until end of program (i.e keyboard interrupt)
     try:
-        while True:
-            time.sleep(1)
+        server.thread.join()
     finally:
+        client.stop()
+        server.stop()
         print("Program ended")
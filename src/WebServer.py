@@ -1,53 +1,94 @@
 # Source: https://www.pyimagesearch.com/2019/09/02/opencv-stream-video-to-web-browser-html-page/
-from flask import Response
-from flask import Flask
-from flask import render_template
-import threading
-import cv2
+# Importing this module starts nothing. start() brings up the video server and returns the Flask app
+# Usage: python3 WebServer.py [--record [DIRECTORY]]
+import argparse
 import VideoStream as vs
-import time
+import Broadcaster as bc
+import Metrics as mt
+import Recording as rec
 
 # Constants
 DEFAULT_HOST = "localhost"
 DEFAULT_PORT = 6175
+DEFAULT_RECORD_PATH = "recordings" # where --record stores received frames for replay
+RECORD_MAX_SEGMENTS = 16 # ~1 GB of the most recent JPEG frames
 
 # Variables
-lock = threading.Lock()
-server = vs.VideoServer()
-serverThread = threading.Thread(target=server.run)
-serverThread.setDaemon(True)
-serverThread.start()
-
-app = Flask(__name__)
-
-@app.route("/")
-def index():
-    # Return the rendered template
-    return render_template("index.html")
-
-def generateVideoFrames():
-    while True:
-        result, outputFrame = server.exportFrame()
-
-        # Check if there is an output frame
-        if result is False:
-            continue
-        
-        # Encode the frame in JPEG format
-        (flag, encodedImage) = cv2.imencode(".jpg", outputFrame)
-
-        if not flag:
-            continue
-        
-        # yield the output frame in the byte format
-        yield(b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encodedImage) + b'\r\n')
-
-@app.route("/video_feed")
-def video_feed():
-	# Return the response generated along with the specific media type (mime type)
-	return Response(generateVideoFrames(),
-		mimetype = "multipart/x-mixed-replace; boundary=frame")
+server = None # the video server, once started
+
+def generateVideoFrames(videoServer):
+    # Every viewer shares the same encoded frames and skips ahead to the latest one when slow
+    for part in videoServer.broadcaster.subscribe():
+        yield part
+
+def generateReplayFrames(videoServer, start, speed):
+    # Recorded JPEGs are sent as they are, nothing is decoded. Playback follows the recording as it grows
+    reader = rec.RecordingReader(videoServer.recordPath)
+    try:
+        if start is not None and start < 0:
+            endTime = reader.endTime()
+            start = endTime + start if endTime is not None else None
+        for timestamp, jpeg in reader.play(start, speed, follow=True, running=lambda: not videoServer.broadcaster.closed):
+            yield bc.mjpegPart(jpeg)
+    finally:
+        reader.close()
+
+# Routes serving videoServer's stream. Flask is only imported here
+def createApp(videoServer):
+    from flask import Flask, Response, render_template, request
+    app = Flask(__name__)
+
+    @app.route("/")
+    def index():
+        # Return the rendered template
+        return render_template("index.html")
+
+    @app.route("/video_feed")
+    def video_feed():
+        # Return the response generated along with the specific media type (mime type)
+        return Response(generateVideoFrames(videoServer),
+            mimetype = "multipart/x-mixed-replace; boundary=" + bc.MJPEG_BOUNDARY.decode())
+
+    @app.route("/replay_feed")
+    def replay_feed():
+        # ?start= seconds since the epoch, or negative for seconds before the end of the recording, ?speed= playback rate
+        if videoServer.recordPath is None:
+            return Response("Recording is turned off", status=404, mimetype="text/plain")
+        start = request.args.get("start", type=float)
+        speed = request.args.get("speed", default=1.0, type=float)
+        return Response(generateReplayFrames(videoServer, start, speed),
+            mimetype = "multipart/x-mixed-replace; boundary=" + bc.MJPEG_BOUNDARY.decode())
+
+    @app.route("/metrics")
+    def metrics():
+        # Counters, queue depths and stage timings of the video server for Prometheus
+        return Response(videoServer.metrics.exposition(), content_type=mt.EXPOSITION_CONTENT_TYPE)
+
+    return app
+
+# Start the video server, waiting up to timeout seconds until clients can send to it, and return the app.
+# Received frames are recorded to recordPath for replay, None (the default) records nothing
+def start(timeout=None, recordPath=None):
+    global server
+    server = vs.VideoServer(recordPath=recordPath, recordMaxSegments=RECORD_MAX_SEGMENTS, live=True) # viewers read from the broadcaster, so keep no decoded backlog
+    server.start(timeout)
+    return createApp(server)
+
+def stop():
+    global server
+    if server is not None:
+        server.stop()
+        server = None
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the video stream to web browsers")
+    parser.add_argument("--record", nargs="?", const=DEFAULT_RECORD_PATH, metavar="DIRECTORY",
+                        help="record received frames for /replay_feed, to " + DEFAULT_RECORD_PATH + " by default")
+    args = parser.parse_args()
+
     # Running app
-    app.run(DEFAULT_HOST, DEFAULT_PORT, debug=True, threaded=True, use_reloader=False)
+    app = start(recordPath=args.record)
+    try:
+        app.run(DEFAULT_HOST, DEFAULT_PORT, debug=True, threaded=True, use_reloader=False)
+    finally:
+        stop()
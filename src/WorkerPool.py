@@ -0,0 +1,208 @@
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Constants
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1) # OpenCV releases the GIL while encoding and decoding
+DEFAULT_MAX_PENDING = 8 # frames in flight per queue
+STAGE_QUEUE = "queue" # submitted until a worker picks it up
+STAGE_WORK = "work" # encoding or decoding
+STAGE_REORDER = "reorder" # finished until earlier frames of the queue are delivered
+STAGES = (STAGE_QUEUE, STAGE_WORK, STAGE_REORDER)
+LATENCY_SAMPLES = 10000 # most recent samples kept for percentiles
+PERCENTILES = (50, 95, 99)
+
+# Running latency of one pipeline stage. Percentiles cover the most recent samples
+class LatencyStat:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.samples = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            self.samples.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            mean = self.total/self.count if self.count else 0
+            samples = sorted(self.samples)
+            snapshot = {"count": self.count, "meanMs": mean*1e3, "maxMs": self.max*1e3}
+        for percentile in PERCENTILES:
+            value = samples[min(len(samples) - 1, len(samples)*percentile//100)] if samples else 0
+            snapshot["p" + str(percentile) + "Ms"] = value*1e3
+        return snapshot
+
+# Worker threads that encode or decode frames off the network and capture threads.
+# Shared by every queue of a client or server
+class WorkerPool:
+    def __init__(self, numWorkers=DEFAULT_WORKERS, maxPending=DEFAULT_MAX_PENDING, name="worker"):
+        # Without workers, frames are processed inline by the submitting thread
+        self.executor = ThreadPoolExecutor(numWorkers, thread_name_prefix=name) if numWorkers > 0 else None
+        self.maxPending = maxPending
+        self.latency = {stage: LatencyStat() for stage in STAGES}
+        self.tasks = [] # heap of (-priority, order, task) waiting for a worker
+        self.tasksLock = threading.Lock()
+        self.taskOrder = itertools.count()
+
+    # An in-order queue delivering results to output. When the workers fall behind, queues of
+    # higher priority are served first
+    def orderedQueue(self, output, priority=0):
+        return OrderedQueue(self, output, priority)
+
+    # Run task() on a worker. A worker picks the waiting task of the highest priority when it
+    # becomes free, tasks of equal priority run in submission order
+    def submit(self, priority, task):
+        with self.tasksLock:
+            heapq.heappush(self.tasks, (-priority, next(self.taskOrder), task))
+        self.executor.submit(self._runNext)
+
+    def _runNext(self):
+        with self.tasksLock:
+            priority, order, task = heapq.heappop(self.tasks)
+        task()
+
+    def stats(self):
+        return {stage: stat.snapshot() for stage, stat in self.latency.items()}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+# Processes frames in parallel but delivers them in the order they were submitted
+class OrderedQueue:
+    def __init__(self, pool, output, priority=0):
+        self.pool = pool
+        self.output = output
+        self.priority = priority # may change while frames are pending
+        self.lock = threading.Lock()
+        self.notFull = threading.Condition(self.lock)
+        self.drained = threading.Condition(self.lock) # nothing pending
+        self.nextSubmit = 0 # sequence number of the next submitted frame
+        self.nextDeliver = 0 # sequence number of the next frame to deliver
+        self.results = {} # sequence number -> (result, work end time)
+        self.pending = 0
+        self.dropped = 0 # rejected because too many frames were pending
+        self.failed = 0 # frames the work function raised on or returned None for, or output raised on
+        self.closed = False
+        self.delivering = False # a worker is handing results to output
+
+    # Queue work(*args). Arguments must not be views into reused buffers. When the queue is full,
+    # the frame is dropped, or with block the caller waits up to timeout seconds for room.
+    # Returns False if the frame was not queued
+    def submit(self, work, *args, block=False, timeout=None):
+        with self.lock:
+            if self.pending >= self.pool.maxPending:
+                if not block or not self.notFull.wait_for(lambda: self.closed or self.pending < self.pool.maxPending, timeout):
+                    self.dropped += 1
+                    return False
+            if self.closed:
+                return False
+            sequence = self.nextSubmit
+            self.nextSubmit += 1
+            self.pending += 1
+
+        if self.pool.executor is None:
+            self._process(sequence, time.perf_counter(), work, args)
+            return True
+        try:
+            self.pool.submit(self.priority, functools.partial(self._process, sequence, time.perf_counter(), work, args))
+        except RuntimeError:
+            # The pool shut down after the check above, nothing more will be processed
+            self.close()
+            return False
+        return True
+
+    # Whether a submit would have to wait for room, or drop its frame
+    def full(self):
+        with self.lock:
+            return not self.closed and self.pending >= self.pool.maxPending
+
+    # Wait until every submitted frame was delivered or failed. Returns False on timeout
+    def join(self, timeout=None):
+        with self.lock:
+            return self.drained.wait_for(lambda: self.pending == 0, timeout)
+
+    # Wake producers blocked in submit and give up on frames not yet delivered, so join returns
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.results.clear()
+            self.pending = 0
+            self.notFull.notify_all()
+            self.drained.notify_all()
+
+    def _process(self, sequence, submitTime, work, args):
+        latency = self.pool.latency
+        startTime = time.perf_counter()
+        try:
+            result = work(*args)
+        except Exception:
+            result = None
+        finishTime = time.perf_counter()
+        latency[STAGE_QUEUE].add(startTime - submitTime)
+        latency[STAGE_WORK].add(finishTime - startTime)
+
+        with self.lock:
+            if self.closed:
+                return
+            self.results[sequence] = (result, finishTime)
+            # One worker delivers at a time, in order. The others leave their results to it
+            if self.delivering:
+                return
+            self.delivering = True
+
+        # Deliver every result that is next in line. Output runs without the lock, so an output that
+        # blocks (a full frame buffer) never holds up submit or close. Frames count as pending until
+        # delivered, so join only returns once output has them
+        delivered = 0
+        finished = False
+        try:
+            while True:
+                with self.lock:
+                    ready = []
+                    if not self.closed:
+                        self.pending -= delivered
+                        self.notFull.notify(delivered)
+                        if self.pending == 0:
+                            self.drained.notify_all()
+                        while self.nextDeliver in self.results:
+                            ready.append(self.results.pop(self.nextDeliver))
+                            self.nextDeliver += 1
+                    delivered = len(ready)
+                    if not ready:
+                        self.delivering = False
+                        finished = True
+                        return
+                for result, finishTime in ready:
+                    latency[STAGE_REORDER].add(time.perf_counter() - finishTime)
+                    if result is None:
+                        self.failed += 1
+                        continue
+                    try:
+                        self.output(result)
+                    except Exception as error:
+                        # One bad frame must not stop delivery of the frames after it
+                        self.failed += 1
+                        print("[WorkerPool]: Output failed: " + repr(error))
+        finally:
+            # Reached without finishing only if something escaped the loop. Hand delivery over again
+            if not finished:
+                with self.lock:
+                    if not self.closed:
+                        self.pending -= delivered
+                        self.notFull.notify(delivered)
+                        if self.pending == 0:
+                            self.drained.notify_all()
+                    self.delivering = False
@@ -0,0 +1,71 @@
+# Compares JPEG decode CPU per frame at full and reduced resolution, and the cost of handing frames
+# to a consumer one at a time against exportBatch into a preallocated RGB array
+# Usage: python3 benchmark_batch_decode.py [batch size]
+import sys
+import time
+import cv2
+import numpy as np
+import FrameSources as fs
+import VideoStream as vs
+
+# Constants
+FRAME_WIDTH = 1920
+FRAME_HEIGHT = 1080
+NUM_FRAMES = 120
+JPEG_QUALITY = 50
+BATCH_SIZE = 8
+HOST = "127.0.0.1"
+
+def encodeFrames():
+    source = fs.SyntheticSource(FRAME_WIDTH, FRAME_HEIGHT, pacing=fs.PACING_FAST, numFrames=NUM_FRAMES)
+    jpegs = []
+    while True:
+        ret, frame = source.read()
+        if not ret:
+            return jpegs
+        jpegs.append(cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])[1].tobytes())
+
+def benchmarkDecode(server, jpegs):
+    t0 = time.process_time()
+    for jpeg in jpegs:
+        frame = server.decodeFrame(jpeg)
+    return (time.process_time() - t0)/len(jpegs), frame.shape
+
+# The consumer wants RGB frames of the decoded size, batchSize at a time
+def benchmarkExport(server, frames, batchSize, batched):
+    height, width = frames[0].shape[:2]
+    out = np.empty((batchSize, height, width, 3), np.uint8)
+    for frame in frames:
+        server.frames.put((frame, 0.0))
+    t0 = time.process_time()
+    if batched:
+        while server.exportBatch(batchSize, out, colorConversion=cv2.COLOR_BGR2RGB)[0] > 0:
+            pass
+    else:
+        while True:
+            batch = []
+            while len(batch) < batchSize:
+                result, frame = server.exportFrame()
+                if not result:
+                    break
+                batch.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            if not batch:
+                break
+            out = np.stack(batch)
+    return (time.process_time() - t0)/len(frames)
+
+if __name__ == '__main__':
+    batchSize = int(sys.argv[1]) if len(sys.argv) > 1 else BATCH_SIZE
+    cv2.setNumThreads(1) # compare single-threaded CPU time
+    jpegs = encodeFrames()
+    print("{} frames of {}x{}, JPEG quality {}, batches of {}".format(NUM_FRAMES, FRAME_WIDTH, FRAME_HEIGHT, JPEG_QUALITY, batchSize))
+    print("{:>10} {:>12} {:>12} {:>16} {:>16}".format("reduction", "size", "decode/frame", "exportFrame/frame", "exportBatch/frame"))
+    for reduction in sorted(vs.DECODE_REDUCTIONS):
+        server = vs.VideoServer(HOST, 0, vs.SOCKET_TYPE_UDP, frameCapacity=NUM_FRAMES, display=False, decodeReduction=reduction)
+        decodeCpu, shape = benchmarkDecode(server, jpegs)
+        frames = [server.decodeFrame(jpeg) for jpeg in jpegs]
+        loopCpu = benchmarkExport(server, frames, batchSize, False)
+        batchCpu = benchmarkExport(server, frames, batchSize, True)
+        server.close()
+        print("{:>10} {:>12} {:>10.2f}ms {:>14.3f}ms {:>14.3f}ms".format(
+            "1/" + str(reduction), "{}x{}".format(shape[1], shape[0]), decodeCpu*1000, loopCpu*1000, batchCpu*1000))
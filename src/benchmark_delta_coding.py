@@ -0,0 +1,57 @@
+# Compares bytes and encode CPU per frame of full JPEG frames against delta coding for a static
+# scene with a small moving object, like a surveillance camera
+# Usage: python3 benchmark_delta_coding.py [keyframe interval ...]
+import sys
+import time
+import cv2
+import numpy as np
+import DeltaCoding as dc
+
+# Constants
+FRAME_WIDTH = 1280
+FRAME_HEIGHT = 720
+NUM_FRAMES = 300
+JPEG_QUALITY = 50
+SENSOR_NOISE = 2 # standard deviation of per-frame noise, real cameras never repeat a frame exactly
+KEYFRAME_INTERVALS = [30, 60, 300]
+
+# Textured background with a box crossing it and fresh sensor noise every frame
+def sceneFrames():
+    random = np.random.default_rng(0)
+    background = cv2.GaussianBlur(random.integers(0, 256, (FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8), (0, 0), 3)
+    noise = [random.normal(0, SENSOR_NOISE, background.shape) for iterator in range(8)]
+    for frameIndex in range(NUM_FRAMES):
+        frame = np.clip(background + noise[frameIndex % len(noise)], 0, 255).astype(np.uint8)
+        x = (frameIndex*4) % (FRAME_WIDTH - 120)
+        frame[300:400, x:x + 120] = (40, 40, 200)
+        yield frame
+
+def benchmarkJpeg(frames):
+    totalBytes = 0
+    t0 = time.process_time()
+    for frame in frames:
+        result, buf = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+        totalBytes += len(buf)
+    return totalBytes/len(frames), (time.process_time() - t0)/len(frames)
+
+def benchmarkDelta(frames, keyframeInterval):
+    encoder = dc.DeltaEncoder(keyframeInterval=keyframeInterval)
+    totalBytes = 0
+    t0 = time.process_time()
+    for frame in frames:
+        totalBytes += len(dc.encode(encoder.select(frame), JPEG_QUALITY))
+    return totalBytes/len(frames), (time.process_time() - t0)/len(frames)
+
+if __name__ == '__main__':
+    keyframeIntervals = [int(n) for n in sys.argv[1:]] or KEYFRAME_INTERVALS
+    cv2.setNumThreads(1) # compare single-threaded CPU time
+    frames = list(sceneFrames())
+
+    jpegBytes, jpegCpu = benchmarkJpeg(frames)
+    print("{} frames of {}x{}, JPEG quality {}".format(NUM_FRAMES, FRAME_WIDTH, FRAME_HEIGHT, JPEG_QUALITY))
+    print("{:>14} {:>12} {:>12} {:>10} {:>10}".format("mode", "bytes/frame", "CPU/frame", "bytes", "CPU"))
+    print("{:>14} {:>12.0f} {:>10.2f}ms {:>9.1f}x {:>9.1f}x".format("JPEG", jpegBytes, jpegCpu*1000, 1, 1))
+    for keyframeInterval in keyframeIntervals:
+        deltaBytes, deltaCpu = benchmarkDelta(frames, keyframeInterval)
+        print("{:>14} {:>12.0f} {:>10.2f}ms {:>9.1f}x {:>9.1f}x".format(
+            "delta, key " + str(keyframeInterval), deltaBytes, deltaCpu*1000, jpegBytes/deltaBytes, jpegCpu/deltaCpu))
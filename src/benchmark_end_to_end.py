@@ -0,0 +1,199 @@
+# End-to-end benchmark of the TCP and UDP paths over loopback, and of shared memory. Streams a fixed number of synthetic
+# frames per configuration, sweeping buffer size, packet size, resolution and JPEG quality one at a
+# time around a baseline. Reports throughput, glass-to-glass latency, CPU, bytes and drops. A consumer
+# slower than the source exports frames, so the live sweep shows what a backlog does to latency
+# Usage: python3 benchmark_end_to_end.py [--frames N] [--fast] [--consumer-fps FPS] [--sweep NAME ...] [--json FILE] [--compare FILE]
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import cv2
+import FrameBuffer as fb
+import FrameSources as fs
+import UDPPackets as udp
+import VideoStream as vs
+
+# Constants
+HOST = "127.0.0.1"
+DEFAULT_FRAMES = 300
+DEFAULT_FPS = 30
+DEFAULT_CONSUMER_FPS = 20 # exports per second, like an analytics model that cannot keep up with the source
+TRANSPORTS = [vs.SOCKET_TYPE_TCP, vs.SOCKET_TYPE_UDP, vs.SOCKET_TYPE_SHM]
+BASELINE = {"bufferSize": vs.DEFAULT_MESSAGE_BUFFER_SIZE, "packetSize": udp.ETHERNET_PACKET_SIZE,
+            "resolution": (640, 480), "quality": 50, "live": False}
+SWEEPS = {
+    "bufferSize": [1024, 10000, 30000], # the README's small, default and big buffers
+    "packetSize": [512, 1400, 8000], # UDP only, at most the baseline buffer size
+    "resolution": [(640, 480), (1280, 720), (1920, 1080)],
+    "quality": [30, 50, 80],
+    "live": [False, True], # queue every frame, or keep only the newest on both sides
+}
+SWEEP_TRANSPORTS = { # sweeps that only apply to some transports, shared memory sends raw frames
+    "bufferSize": [vs.SOCKET_TYPE_TCP, vs.SOCKET_TYPE_UDP],
+    "packetSize": [vs.SOCKET_TYPE_UDP],
+    "quality": [vs.SOCKET_TYPE_TCP, vs.SOCKET_TYPE_UDP],
+}
+DRAIN_TIME = 0.5 # seconds without a new frame on the server before a run ends
+REGRESSION_TOLERANCE = 0.1 # relative change flagged when comparing against a baseline
+LOWER_IS_BETTER = ("p95LatencyMs", "exportP95LatencyMs", "cpuMsPerFrame", "bytesPerFrame", "dropRate")
+HIGHER_IS_BETTER = ("fps",)
+
+# Configurations to run: the baseline plus each swept value, without repeats
+def configurations(transports, sweeps):
+    runs = []
+    for transport in transports:
+        seen = set()
+        for sweep in sweeps:
+            if transport not in SWEEP_TRANSPORTS.get(sweep, TRANSPORTS):
+                continue
+            for value in SWEEPS[sweep]:
+                config = dict(BASELINE, **{sweep: value})
+                # A datagram must fit the server's receive buffer, TCP has no packets
+                if transport == vs.SOCKET_TYPE_UDP:
+                    config["packetSize"] = min(config["packetSize"], config["bufferSize"])
+                else:
+                    del config["packetSize"]
+                key = tuple(sorted(config.items()))
+                if key in seen:
+                    continue
+                seen.add(key)
+                changed = [k + "=" + str(v) for k, v in config.items() if v != BASELINE[k]]
+                runs.append((transport + " " + (", ".join(changed) or "baseline"), transport, config))
+    return runs
+
+def cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+# Exports frames at consumerFps until stopped, spending each frame interval "processing" the frame
+def runConsumer(server, consumerFps, running):
+    interval = 1/consumerFps
+    while running.is_set():
+        result, frame = server.exportFrame(timeout=interval)
+        if result:
+            time.sleep(interval)
+
+def benchmark(transport, config, numFrames, fps, pacing, consumerFps):
+    width, height = config["resolution"]
+    packetSize = config.get("packetSize")
+    server = vs.VideoServer(HOST, 0, transport, config["bufferSize"], numFrames, packetSize=packetSize, display=False,
+                            live=config["live"])
+    port = server.serverSocket.getsockname()[1]
+    server.start()
+    consuming = threading.Event()
+    consuming.set()
+    consumerThread = threading.Thread(target=runConsumer, args=(server, consumerFps, consuming))
+    consumerThread.daemon = True
+    consumerThread.start()
+
+    source = fs.SyntheticSource(width, height, fps, pacing, numFrames)
+    cpu0 = cpuTime()
+    t0 = time.perf_counter()
+    client = vs.VideoClient(HOST, port, transport, videoPath=source, framePolicy=fb.POLICY_BLOCK,
+                            packetSize=packetSize, jpegQuality=config["quality"], live=config["live"])
+    client.run()
+
+    # Wait for the server to finish the frames still on the way
+    lastCount = -1
+    lastFrameTime = time.perf_counter()
+    while time.perf_counter() - lastFrameTime < DRAIN_TIME:
+        if server.framesReceived != lastCount:
+            lastCount = server.framesReceived
+            lastFrameTime = time.perf_counter()
+        time.sleep(0.01)
+    elapsed = lastFrameTime - t0
+    cpu = cpuTime() - cpu0
+    consuming.clear()
+    consumerThread.join()
+
+    server.stop(DRAIN_TIME)
+
+    received = server.framesReceived
+    latency = server.latency.snapshot()
+    exportLatency = server.exportLatency.snapshot() # the consumer's view, including any backlog
+    return {
+        "framesSent": client.framesSent,
+        "framesReceived": received,
+        "fps": received/elapsed if elapsed > 0 else 0,
+        "p50LatencyMs": latency["p50Ms"],
+        "p95LatencyMs": latency["p95Ms"],
+        "p99LatencyMs": latency["p99Ms"],
+        "exportP50LatencyMs": exportLatency["p50Ms"],
+        "exportP95LatencyMs": exportLatency["p95Ms"],
+        "framesExported": exportLatency["count"],
+        "framesDropped": client.frames.dropped + client.encodeQueue.dropped + server.frames.dropped + server.decodeQueue.dropped,
+        "cpuMsPerFrame": cpu/received*1e3 if received else 0, # client and server together
+        "bytesPerFrame": client.bytesSent/client.framesSent if client.framesSent else 0,
+        "dropRate": 1 - received/numFrames,
+    }
+
+# Relative changes beyond the tolerance in the worse direction, per run name
+def regressions(results, baseline):
+    baselineRuns = {run["name"]: run for run in baseline["results"]}
+    found = []
+    for run in results:
+        before = baselineRuns.get(run["name"])
+        if before is None:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if metric not in before:
+                continue # a baseline from before the metric existed
+            old, new = before[metric], run[metric]
+            if old == 0:
+                continue
+            change = (new - old)/abs(old)
+            if (metric in LOWER_IS_BETTER and change > REGRESSION_TOLERANCE) or (metric in HIGHER_IS_BETTER and change < -REGRESSION_TOLERANCE):
+                found.append((run["name"], metric, old, new, change))
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end TCP and UDP benchmark over loopback")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES, help="frames streamed per run")
+    parser.add_argument("--fps", type=float, default=DEFAULT_FPS, help="source frame rate when paced in real time")
+    parser.add_argument("--fast", action="store_true", help="send frames as fast as possible instead of in real time")
+    parser.add_argument("--consumer-fps", type=float, default=DEFAULT_CONSUMER_FPS, help="frames per second the consumer exports")
+    parser.add_argument("--transport", nargs="+", default=TRANSPORTS, choices=TRANSPORTS)
+    parser.add_argument("--sweep", nargs="+", default=list(SWEEPS), choices=list(SWEEPS))
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results file, exits with 1 on a regression")
+    args = parser.parse_args()
+    pacing = fs.PACING_FAST if args.fast else fs.PACING_REALTIME
+
+    results = []
+    print("{} frames per run, {}, consumer exporting at {} FPS".format(
+        args.frames, "as fast as possible" if args.fast else str(args.fps) + " FPS source", args.consumer_fps))
+    print("{:<40} {:>8} {:>9} {:>9} {:>9} {:>10} {:>12} {:>7} {:>10} {:>10}".format(
+        "run", "FPS", "p50", "p95", "p99", "CPU/frame", "bytes/frame", "drops", "export p50", "export p95"))
+    for name, transport, config in configurations(args.transport, args.sweep):
+        with contextlib.redirect_stdout(io.StringIO()): # silence the client and server progress output
+            r = benchmark(transport, config, args.frames, args.fps, pacing, args.consumer_fps)
+        r.update({"name": name, "transport": transport, "config": dict(config, resolution=list(config["resolution"]))})
+        results.append(r)
+        print("{:<40} {:>8.1f} {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms {:>8.2f}ms {:>12.0f} {:>6.1f}% {:>8.1f}ms {:>8.1f}ms".format(
+            name, r["fps"], r["p50LatencyMs"], r["p95LatencyMs"], r["p99LatencyMs"], r["cpuMsPerFrame"],
+            r["bytesPerFrame"], r["dropRate"]*100, r["exportP50LatencyMs"], r["exportP95LatencyMs"]))
+
+    output = {
+        "environment": {"python": platform.python_version(), "opencv": cv2.__version__, "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "settings": {"frames": args.frames, "fps": args.fps, "pacing": pacing, "consumerFps": args.consumer_fps},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as outputFile:
+            json.dump(output, outputFile, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            found = regressions(results, json.load(baselineFile))
+        for name, metric, old, new, change in found:
+            print("Regression: {} {} {:.2f} -> {:.2f} ({:+.0%})".format(name, metric, old, new, change))
+        if found:
+            sys.exit(1)
+        print("No regressions beyond {:.0%}".format(REGRESSION_TOLERANCE))
@@ -0,0 +1,96 @@
+# Measures delivered FPS under simulated packet loss with and without forward error correction
+import os
+import random
+import socket
+import threading
+import time
+import UDPPackets as udp
+
+# Constants
+HOST = "127.0.0.1"
+FRAME_SIZE = 60000 # bytes, roughly a 720p JPEG at quality 50
+PACKET_SIZE = udp.ETHERNET_PACKET_SIZE
+NUM_FRAMES = 300
+SOURCE_FPS = 60
+LOSS_RATES = [0.001, 0.01, 0.05]
+FEC_SETTINGS = [(10, 0), (20, 1), (10, 1), (10, 2)] # (group size, parity packets)
+SOCKET_BUFFER_SIZE = 4*1024*1024
+RECEIVE_TIMEOUT = 1 # seconds of silence before the receiver gives up
+
+# Socket shim that silently drops a fraction of outgoing datagrams
+class LossySocket:
+    def __init__(self, sock, lossRate, seed=0):
+        self.sock = sock
+        self.lossRate = lossRate
+        self.random = random.Random(seed)
+        self.dropped = 0
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        if self.random.random() < self.lossRate:
+            self.dropped += 1
+            return sum(len(b) for b in buffers)
+        return self.sock.sendmsg(buffers, ancdata, flags, address)
+
+    def sendto(self, data, address):
+        if self.random.random() < self.lossRate:
+            self.dropped += 1
+            return len(data)
+        return self.sock.sendto(data, address)
+
+def runReceiver(sock, results):
+    receiver = udp.UDPPacketReceiver(sock, PACKET_SIZE)
+    handler = udp.UDPPacketHandler()
+    try:
+        while True:
+            for packet, address in receiver.receive():
+                if handler.reassemblePackets(packet) is not None:
+                    results["lastFrameTime"] = time.perf_counter()
+    except socket.timeout:
+        pass
+    results.update(handler.stats())
+
+def benchmark(lossRate, fecGroupSize, fecParityPackets, payload):
+    serverSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    serverSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    serverSock.bind((HOST, 0))
+    serverSock.settimeout(RECEIVE_TIMEOUT)
+    clientSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    lossySock = LossySocket(clientSock, lossRate)
+
+    results = {}
+    receiverThread = threading.Thread(target=runReceiver, args=(serverSock, results))
+    receiverThread.start()
+
+    sender = udp.UDPPacketSender(lossySock, PACKET_SIZE, fecGroupSize, fecParityPackets)
+    address = serverSock.getsockname()
+    packetsSent = 0
+    frameInterval = 1/SOURCE_FPS
+    t0 = time.perf_counter()
+    for frameIndex in range(NUM_FRAMES):
+        packetsSent += sender.send(frameIndex, payload, address)
+        # Pace frames so losses come from the shim rather than socket buffer overflow
+        sleepTime = t0 + (frameIndex + 1)*frameInterval - time.perf_counter()
+        if sleepTime > 0:
+            time.sleep(sleepTime)
+
+    receiverThread.join()
+    clientSock.close()
+    serverSock.close()
+
+    elapsed = results.get("lastFrameTime", time.perf_counter()) - t0
+    results["packetsSent"] = packetsSent
+    results["deliveredFps"] = results["completed"]/elapsed
+    return results
+
+if __name__ == '__main__':
+    payload = os.urandom(FRAME_SIZE)
+    print("Sending {} frames of {} bytes at {} FPS in {} byte packets".format(NUM_FRAMES, FRAME_SIZE, SOURCE_FPS, PACKET_SIZE))
+    print("{:>6} {:>12} {:>10} {:>10} {:>14} {:>10}".format(
+        "loss", "FEC (N, K)", "packets", "recovered", "delivered FPS", "delivered"))
+    for lossRate in LOSS_RATES:
+        for fecGroupSize, fecParityPackets in FEC_SETTINGS:
+            r = benchmark(lossRate, fecGroupSize, fecParityPackets, payload)
+            fecSetting = "off" if fecParityPackets == 0 else "({}, {})".format(fecGroupSize, fecParityPackets)
+            print("{:>5.1f}% {:>12} {:>10} {:>10} {:>14.1f} {:>9.1f}%".format(
+                lossRate*100, fecSetting, r["packetsSent"], r["recovered"],
+                r["deliveredFps"], r["completed"]/NUM_FRAMES*100))
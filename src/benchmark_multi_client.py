@@ -0,0 +1,118 @@
+# Load generator: N synthetic clients stream to one multi-client VideoServer so scaling can be measured
+# Usage: python3 benchmark_multi_client.py [TCP|UDP] [clients ...]
+import multiprocessing
+import resource
+import socket
+import sys
+import threading
+import time
+import cv2
+import FrameSources as fs
+import WorkerPool as wp
+import TCPPackets as tcp
+import UDPPackets as udp
+import VideoStream as vs
+
+# Constants
+HOST = "127.0.0.1"
+CLIENT_COUNTS = [1, 4, 16, 32]
+CLIENT_FPS = 30
+DURATION = 5 # seconds each client streams for
+FRAME_WIDTH = 640
+FRAME_HEIGHT = 480
+PACKET_SIZE = udp.ETHERNET_PACKET_SIZE
+JPEG_QUALITY = 50
+RECEIVE_BUFFER_SIZE = 4*1024*1024 # bytes, so the server's socket buffer is not what limits scaling
+PACING_HEADROOM = 1.5 # UDP senders pace at this multiple of their average bitrate
+
+# A camera-like frame (~16 KB at 640x480), unlike random noise, which encodes to ~125 KB
+def syntheticFrame(seed):
+    result, frame = fs.SyntheticSource(FRAME_WIDTH, FRAME_HEIGHT, seed=seed).read()
+    result, buf = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+    return buf.tobytes()
+
+# A camera-less client that sends the same JPEG at a fixed frame rate
+def runClient(socketType, port, seed):
+    payload = syntheticFrame(seed)
+    if socketType == vs.SOCKET_TYPE_TCP:
+        sock = socket.create_connection((HOST, port))
+        header = tcp.TCPFrameHeader(tcp.CODEC_JPEG, FRAME_WIDTH, FRAME_HEIGHT, 0, len(payload))
+    else:
+        # Spread each frame's packets over the frame interval instead of bursting them
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        pacer = udp.TokenBucket(len(payload)*8*CLIENT_FPS*PACING_HEADROOM)
+        sender = udp.UDPPacketSender(sock, PACKET_SIZE, pacer=pacer)
+
+    frameInterval = 1/CLIENT_FPS
+    t0 = time.perf_counter()
+    for frameIndex in range(DURATION*CLIENT_FPS):
+        if socketType == vs.SOCKET_TYPE_TCP:
+            header.timestamp = time.time()
+            sock.sendall(header.encode() + payload)
+        else:
+            sender.send(frameIndex, payload, (HOST, port))
+        sleepTime = t0 + (frameIndex + 1)*frameInterval - time.perf_counter()
+        if sleepTime > 0:
+            time.sleep(sleepTime)
+    sock.close()
+
+def benchmark(socketType, numClients):
+    server = vs.VideoServer(HOST, 0, socketType, vs.DEFAULT_MESSAGE_BUFFER_SIZE, multiClient=True, display=False,
+                            receiveBufferSize=RECEIVE_BUFFER_SIZE)
+    port = server.serverSocket.getsockname()[1]
+    server.start()
+
+    # Streams are forgotten on disconnect, so keep a reference to each one
+    seenStreams = {}
+    def watchStreams():
+        while server.running:
+            for streamId in server.streamIds():
+                seenStreams.setdefault(streamId, server.streams.get(streamId))
+            time.sleep(0.05)
+
+    cpu0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.perf_counter()
+    clients = [multiprocessing.Process(target=runClient, args=(socketType, port, seed)) for seed in range(numClients)]
+    for client in clients:
+        client.start()
+    watcher = threading.Thread(target=watchStreams)
+    watcher.start()
+    for client in clients:
+        client.join()
+    time.sleep(0.5) # let the server drain its socket buffers
+    elapsed = time.perf_counter() - t0
+    cpu1 = resource.getrusage(resource.RUSAGE_SELF)
+
+    server.stop()
+    watcher.join()
+
+    received = [stream.framesReceived for stream in seenStreams.values() if stream is not None]
+    sent = DURATION*CLIENT_FPS
+    cpu = (cpu1.ru_utime - cpu0.ru_utime) + (cpu1.ru_stime - cpu0.ru_stime)
+    latency = server.decodePool.stats()
+    return {
+        "streams": len(received),
+        "totalFps": sum(received)/elapsed,
+        "minDelivered": min(received, default=0)/sent,
+        "meanDelivered": (sum(received)/len(received) if received else 0)/sent,
+        "serverCpu": cpu/elapsed,
+        "queueMs": latency[wp.STAGE_QUEUE]["meanMs"],
+        "decodeMs": latency[wp.STAGE_WORK]["meanMs"],
+        "reorderMs": latency[wp.STAGE_REORDER]["meanMs"],
+    }
+
+if __name__ == '__main__':
+    socketType = sys.argv[1].upper() if len(sys.argv) > 1 else vs.SOCKET_TYPE_UDP
+    clientCounts = [int(n) for n in sys.argv[2:]] or CLIENT_COUNTS
+
+    results = []
+    for numClients in clientCounts:
+        results.append((numClients, benchmark(socketType, numClients)))
+
+    print("{} clients at {} FPS for {} seconds".format(socketType, CLIENT_FPS, DURATION))
+    print("{:>8} {:>8} {:>10} {:>14} {:>14} {:>12} {:>10} {:>10} {:>10}".format(
+        "clients", "streams", "total FPS", "min delivered", "mean delivered", "server CPU", "queue", "decode", "reorder"))
+    for numClients, r in results:
+        print("{:>8} {:>8} {:>10.1f} {:>13.1f}% {:>13.1f}% {:>11.1f}% {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms".format(
+            numClients, r["streams"], r["totalFps"], r["minDelivered"]*100, r["meanDelivered"]*100, r["serverCpu"]*100,
+            r["queueMs"], r["decodeMs"], r["reorderMs"]))
@@ -0,0 +1,118 @@
+# Measures delivered frames and delivery latency under simulated packet loss, without repair,
+# with forward error correction and with NACK retransmission
+import os
+import socket
+import threading
+import time
+import UDPPackets as udp
+import WorkerPool as wp
+from benchmark_fec_loss import LossySocket
+
+# Constants
+HOST = "127.0.0.1"
+FRAME_SIZE = 60000 # bytes, roughly a 720p JPEG at quality 50
+PACKET_SIZE = udp.ETHERNET_PACKET_SIZE
+NUM_FRAMES = 300
+SOURCE_FPS = 60
+LOSS_RATES = [0.001, 0.01, 0.05]
+MODES = ["off", "FEC (10, 1)", "NACK"]
+SOCKET_BUFFER_SIZE = 4*1024*1024
+IDLE_TIMEOUT = 1 # seconds of silence before the receiver gives up
+
+# Delivery latency is measured from the send time stamped into each frame's packets
+def runReceiver(sock, lossySock, nackDeadline, results):
+    receiver = udp.UDPPacketReceiver(sock, PACKET_SIZE)
+    handler = udp.UDPPacketHandler(nackDeadline=nackDeadline)
+    latency = wp.LatencyStat()
+    sock.settimeout(udp.NACK_INTERVAL)
+    address = None
+    lastPacketTime = time.monotonic()
+
+    def delivered(frameBytes):
+        while frameBytes is not None:
+            latency.add(time.time() - handler.lastTimestamp)
+            frameBytes = handler.popReadyFrame() if nackDeadline is not None else None
+
+    while time.monotonic() - lastPacketTime < IDLE_TIMEOUT:
+        try:
+            batch = receiver.receive()
+        except socket.timeout:
+            batch = []
+        for packet, address in batch:
+            lastPacketTime = time.monotonic()
+            delivered(handler.reassemblePackets(packet))
+        if nackDeadline is not None and address is not None:
+            for nack in handler.pendingNacks():
+                lossySock.sendto(nack.encode(), address)
+            delivered(handler.popReadyFrame())
+    results.update(handler.stats())
+    results["latency"] = latency.snapshot()
+
+# Answers NACKs from the sender's cache, like VideoClient.runControl
+def runNackListener(sock, sender, address, running):
+    sock.settimeout(0.1)
+    while running.is_set():
+        try:
+            msg = sock.recv(udp.MAX_UDP_PACKET_SIZE)
+        except socket.timeout:
+            continue
+        nack = udp.UDPNack.decode(msg)
+        if nack is not None:
+            sender.resend(nack, address)
+
+def benchmark(lossRate, mode, payload):
+    serverSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    serverSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    serverSock.bind((HOST, 0))
+    clientSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    clientSock.bind((HOST, 0))
+    # Loss applies both ways, to retransmissions and NACKs too
+    lossyClientSock = LossySocket(clientSock, lossRate)
+    lossyServerSock = LossySocket(serverSock, lossRate, seed=1)
+
+    nack = mode == "NACK"
+    fecParityPackets = 1 if mode.startswith("FEC") else 0
+    sender = udp.UDPPacketSender(lossyClientSock, PACKET_SIZE, 10, fecParityPackets,
+                                 retransmitWindow=udp.DEFAULT_RETRANSMIT_WINDOW if nack else None)
+    address = serverSock.getsockname()
+
+    results = {}
+    receiverThread = threading.Thread(target=runReceiver,
+                                      args=(serverSock, lossyServerSock, udp.DEFAULT_NACK_DEADLINE if nack else None, results))
+    receiverThread.start()
+    running = threading.Event()
+    running.set()
+    listenerThread = threading.Thread(target=runNackListener, args=(clientSock, sender, address, running))
+    listenerThread.start()
+
+    packetsSent = 0
+    frameInterval = 1/SOURCE_FPS
+    t0 = time.perf_counter()
+    for frameIndex in range(NUM_FRAMES):
+        packetsSent += sender.send(frameIndex, payload, address, time.time())
+        # Pace frames so losses come from the shim rather than socket buffer overflow
+        sleepTime = t0 + (frameIndex + 1)*frameInterval - time.perf_counter()
+        if sleepTime > 0:
+            time.sleep(sleepTime)
+
+    receiverThread.join()
+    running.clear()
+    listenerThread.join()
+    clientSock.close()
+    serverSock.close()
+
+    results["packetsSent"] = packetsSent + sender.retransmitted
+    return results
+
+if __name__ == '__main__':
+    payload = os.urandom(FRAME_SIZE)
+    print("Sending {} frames of {} bytes at {} FPS in {} byte packets, NACK deadline {} ms".format(
+        NUM_FRAMES, FRAME_SIZE, SOURCE_FPS, PACKET_SIZE, udp.DEFAULT_NACK_DEADLINE*1e3))
+    print("{:>6} {:>12} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "loss", "repair", "packets", "delivered", "repaired", "p50 ms", "p99 ms"))
+    for lossRate in LOSS_RATES:
+        for mode in MODES:
+            r = benchmark(lossRate, mode, payload)
+            print("{:>5.1f}% {:>12} {:>10} {:>9.1f}% {:>10} {:>10.2f} {:>10.2f}".format(
+                lossRate*100, mode, r["packetsSent"], r["completed"]/NUM_FRAMES*100, r["repaired"],
+                r["latency"]["p50Ms"], r["latency"]["p99Ms"]))
@@ -0,0 +1,76 @@
+# Measures incomplete frames when the receiver's socket buffer overflows, with frames sent in
+# bursts and paced by a token bucket at the same average bitrate
+# Usage: python3 benchmark_pacing.py [receive buffer bytes ...]
+import os
+import socket
+import sys
+import threading
+import time
+import UDPPackets as udp
+
+# Constants
+HOST = "127.0.0.1"
+FRAME_SIZE = 60000 # bytes, roughly a 720p JPEG at quality 50
+PACKET_SIZE = udp.ETHERNET_PACKET_SIZE
+NUM_FRAMES = 300
+SOURCE_FPS = 30
+DECODE_TIME = 0.02 # seconds the receiver is busy after each frame, as if decoding it
+RECEIVE_BUFFER_SIZES = [16*1024, 32*1024, 64*1024] # requested, Linux grants twice this
+PACING_HEADROOM = [None, 1.5, 1.1] # pacing bitrate over the average bitrate, None sends bursts
+RECEIVE_TIMEOUT = 1 # seconds of silence before the receiver gives up
+
+def runReceiver(sock, results):
+    receiver = udp.UDPPacketReceiver(sock, PACKET_SIZE)
+    handler = udp.UDPPacketHandler()
+    try:
+        while True:
+            for packet, address in receiver.receive():
+                if handler.reassemblePackets(packet) is not None:
+                    time.sleep(DECODE_TIME)
+    except socket.timeout:
+        pass
+    handler.expireFrames(time.monotonic() + udp.DEFAULT_REASSEMBLY_TIMEOUT)
+    results.update(handler.stats())
+
+def benchmark(receiveBufferSize, headroom, payload):
+    serverSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sendBufferSize, grantedSize = udp.setSocketBuffers(serverSock, receiveBufferSize=receiveBufferSize)
+    serverSock.bind((HOST, 0))
+    serverSock.settimeout(RECEIVE_TIMEOUT)
+    clientSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    results = {"receiveBuffer": grantedSize}
+    receiverThread = threading.Thread(target=runReceiver, args=(serverSock, results))
+    receiverThread.start()
+
+    averageBitrate = FRAME_SIZE*8*SOURCE_FPS
+    pacer = udp.TokenBucket(averageBitrate*headroom) if headroom else None
+    sender = udp.UDPPacketSender(clientSock, PACKET_SIZE, pacer=pacer)
+    address = serverSock.getsockname()
+    frameInterval = 1/SOURCE_FPS
+    t0 = time.perf_counter()
+    for frameIndex in range(NUM_FRAMES):
+        sender.send(frameIndex, payload, address)
+        sleepTime = t0 + (frameIndex + 1)*frameInterval - time.perf_counter()
+        if sleepTime > 0:
+            time.sleep(sleepTime)
+    results["sendFps"] = NUM_FRAMES/(time.perf_counter() - t0)
+
+    receiverThread.join()
+    clientSock.close()
+    serverSock.close()
+    return results
+
+if __name__ == '__main__':
+    receiveBufferSizes = [int(n) for n in sys.argv[1:]] or RECEIVE_BUFFER_SIZES
+    payload = os.urandom(FRAME_SIZE)
+    print("Sending {} frames of {} bytes at {} FPS ({:.1f} Mbit/s) in {} byte packets, {} ms decode per frame".format(
+        NUM_FRAMES, FRAME_SIZE, SOURCE_FPS, FRAME_SIZE*8*SOURCE_FPS/1e6, PACKET_SIZE, DECODE_TIME*1000))
+    print("{:>14} {:>10} {:>10} {:>12} {:>10}".format("receive buffer", "pacing", "send FPS", "incomplete", "delivered"))
+    for receiveBufferSize in receiveBufferSizes:
+        for headroom in PACING_HEADROOM:
+            r = benchmark(receiveBufferSize, headroom, payload)
+            pacing = "burst" if headroom is None else "x{:.1f}".format(headroom)
+            incomplete = NUM_FRAMES - r["completed"]
+            print("{:>14} {:>10} {:>10.1f} {:>12} {:>9.1f}%".format(
+                r["receiveBuffer"], pacing, r["sendFps"], incomplete, r["completed"]/NUM_FRAMES*100))
@@ -0,0 +1,77 @@
+# Measures UDP frame throughput and CPU cost per packet size over loopback
+import os
+import socket
+import threading
+import time
+import UDPPackets as udp
+
+# Constants
+HOST = "127.0.0.1"
+FRAME_SIZE = 60000 # bytes, roughly a 720p JPEG at quality 50
+NUM_FRAMES = 300
+PACKET_SIZES = [200, 576, 1400, 4096, 8192, 16384, 32768, udp.MAX_UDP_PACKET_SIZE]
+SOCKET_BUFFER_SIZE = 4*1024*1024
+RECEIVE_TIMEOUT = 1 # seconds of silence before the receiver gives up
+
+def runReceiver(sock, packetSize, results):
+    receiver = udp.UDPPacketReceiver(sock, packetSize)
+    handler = udp.UDPPacketHandler()
+    completedFrames = 0
+    packetsReceived = 0
+    cpu0 = time.thread_time()
+    try:
+        while True:
+            for packet, address in receiver.receive():
+                packetsReceived += 1
+                if handler.reassemblePackets(packet) is not None:
+                    completedFrames += 1
+    except socket.timeout:
+        pass
+    results["completedFrames"] = completedFrames
+    results["packetsReceived"] = packetsReceived
+    results["receiverCpu"] = time.thread_time() - cpu0
+
+def benchmark(packetSize, payload):
+    serverSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    serverSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    serverSock.bind((HOST, 0))
+    serverSock.settimeout(RECEIVE_TIMEOUT)
+    clientSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    clientSock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
+    results = {}
+    receiverThread = threading.Thread(target=runReceiver, args=(serverSock, packetSize, results))
+    receiverThread.start()
+
+    sender = udp.UDPPacketSender(clientSock, packetSize)
+    address = serverSock.getsockname()
+    packetsSent = 0
+    cpu0 = time.thread_time()
+    t0 = time.perf_counter()
+    for frameIndex in range(NUM_FRAMES):
+        packetsSent += sender.send(frameIndex, payload, address)
+    sendTime = time.perf_counter() - t0
+    senderCpu = time.thread_time() - cpu0
+
+    receiverThread.join()
+    clientSock.close()
+    serverSock.close()
+
+    results["packetSize"] = packetSize
+    results["packetsSent"] = packetsSent
+    results["sendFps"] = NUM_FRAMES/sendTime
+    results["senderCpuPerFrame"] = senderCpu/NUM_FRAMES
+    results["deliveredRatio"] = results["completedFrames"]/NUM_FRAMES
+    return results
+
+if __name__ == '__main__':
+    payload = os.urandom(FRAME_SIZE)
+    print("Sending {} frames of {} bytes over loopback".format(NUM_FRAMES, FRAME_SIZE))
+    print("{:>10} {:>10} {:>10} {:>16} {:>16} {:>10}".format(
+        "packet", "packets", "send FPS", "send CPU/frame", "recv CPU/frame", "delivered"))
+    for packetSize in PACKET_SIZES:
+        r = benchmark(packetSize, payload)
+        receiverCpuPerFrame = r["receiverCpu"]/max(1, r["completedFrames"])
+        print("{:>10} {:>10} {:>10.1f} {:>14.1f}us {:>14.1f}us {:>9.1f}%".format(
+            packetSize, r["packetsSent"], r["sendFps"], r["senderCpuPerFrame"]*1e6,
+            receiverCpuPerFrame*1e6, r["deliveredRatio"]*100))
@@ -0,0 +1,73 @@
+# Measures startup from launching a fresh process to its first delivered frame, split into imports,
+# the server becoming ready, the client capturing its first frame and the server delivering it.
+# Also times importing the web server, which should load and start nothing
+# Usage: python3 benchmark_startup.py [runs]
+import contextlib
+import importlib
+import io
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Constants
+HOST = "127.0.0.1"
+RUNS = 5
+FRAME_WIDTH = 640
+FRAME_HEIGHT = 480
+FIRST_FRAME_TIMEOUT = 10 # seconds
+MODES = ["import WebServer", "TCP", "UDP", "SHM"]
+STAGES = ["imported", "ready", "captured", "delivered"]
+HEAVY_MODULES = ("cv2", "numpy", "flask", "jinja2")
+
+# Runs in the child process. Stage times are seconds since the parent launched it
+def runChild(mode, launchTime):
+    stages = {}
+    if mode == "import WebServer":
+        importlib.import_module("WebServer")
+        stages["imported"] = time.time() - launchTime
+        stages["loaded"] = [name for name in HEAVY_MODULES if name in sys.modules]
+        return stages
+
+    import FrameSources as fs
+    import VideoStream as vs
+    stages["imported"] = time.time() - launchTime
+    with contextlib.redirect_stdout(io.StringIO()): # silence the client and server progress output
+        server = vs.VideoServer(HOST, 0, mode, display=False)
+        server.start(FIRST_FRAME_TIMEOUT)
+        stages["ready"] = time.time() - launchTime
+        port = server.serverSocket.getsockname()[1]
+        source = fs.SyntheticSource(FRAME_WIDTH, FRAME_HEIGHT)
+        client = vs.VideoClient(HOST, port, mode, videoPath=source)
+        client.start(FIRST_FRAME_TIMEOUT)
+        stages["captured"] = time.time() - launchTime
+        if server.firstFrame.wait(FIRST_FRAME_TIMEOUT):
+            stages["delivered"] = time.time() - launchTime
+        client.stop()
+        server.stop()
+    return stages
+
+def benchmark(mode):
+    launchTime = time.time()
+    output = subprocess.run([sys.executable, __file__, "--child", mode, repr(launchTime)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        print(json.dumps(runChild(sys.argv[2], float(sys.argv[3]))))
+        sys.exit()
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    print("Median of {} fresh processes, milliseconds since launch".format(runs))
+    print("{:<18} {:>10} {:>10} {:>10} {:>10}".format("mode", *STAGES))
+    for mode in MODES:
+        results = [benchmark(mode) for iterator in range(runs)]
+        columns = []
+        for stage in STAGES:
+            times = [r[stage] for r in results if stage in r]
+            columns.append("{:>8.1f}ms".format(statistics.median(times)*1000) if times else "{:>10}".format("-"))
+        print("{:<18} {}".format(mode, " ".join(columns)))
+        if "loaded" in results[0]:
+            print("{:<18} loaded: {}".format("", ", ".join(results[0]["loaded"]) or "nothing heavy"))
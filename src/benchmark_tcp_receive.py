@@ -0,0 +1,65 @@
+# Compares the TCP receive engine against the original append-and-slice loop over loopback
+import os
+import socket
+import threading
+import time
+import TCPPackets as tcp
+
+# Constants
+HOST = "127.0.0.1"
+BUFFER_SIZES = [1024, 10000, 30000] # the small, default and big example buffer sizes
+FRAME_SIZES = [60000, 1280*720*3] # a 720p JPEG and a raw 720p BGR frame
+NUM_FRAMES = 60
+
+def sendFrames(port, payload):
+    with socket.create_connection((HOST, port)) as sock:
+        header = tcp.TCPFrameHeader(tcp.CODEC_RAW, 0, 0, time.time(), len(payload)).encode()
+        message = header + payload
+        for frameIndex in range(NUM_FRAMES):
+            sock.sendall(message)
+
+# The receive loop the server used before TCPFrameReceiver
+def legacyReceive(connection, msgBufferSize):
+    data = b''
+    headerSize = tcp.TCPFrameHeader.headerSize
+    for frameIndex in range(NUM_FRAMES):
+        while len(data) < headerSize:
+            data += connection.recv(msgBufferSize)
+        header = tcp.TCPFrameHeader.decode(data)
+        data = data[headerSize:]
+        while len(data) < header.length:
+            data += connection.recv(msgBufferSize)
+        data = data[header.length:]
+
+def receiverReceive(connection, msgBufferSize):
+    receiver = tcp.TCPFrameReceiver(connection, msgBufferSize)
+    for frameIndex in range(NUM_FRAMES):
+        header, frameData = receiver.receive()
+
+def benchmark(receive, msgBufferSize, payload):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as serverSock:
+        serverSock.bind((HOST, 0))
+        serverSock.listen(1)
+        senderThread = threading.Thread(target=sendFrames, args=(serverSock.getsockname()[1], payload))
+        senderThread.start()
+        connection, address = serverSock.accept()
+
+        with connection:
+            cpu0 = time.thread_time()
+            t0 = time.perf_counter()
+            receive(connection, msgBufferSize)
+            elapsed = time.perf_counter() - t0
+            cpu = time.thread_time() - cpu0
+        senderThread.join()
+    return NUM_FRAMES/elapsed, cpu/NUM_FRAMES
+
+if __name__ == '__main__':
+    print("{:>10} {:>10} {:>12} {:>14} {:>12} {:>14}".format(
+        "frame", "buffer", "legacy FPS", "legacy CPU", "engine FPS", "engine CPU"))
+    for frameSize in FRAME_SIZES:
+        payload = os.urandom(frameSize)
+        for msgBufferSize in BUFFER_SIZES:
+            legacyFps, legacyCpu = benchmark(legacyReceive, msgBufferSize, payload)
+            engineFps, engineCpu = benchmark(receiverReceive, msgBufferSize, payload)
+            print("{:>10} {:>10} {:>12.1f} {:>12.2f}ms {:>12.1f} {:>12.2f}ms".format(
+                frameSize, msgBufferSize, legacyFps, legacyCpu*1e3, engineFps, engineCpu*1e3))
@@ -0,0 +1,116 @@
+# Load test for the MJPEG endpoint: opens N streaming viewers and reports per-viewer FPS and server RSS
+# Usage: python3 benchmark_web_viewers.py [AsyncWebServer.py|WebServer.py] [viewers ...]
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+import Broadcaster as bc
+import UDPPackets as udp
+import VideoStream as vs
+
+# Constants
+WEB_HOST = "localhost"
+WEB_PORT = 6175
+VIEWER_COUNTS = [1, 10, 100, 300]
+SOURCE_FPS = 30
+DURATION = 5 # seconds each round of viewers watches for
+STARTUP_TIMEOUT = 30 # seconds for the web server to come up
+CONNECT_RETRY_TIME = 0.05 # seconds between attempts to reach it
+READ_LIMIT = 4*1024*1024 # largest multipart part a viewer accepts
+
+# Camera-less client feeding the web server's VideoServer until stopped
+def sendFrames(stopEvent):
+    # Smooth gradient with light noise compresses like a camera image
+    gradient = np.linspace(0, 255, 640, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    noise = np.random.default_rng(0).normal(0, 8, (480, 640, 3))
+    frame = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+    result, buf = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
+    payload = buf.tobytes()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender = udp.UDPPacketSender(sock, udp.defaultPacketSize(vs.DEFAULT_HOST, vs.DEFAULT_PORT, vs.DEFAULT_MESSAGE_BUFFER_SIZE))
+    frameIndex = 0
+    while not stopEvent.is_set():
+        sender.send(frameIndex, payload, (vs.DEFAULT_HOST, vs.DEFAULT_PORT))
+        frameIndex += 1
+        time.sleep(1/SOURCE_FPS)
+    sock.close()
+
+# Wait until the web server accepts connections. Returns False if it never does
+def waitForWebServer():
+    endTime = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < endTime:
+        try:
+            socket.create_connection((WEB_HOST, WEB_PORT), CONNECT_RETRY_TIME).close()
+            return True
+        except OSError:
+            time.sleep(CONNECT_RETRY_TIME)
+    return False
+
+def residentMemory(pid):
+    with open("/proc/" + str(pid) + "/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])*1024
+    return 0
+
+async def watch(counts, index, endTime):
+    try:
+        reader, writer = await asyncio.open_connection(WEB_HOST, WEB_PORT, limit=READ_LIMIT)
+    except OSError:
+        return
+    writer.write(b'GET /video_feed HTTP/1.1\r\nHost: ' + WEB_HOST.encode() + b'\r\n\r\n')
+    try:
+        await reader.readuntil(b'\r\n\r\n') # response headers
+        while time.monotonic() < endTime:
+            await asyncio.wait_for(reader.readuntil(bc.PART_HEADER), endTime - time.monotonic())
+            counts[index] += 1
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def benchmark(numViewers, serverPid):
+    counts = [0]*numViewers
+    endTime = time.monotonic() + DURATION
+    viewers = [asyncio.ensure_future(watch(counts, i, endTime)) for i in range(numViewers)]
+    await asyncio.sleep(DURATION/2)
+    rss = residentMemory(serverPid)
+    await asyncio.gather(*viewers)
+    # The first part only marks the start of the stream
+    fps = [max(0, count - 1)/DURATION for count in counts]
+    return {"minFps": min(fps), "meanFps": sum(fps)/len(fps), "rss": rss}
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    script = args.pop(0) if args and args[0].endswith(".py") else "AsyncWebServer.py"
+    viewerCounts = [int(n) for n in args] or VIEWER_COUNTS
+
+    srcDir = os.path.dirname(os.path.abspath(__file__))
+    serverProcess = subprocess.Popen([sys.executable, os.path.join(srcDir, script)], cwd=srcDir,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stopEvent = threading.Event()
+    senderThread = threading.Thread(target=sendFrames, args=(stopEvent,))
+    try:
+        if not waitForWebServer():
+            sys.exit(script + " did not start listening on port " + str(WEB_PORT))
+        senderThread.start()
+        time.sleep(1)
+        idleRss = residentMemory(serverProcess.pid)
+
+        results = []
+        for numViewers in viewerCounts:
+            results.append((numViewers, asyncio.run(benchmark(numViewers, serverProcess.pid))))
+    finally:
+        stopEvent.set()
+        serverProcess.terminate()
+        serverProcess.wait()
+
+    print("{} with a {} FPS source, idle RSS {:.1f} MB".format(script, SOURCE_FPS, idleRss/1e6))
+    print("{:>8} {:>10} {:>10} {:>12}".format("viewers", "min FPS", "mean FPS", "server RSS"))
+    for numViewers, r in results:
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f}MB".format(numViewers, r["minFps"], r["meanFps"], r["rss"]/1e6))